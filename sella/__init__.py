@@ -1,3 +1,3 @@
 from .sella import MinModeAtoms
-from .optimize import optimize
-from .irc import irc
+from .optimize import optimize, optimize_iter
+from .irc import irc, irc_iter
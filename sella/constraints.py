@@ -3,7 +3,7 @@ import warnings
 import numpy as np
 from scipy.linalg import null_space
 
-from .cython_routines import modified_gram_schmidt
+from .cython_routines import block_ortho
 from .internal_cython import cart_to_internal
 
 
@@ -259,7 +259,7 @@ def calc_constr_basis(x, con, ncon, rot_center, rot_axes):
         Tc = drdx / np.linalg.norm(drdx)
     # Otherwise, we need to orthonormalize everything
     else:
-        Tc = modified_gram_schmidt(drdx)
+        Tc = block_ortho(drdx)
 
     Tm = null_space(Tc.T)
 
@@ -5,7 +5,8 @@ from cython.view cimport array as cvarray
 
 from scipy.linalg.cython_blas cimport ddot, dgemv, dnrm2, dcopy, daxpy, dscal
 from scipy.linalg.cython_lapack cimport dgels, dgesvd
-from scipy.linalg import null_space
+from scipy.linalg import null_space, solve_triangular
+from scipy.linalg.lapack import dpotrf, dpstrf
 
 from libc.math cimport sqrt, fabs
 from libc.stdlib cimport malloc, free
@@ -136,7 +137,7 @@ def modified_gram_schmidt(X_np, double eps=1e-15):
     with nogil:
         for i in range(n):
             while True:
-                for j in range(i - 1):
+                for j in range(i):
                     scale = -ddot(&d, &X[0, j], &sd, &X[0, i], &sd)
                     daxpy(&d, &scale, &X[0, j], &sd, &X[0, i], &sd)
                 scale = dnrm2(&d, &X[0, i], &sd)
@@ -147,6 +148,70 @@ def modified_gram_schmidt(X_np, double eps=1e-15):
 
     return X_local
 
+def _gram_cholesky(G, double eps):
+    """Upper Cholesky factor R of the Gram matrix G, whose diagonal
+    must be 1. If G is numerically singular, a pivoted factorization
+    is used instead, and the factor of the largest set of independent
+    columns is returned together with their indices."""
+    R, info = dpotrf(G, lower=0, clean=1)
+    if info == 0 and np.min(np.diag(R))**2 > eps:
+        return R, None
+    R, piv, rank, info = dpstrf(G, tol=eps, lower=0)
+    return np.triu(R[:rank, :rank]), piv[:rank] - 1
+
+
+def block_ortho(X, Y=None, M=None, double eps=1e-15):
+    """Orthonormalize the columns of X against the columns of Y and
+    against each other, with respect to the inner product defined by M
+    (the identity if M is None). The columns of Y must already be
+    orthonormal. Columns of X that are linearly dependent on Y or on
+    the other columns are dropped.
+
+    Unlike ortho and simple_ortho, which work one column at a time,
+    this does block Gram-Schmidt against Y followed by Cholesky QR, and
+    repeats both once (CholQR2). All of the work is done with
+    matrix-matrix products, and M is applied to Y once and to X once
+    per pass. For X of full rank, the result is the Q factor of the QR
+    decomposition of X, as from modified_gram_schmidt."""
+    X_local = np.array(X, dtype=np.float64)
+    if X_local.ndim == 1:
+        X_local = X_local[:, np.newaxis]
+    n = X_local.shape[0]
+
+    if Y is None:
+        Y_local = np.empty((n, 0))
+    else:
+        Y_local = np.asarray(Y, dtype=np.float64).reshape((n, -1))
+    MY = Y_local if M is None else M @ Y_local
+
+    MX = X_local if M is None else M @ X_local
+    norms = np.sqrt(np.abs(np.einsum('ij,ij->j', X_local, MX)))
+    X_local = X_local[:, norms > 0]
+    norms = norms[norms > 0]
+
+    for k in range(2):
+        X_local -= Y_local @ (MY.T @ X_local)
+        MX = X_local if M is None else M @ X_local
+        G = X_local.T @ MX
+        scale = np.sqrt(np.abs(np.diag(G)))
+        if k == 0:
+            # Drop columns that lie in the span of Y
+            keep = scale > sqrt(eps) * norms
+            X_local = X_local[:, keep] / scale[keep]
+            G = G[np.ix_(keep, keep)] / np.outer(scale[keep], scale[keep])
+        else:
+            X_local /= scale
+            G /= np.outer(scale, scale)
+        if X_local.shape[1] == 0:
+            break
+        R, piv = _gram_cholesky(G, eps)
+        if piv is not None:
+            X_local = X_local[:, piv]
+        X_local = solve_triangular(R, X_local.T, trans='T').T
+
+    return np.ascontiguousarray(X_local)
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
@@ -242,6 +307,8 @@ def simple_ortho(X, Y=None, double eps=1e-15):
                 nxout -= 1
         # Ensure columns of X are orthogonal to the columns of Y.
         # This is a bit redundant with the first step of the next iteration.
+        # If X or Y has no columns left, there is nothing to check.
+        err = 0.
         for i in range(nxout):
             for j in range(nyout):
                 err = ddot(&n, &Y_mv[0, j], &ny, &X_mv[0, i], &nx)
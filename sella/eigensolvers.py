@@ -2,10 +2,12 @@
 
 import numpy as np
 
-from scipy.linalg import eigh, lstsq, solve
+from scipy.linalg import eigh, lstsq, solve, lu_factor, lu_solve
+from scipy.sparse import issparse, identity
+from scipy.sparse.linalg import eigsh, splu
 
-from .cython_routines import ortho
-from .hessian_update import symmetrize_Y
+from .cython_routines import block_ortho
+from .hessian_update import Symmetrizer
 
 
 def exact(A, maxres=None, P=None):
@@ -30,6 +32,34 @@ def exact(A, maxres=None, P=None):
     return lams, vecs, lams[np.newaxis, :] * vecs
 
 
+def _lowest_eigs(P):
+    """Eigenvalues and eigenvectors of the preconditioner P, in ascending
+    order. If P is a scipy.sparse matrix, only enough of the lowest
+    eigenpairs to include all negative eigenvalues and at least one
+    non-negative one are calculated."""
+    if not issparse(P):
+        lams, vecs, _ = exact(P, 0)
+        return lams, vecs
+    n, _ = P.shape
+    k = 4
+    while k < n - 1:
+        lams, vecs = eigsh(P, k=k, which='SA')
+        if np.max(lams) >= 0:
+            order = np.argsort(lams)
+            return lams[order], vecs[:, order]
+        k *= 2
+    return eigh(P.toarray())
+
+
+def _shifted_solver(P, theta):
+    """Returns a function that solves (P - theta * I) x = b"""
+    n, _ = P.shape
+    if issparse(P):
+        return splu((P - theta * identity(n)).tocsc()).solve
+    lu = lu_factor(P - theta * np.eye(n))
+    return lambda b: lu_solve(lu, b)
+
+
 def lobpcg(A, v0, maxres, P=None):
 
     if maxres <= 0:
@@ -55,7 +85,7 @@ def lobpcg(A, v0, maxres, P=None):
         maxres = np.sqrt(1e-15) * n
 
     # Orthogonalize initial guess vectors
-    X = ortho(X0, np.empty((n, 0)))
+    X = block_ortho(X0, np.empty((n, 0)))
     U = X.copy()
 
     # Initial Ritz pairs
@@ -81,7 +111,7 @@ def lobpcg(A, v0, maxres, P=None):
         # Find new search directions and orthogonalize
         Htilde, _, _, _ = lstsq(N - 1.15 * N_theta * I, RI)
 #        Htilde, _ = bicg(N - 1.15 * N_theta * I, RI)
-        H = ortho(Htilde, np.hstack((X, P)))
+        H = block_ortho(Htilde, np.hstack((X, P)))
         U = np.hstack((U, H))
 
         # New set of guess vectors
@@ -120,8 +150,8 @@ def lobpcg(A, v0, maxres, P=None):
         # Zero the components belonging to X
         Ytilde[:nev, :] = 0.
 
-        # Strict reorthogonalization with repeated MGS
-        YI = ortho(Ytilde, Y[:, :nev])
+        # Strict reorthogonalization with block Gram-Schmidt
+        YI = block_ortho(Ytilde, Y[:, :nev])
         P = S @ YI
         AP = AS @ YI
     print('Warning: LOBPCG may not have converged')
@@ -134,27 +164,26 @@ def davidson(A, maxres, P):
     if maxres <= 0:
         return exact(A, maxres, P)
 
-    I = np.eye(n)
-
-    P_lams, P_vecs, _ = exact(P, 0)
+    P_lams, P_vecs = _lowest_eigs(P)
     nneg = max(2, np.sum(P_lams < 0) + 1)
 
-    V = ortho(P_vecs[:, :nneg])
+    V = block_ortho(P_vecs[:, :nneg])
 
-    AV = A.dot(V)
+    # The subspace only grows, so the symmetrized projection of A is
+    # extended incrementally rather than recalculated every iteration
+    sym = Symmetrizer(n)
+    sym.add(V, A.dot(V))
 
-    method = 2
     seeking = 0
     while True:
-        Atilde = V.T @ (symmetrize_Y(V, AV, symm=method))
-        lams, vecs = eigh(Atilde)
+        lams, vecs = eigh(sym.Atilde)
         nneg = max(2, np.sum(lams < 0) + 1)
         # Rotate our subspace V to be diagonal in A.
         # This is not strictly necessary but it makes our lives easier later
-        AV = AV @ vecs
-        V = V @ vecs
+        AV = sym.Y @ vecs
+        V = sym.S @ vecs
 
-        Ytilde = symmetrize_Y(V, AV, symm=method)
+        Ytilde = sym.Ytilde @ vecs
         R = Ytilde[:, :nneg] - V[:, :nneg] * lams[np.newaxis, :nneg]
         Rnorm = np.linalg.norm(R, axis=0)
         print(Rnorm, lams[:nneg], Rnorm / lams[:nneg], seeking)
@@ -171,25 +200,24 @@ def davidson(A, maxres, P):
         else:
             return lams, V, AV
 
-        Pproj = P - thetai * I
-        Pprojr = solve(Pproj, ri)
-        PprojV = solve(Pproj, V)
+        Pproj_solve = _shifted_solver(P, thetai)
+        Pprojr = Pproj_solve(ri)
+        PprojV = Pproj_solve(V)
         alpha = solve(V.T @ PprojV, V.T @ Pprojr)
-        ti = solve(Pproj, (V @ alpha - ri))
+        ti = Pproj_solve(V @ alpha - ri)
 
-        t = ortho(ti, V)
+        t = block_ortho(ti, V)
 
         # Davidson failed to find a new search direction
         if t.shape[1] == 0:
             # Do Lanczos instead
-            t = ortho(AV[:, -1], V)
+            t = block_ortho(AV[:, -1], V)
             # If Lanczos also fails to find a new search direction,
             # just give up and return the current Ritz pairs
             if t.shape[1] == 0:
                 return lams, V, AV
 
-        V = np.hstack([V, t])
-        AV = np.hstack([AV, A.dot(t)])
+        sym.add(t, A.dot(t))
     else:
         return lams, V, AV
 
@@ -200,27 +228,26 @@ def lanczos(A, maxres, P):
     if maxres <= 0:
         return exact(A, maxres, P)
 
-    I = np.eye(n)
-
-    P_lams, P_vecs, _ = exact(P, 0)
+    P_lams, P_vecs = _lowest_eigs(P)
     nneg = max(2, np.sum(P_lams < 0) + 1)
 
-    V = ortho(P_vecs[:, :nneg])
+    V = block_ortho(P_vecs[:, :nneg])
 
-    AV = A.dot(V)
+    # The subspace only grows, so the symmetrized projection of A is
+    # extended incrementally rather than recalculated every iteration
+    sym = Symmetrizer(n)
+    sym.add(V, A.dot(V))
 
-    method = 2
     seeking = 0
     while True:
-        Atilde = V.T @ (symmetrize_Y(V, AV, symm=method))
-        lams, vecs = eigh(Atilde)
+        lams, vecs = eigh(sym.Atilde)
         nneg = max(2, np.sum(lams < 0) + 1)
         # Rotate our subspace V to be diagonal in A.
         # This is not strictly necessary but it makes our lives easier later
-        AV = AV @ vecs
-        V = V @ vecs
+        AV = sym.Y @ vecs
+        V = sym.S @ vecs
 
-        Ytilde = symmetrize_Y(V, AV, symm=method)
+        Ytilde = sym.Ytilde @ vecs
         R = Ytilde[:, :nneg] - V[:, :nneg] * lams[np.newaxis, :nneg]
         Rnorm = np.linalg.norm(R, axis=0)
         print(Rnorm, lams[:nneg], Rnorm / lams[:nneg], seeking)
@@ -235,14 +262,13 @@ def lanczos(A, maxres, P):
         else:
             return lams, V, AV
 
-        t = ortho(AV[:, seeking], V)
+        t = block_ortho(AV[:, seeking], V)
 
         # If Lanczos also fails to find a new search direction,
         # just give up and return the current Ritz pairs
         if t.shape[1] == 0:
             return lams, V, AV
 
-        V = np.hstack([V, t])
-        AV = np.hstack([AV, A.dot(t)])
+        sym.add(t, A.dot(t))
     else:
         return lams, V, AV
@@ -1,19 +1,21 @@
 # cython: language_level=3
 
 cimport cython
-from cython.view cimport array as cvarray
 
 cimport numpy as np
-from scipy.linalg.cython_blas cimport dcopy, dgemv
-from scipy.linalg.cython_lapack cimport dgels
+from scipy.linalg.cython_lapack cimport dgelsd
 
 from libc.stdlib cimport malloc, free
 from libc.math cimport sqrt, exp
-from libc.string cimport memset
+from libc.string cimport memset, memcpy
+
+import os
+import multiprocessing
 
 import numpy as np
 from ase.data import covalent_radii
-from scipy.optimize import minimize, brute
+from scipy.optimize import minimize
+from scipy.sparse import bsr_matrix
 
 # We are fitting an approximate force field to a given gradient in order to predict
 # the initial Hessian matrix for saddle point optimization. The fitted parameters of
@@ -32,6 +34,10 @@ from scipy.optimize import minimize, brute
 # to the NONLINEAR parameters only. This is what goes into the gradient of our cost function.
 #
 # dFnonlin[NDOF x NNONLINEAR x NLINEAR]
+#
+# Both are work arrays that are allocated by each call of FitContext.objective. The
+# only persistent state of a fit, the pair interactions and the reference forces, is
+# owned by its FitContext.
 
 cdef int ONE = 1
 cdef int THREE = 3
@@ -39,9 +45,6 @@ cdef double D_ZERO = 0.
 cdef double D_ONE = 1.
 cdef double D_TWO = 2.
 
-cdef double[:, :, :] dFlin
-cdef double[:, :, :, :] dFnonlin
-
 cdef struct s_pair_interactions:
     int nint
     int* npairs
@@ -50,36 +53,45 @@ cdef struct s_pair_interactions:
 
 ctypedef s_pair_interactions pair_interactions
 
-cdef pair_interactions lj_interactions
-cdef pair_interactions buck_interactions
-cdef pair_interactions morse_interactions
-cdef pair_interactions bond_interactions
+# Where the pair Hessian kernels accumulate their 3x3 blocks: either a dense
+# (3 * natoms, 3 * natoms) array, or the data array of a BSR matrix with 3x3
+# blocks. In the latter case, pair_blocks holds the (i, j) and (j, i) block
+# indices of each pair, in the order in which the pairs are visited, and
+# diag_blocks the (i, i) block index of each atom.
+cdef struct s_hess_target:
+    bint sparse
+    int ndof
+    double* dense
+    double* blocks
+    int* pair_blocks
+    int* diag_blocks
+    int npair
+
+ctypedef s_hess_target hess_target
 
 cdef void init_pair_interactions(pair_interactions* pi, dict data):
     cdef int i
-    cdef int j
-    cdef int k
     cdef int npairs
+    cdef int[:, :] indices
+    cdef double[:, :] coords
 
     cdef int nint = len(data)
-    
+
     pi[0].nint = nint
-    pi[0].npairs = <int*> malloc(sizeof(int*) * nint)
+    pi[0].npairs = <int*> malloc(sizeof(int) * nint)
     pi[0].indices = <int**> malloc(sizeof(int*) * nint)
     pi[0].coords = <double**> malloc(sizeof(double*) * nint)
 
-    for i, (atom_types, pair_data) in enumerate(data.items()):
-        npairs = len(pair_data)
+    for i, (indices, coords) in enumerate(data.values()):
+        npairs = indices.shape[0]
         pi[0].npairs[i] = npairs
 
         pi[0].indices[i] = <int*> malloc(sizeof(int) * npairs * 2)
-        pi[0].coords[i] = <double*>  malloc(sizeof(double) * npairs * 3)
+        pi[0].coords[i] = <double*> malloc(sizeof(double) * npairs * 3)
 
-        for j, (indices, coords) in enumerate(pair_data):
-            for k in range(3):
-                pi[0].coords[i][3 * j + k] = coords[k]
-                if k < 2:
-                    pi[0].indices[i][2 * j + k] = indices[k]
+        if npairs > 0:
+            memcpy(pi[0].indices[i], &indices[0, 0], sizeof(int) * npairs * 2)
+            memcpy(pi[0].coords[i], &coords[0, 0], sizeof(double) * npairs * 3)
 
 cdef void free_pair_interactions(pair_interactions* pi):
     cdef int i
@@ -92,6 +104,161 @@ cdef void free_pair_interactions(pair_interactions* pi):
     free(pi[0].indices)
     free(pi[0].coords)
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _neighbor_pairs(atoms, double cutoff):
+    """Find all pairs of atoms (i, j) closer than cutoff, including
+    pairs across periodic boundaries, using a cell list. Returns the
+    pairs sorted by (i, j), the displacement vectors from i to the
+    periodic image of j, and the distances. Each pair is returned
+    only once, so periodic self-interactions (i, i, S) appear for
+    only one of S and -S."""
+    cdef int natoms = len(atoms)
+    cdef double rcut2 = cutoff * cutoff
+    cdef double dij2
+    cdef double dx
+    cdef int i, j, g, m, k, b, bx, by, bz
+    cdef int nghosts
+    cdef int ipass
+    cdef Py_ssize_t n, npairs
+
+    pbc = np.asarray(atoms.pbc, dtype=bool)
+    pos = np.array(atoms.positions, dtype=np.float64)
+
+    # Every periodic image of every atom that lies within cutoff of
+    # the bounding box of the (wrapped) atoms. Atoms are only ever
+    # paired with these "ghosts", so the work is linear in the number
+    # of atoms for a fixed cutoff.
+    if np.any(pbc):
+        cell = np.array(atoms.cell, dtype=np.float64)
+        scaled = np.linalg.solve(cell.T, pos.T).T
+        scaled[:, pbc] %= 1.
+        pos = scaled @ cell
+        # Distance between opposite faces of the unit cell
+        heights = abs(np.linalg.det(cell)) / np.linalg.norm(
+            np.cross(cell[[1, 2, 0]], cell[[2, 0, 1]]), axis=1)
+        nrep = np.where(pbc, np.ceil(cutoff / heights), 0).astype(int)
+        shifts = np.stack(np.meshgrid(*[np.arange(-n, n + 1) for n in nrep],
+                                      indexing='ij'), axis=-1).reshape((-1, 3))
+    else:
+        cell = np.zeros((3, 3))
+        shifts = np.zeros((1, 3), dtype=int)
+
+    lo = pos.min(0) - cutoff
+    hi = pos.max(0) + cutoff
+    images = pos[np.newaxis, :, :] + (shifts @ cell)[:, np.newaxis, :]
+    inside = np.all((images >= lo) & (images <= hi), axis=2)
+    ishift, gidx_np = np.nonzero(inside)
+    gpos_np = np.ascontiguousarray(images[ishift, gidx_np])
+    gidx_np = gidx_np.astype(np.int32)
+    # Sign of the first nonzero component of the image shift, used to
+    # keep only one of each (i, i, S) and (i, i, -S) pair
+    gsign_np = np.zeros(len(ishift), dtype=np.int32)
+    for k in range(2, -1, -1):
+        gsign_np = np.where(shifts[ishift, k] != 0,
+                            np.sign(shifts[ishift, k]), gsign_np).astype(np.int32)
+    nghosts = len(gidx_np)
+
+    # Bin the ghosts with a counting sort. Bins are at least cutoff wide,
+    # and the number of bins is capped so that sparse systems do not
+    # allocate huge, mostly empty grids.
+    nbins_np = np.minimum(np.maximum(np.floor((hi - lo) / cutoff), 1),
+                          max(1, int(np.ceil(nghosts**(1. / 3.))))).astype(np.int32)
+    width_np = (hi - lo) / nbins_np
+    gbin3 = np.minimum(((gpos_np - lo) / width_np).astype(np.int32), nbins_np - 1)
+    gbin = (gbin3[:, 0] * nbins_np[1] + gbin3[:, 1]) * nbins_np[2] + gbin3[:, 2]
+    gorder = np.argsort(gbin, kind='stable').astype(np.int32)
+    bin_start_np = np.zeros(np.prod(nbins_np) + 1, dtype=np.int32)
+    np.cumsum(np.bincount(gbin, minlength=np.prod(nbins_np)), out=bin_start_np[1:])
+
+    cdef double[:, :] pos_mv = pos
+    cdef double[:, :] gpos = gpos_np
+    cdef int[:] gidx = gidx_np
+    cdef int[:] gsign = gsign_np
+    cdef int[:] order = gorder
+    cdef int[:] bin_start = bin_start_np
+    cdef int[:] nbins = nbins_np
+    cdef int[:, :] abin = np.minimum(((pos - lo) / width_np).astype(np.int32),
+                                     nbins_np - 1)
+
+    counts_np = np.zeros(natoms + 1, dtype=np.intp)
+    cdef Py_ssize_t[:] counts = counts_np
+    pairs_np = np.zeros((0, 2), dtype=np.int32)
+    coords_np = np.zeros((0, 3), dtype=np.float64)
+    cdef int[:, :] pairs_mv
+    cdef double[:, :] coords_mv
+
+    # The first pass counts the pairs of each atom, the second fills them in
+    for ipass in range(2):
+        with nogil:
+            for i in range(natoms):
+                n = counts[i]
+                for bx in range(max(abin[i, 0] - 1, 0), min(abin[i, 0] + 2, nbins[0])):
+                    for by in range(max(abin[i, 1] - 1, 0), min(abin[i, 1] + 2, nbins[1])):
+                        for bz in range(max(abin[i, 2] - 1, 0), min(abin[i, 2] + 2, nbins[2])):
+                            b = (bx * nbins[1] + by) * nbins[2] + bz
+                            for m in range(bin_start[b], bin_start[b + 1]):
+                                g = order[m]
+                                j = gidx[g]
+                                if j < i or (j == i and gsign[g] <= 0):
+                                    continue
+                                dij2 = 0.
+                                for k in range(3):
+                                    dx = gpos[g, k] - pos_mv[i, k]
+                                    dij2 += dx * dx
+                                if dij2 > rcut2:
+                                    continue
+                                if ipass == 1:
+                                    pairs_mv[n, 0] = i
+                                    pairs_mv[n, 1] = j
+                                    for k in range(3):
+                                        coords_mv[n, k] = gpos[g, k] - pos_mv[i, k]
+                                    n += 1
+                                else:
+                                    counts[i + 1] += 1
+        if ipass == 0:
+            np.cumsum(counts_np, out=counts_np)
+            npairs = counts_np[natoms]
+            pairs_np = np.empty((npairs, 2), dtype=np.int32)
+            coords_np = np.empty((npairs, 3), dtype=np.float64)
+            pairs_mv = pairs_np
+            coords_mv = coords_np
+
+    # Within each atom i, the pairs come out in bin order; sort by (i, j)
+    order_np = np.lexsort((pairs_np[:, 1], pairs_np[:, 0]))
+    pairs_np = pairs_np[order_np]
+    coords_np = coords_np[order_np]
+    return pairs_np, coords_np, np.linalg.norm(coords_np, axis=1)
+
+def _min_distance(atoms):
+    """Shortest distance between any two atoms (or periodic images)"""
+    if len(atoms) < 2 and not np.any(atoms.pbc):
+        raise ValueError("Need at least two atoms to find pair interactions")
+    cutoff = 2 * np.max(covalent_radii[atoms.numbers])
+    while True:
+        _, _, d = _neighbor_pairs(atoms, cutoff)
+        if len(d) > 0:
+            return d.min()
+        cutoff *= 2
+
+def _group_pairs(enumbers, pairs, coords):
+    """Split a pair list by the (sorted) atomic numbers of the two atoms.
+    Returns a dict mapping each element pair to contiguous arrays of
+    pair indices and displacement vectors. The dict is ordered by first
+    appearance of each element pair in the pair list."""
+    cdef int zmax = np.max(enumbers) + 1
+    zpairs = np.sort(enumbers[pairs], axis=1)
+    keys = zpairs[:, 0] * zmax + zpairs[:, 1]
+    ukeys, first, inverse = np.unique(keys, return_index=True,
+                                      return_inverse=True)
+    groups = {}
+    for n in np.argsort(first):
+        mask = inverse == n
+        eij = tuple(int(z) for z in zpairs[first[n]])
+        groups[eij] = (np.ascontiguousarray(pairs[mask], dtype=np.int32),
+                       np.ascontiguousarray(coords[mask], dtype=np.float64))
+    return groups
+
 #cdef struct s_pair_interaction:
 #    int i
 #    int j
@@ -99,153 +266,57 @@ cdef void free_pair_interactions(pair_interactions* pi):
 #
 #ctypedef s_pair_interaction pair_interaction
 
-def force_match(atoms, types=['buck', 'bond']):
-    cdef int i
-    cdef int j
-    cdef int k
-    cdef int a
+def force_match(atoms, types=['buck', 'bond'], sparse=False, nproc=1):
     cdef int natoms = len(atoms)
-    cdef int ndof = 3 * natoms
-    cdef int nlin = 0
-    cdef int nnonlin = 0
     cdef int nbuck = 0
     cdef int nbond = 0
-    cdef int nlj = 0
     cdef int nmorse = 0
-    cdef int info
     cdef bint do_lj
     cdef bint do_buck
     cdef bint do_morse
     cdef bint do_bond
 
-    global dFlin
-    global dFnonlin
-    global lj_interactions
-    global buck_interactions
-    global bond_interactions
-
     enumbers = atoms.get_atomic_numbers()
-    rmax = np.max(atoms.get_all_distances())
-    rmin = np.min(atoms.get_all_distances() + rmax * np.eye(natoms))
-    rcut = 3 * rmin
+    rcut = 3 * _min_distance(atoms)
     #rcut = 9.5
-    pos = atoms.get_positions()
-
-
-    if np.any(atoms.pbc):
-        cell = atoms.get_cell()
-        latt_len = np.sqrt((cell**2).sum(1))
-        V = abs(np.linalg.det(cell))
-        n = atoms.pbc * np.array(np.ceil(rcut * np.prod(latt_len) /
-                                         (V * latt_len)), dtype=int)
-        tvecs = []
-        for i in range(-n[0], n[0] + 1):
-            latt_a = i * cell[0]
-            for j in range(-n[1], n[1] + 1):
-                latt_ab = latt_a + j * cell[1]
-                for k in range(-n[2], n[2] + 1):
-                    tvecs.append(latt_ab + k * cell[2])
-        tvecs = np.array(tvecs)
-    else:
-        tvecs = np.array([[0., 0., 0.]])
-
-    cdef double[:] rij = cvarray(shape=(3,), itemsize=sizeof(double), format='d')
-    cdef double[:, :] pos_mv = memoryview(pos)
-    cdef double[:, :] tvecs_mv = memoryview(tvecs)
-    cdef int nt = len(tvecs)
-    cdef int ti
-    cdef double dij2
-    cdef double dij
-    cdef double rcut2 = rcut * rcut
-    
-    rij_t = np.zeros(3, dtype=np.float64)
-    cdef double[:] rij_t_mv = memoryview(rij_t)
 
     do_lj = 'lj' in types
     do_buck = 'buck' in types
     do_morse = 'morse' in types
     do_bond = 'bond' in types
 
-    vdw_data = {}
-    cov_data = {}
+    pairs, coords, dists = _neighbor_pairs(atoms, rcut)
+    vdw_data = _group_pairs(enumbers, pairs, coords)
+
     ff_data = {'lj': {},
                'buck': {},
                'morse': {},
                'bond': {},
                }
-    x0 = []
-    brute_range = []
-    for i in range(natoms):
-        for j in range(i, natoms):
-            for k in range(3):
-                rij[k] = pos_mv[j, k] - pos_mv[i, k]
-            for ti in range(nt):
-                if (i == j) and tvecs_mv[ti, 0] == 0. and tvecs_mv[ti, 1] == 0. and tvecs_mv[ti, 2] == 0.:
-                    continue
-                dij2 = 0.
-                for k in range(3):
-                    rij_t_mv[k] = rij[k] + tvecs_mv[ti, k]
-                    dij2 += rij_t_mv[k] * rij_t_mv[k]
-                if dij2 > rcut2:
-                    continue
-                dij = sqrt(dij2)
-                eij = tuple(sorted(enumbers[[i, j]]))
-
-                if do_lj:
-                    vdw_x = ff_data['lj'].get(eij)
-                    if vdw_x is None:
-                        vdw_x = []
-                        ff_data['lj'][eij] = vdw_x
-                        nlj += 1
-                    vdw_x.append(((i, j), rij_t.copy()))
-
-                if do_buck:
-                    vdw_x = ff_data['buck'].get(eij)
-                    if vdw_x is None:
-                        vdw_x = []
-                        ff_data['buck'][eij] = vdw_x
-                        nbuck += 1
-                        x0.append(2.5)
-                        brute_range.append((0.1, 10.0))
-                    vdw_x.append(((i, j), rij_t.copy()))
-                
-                if do_morse:
-                    vdw_x = ff_data['morse'].get(eij)
-                    if vdw_x is None:
-                        vdw_x = []
-                        ff_data['morse'][eij] = vdw_x
-                        nmorse += 1
-                        x0.append(2.5)
-                        brute_range.append((0.1, 10.0))
-                    vdw_x.append(((i, j), rij_t.copy()))
-
-                if do_bond:
-                    rcov = np.sum(covalent_radii[list(eij)])
-                    if dij > 1.5 * rcov:
-                        continue
-                    cov_x = ff_data['bond'].get(eij)
-                    if cov_x is None:
-                        cov_x = []
-                        ff_data['bond'][eij] = cov_x
-                        nbond += 1
-                        x0.append(rcov)
-                        brute_range.append((0.5 * rcov, 2 * rcov))
-                    cov_x.append(((i, j), rij_t.copy()))
-
-    nlin = 2 * nlj + 2 * nbuck + 2 * nmorse + nbond
-    nnonlin = nbuck + nmorse + nbond
-
-    init_pair_interactions(&lj_interactions, ff_data['lj'])
-    init_pair_interactions(&buck_interactions, ff_data['buck'])
-    init_pair_interactions(&morse_interactions, ff_data['morse'])
-    init_pair_interactions(&bond_interactions, ff_data['bond'])
-    
-    dFlin = cvarray(shape=(natoms, 3, nlin), itemsize=sizeof(double), format='d')
-    dFnonlin = cvarray(shape=(natoms, 3, nnonlin, nlin), itemsize=sizeof(double), format='d')
+    if do_lj:
+        ff_data['lj'] = vdw_data
+    if do_buck:
+        ff_data['buck'] = vdw_data
+    if do_morse:
+        ff_data['morse'] = vdw_data
+    if do_bond:
+        rcov = covalent_radii[enumbers[pairs]].sum(1)
+        bonded = dists <= 1.5 * rcov
+        ff_data['bond'] = _group_pairs(enumbers, pairs[bonded], coords[bonded])
+
+    nbuck = len(ff_data['buck'])
+    nmorse = len(ff_data['morse'])
+    nbond = len(ff_data['bond'])
+
+    # Initial guesses and brute force search ranges for the nonlinear
+    # parameters, in the same order that objective reads them
+    x0 = [2.5] * (nbuck + nmorse)
+    brute_range = [(0.1, 10.0)] * (nbuck + nmorse)
+    for eij in ff_data['bond']:
+        rcov_ij = np.sum(covalent_radii[list(eij)])
+        x0.append(rcov_ij)
+        brute_range.append((0.5 * rcov_ij, 2 * rcov_ij))
 
-    memset(&dFlin[0, 0, 0], 0, sizeof(double) * ndof * nlin)
-    memset(&dFnonlin[0, 0, 0, 0], 0, sizeof(double) * ndof * nnonlin * nlin)
-    
     constraints = []
     if atoms.constraints:
         constraints = atoms.constraints
@@ -253,236 +324,558 @@ def force_match(atoms, types=['buck', 'bond']):
     ftrue = atoms.get_forces()
     atoms.constraints = constraints
 
+    ctx = FitContext(ff_data, natoms, ftrue)
+
     bounds = []
     bounds += [(0., None)] * nbuck
     bounds += [(1., None)] * nmorse
     bounds += [(0., None)] * nbond
 
-    if nnonlin < 5:
-        x0 = brute(objective, brute_range, args=(ndof, nlin, natoms, ftrue), Ns=10, disp=True)
-    else:
-        x0 = np.array(x0, dtype=np.float64)
+    x0 = global_search(ctx, brute_range, bounds, x0, nproc=nproc)
 
-    print(objective(x0, ndof, nlin, natoms, ftrue))
+    print(ctx.objective(x0))
 
-    res = minimize(objective, x0, method='L-BFGS-B', jac=True, options={'gtol': 1e-10, 'ftol': 1e-8},
-                   args=(ndof, nlin, natoms, ftrue, True), bounds=bounds)
+    res = minimize(ctx.objective, x0, method='L-BFGS-B', jac=True, options={'gtol': 1e-10, 'ftol': 1e-8},
+                   args=(True,), bounds=bounds)
     print(res)
     nonlinpars = res['x']
 
-    linpars = objective(nonlinpars, ndof, nlin, natoms, ftrue, False, True)
+    linpars = ctx.objective(nonlinpars, False, True)
     print(linpars, nonlinpars)
 
-    hess = calc_hess(linpars, nonlinpars, natoms)
-
-    free_pair_interactions(&lj_interactions)
-    free_pair_interactions(&buck_interactions)
-    free_pair_interactions(&morse_interactions)
-    free_pair_interactions(&bond_interactions)
-
-    return hess
-    
-def objective(pars, int ndof, int nlin, int natoms, np.ndarray[np.float_t, ndim=2] ftrue, bint grad=False, bint ret_linpars=False):
-    global dFlin
-    global dFnonlin
-    global lj_interactions
-    global buck_interactions
-    global morse_interactions
-    global bond_interactions
-
+    return ctx.calc_hess(linpars, nonlinpars, sparse)
+
+# The FitContext of a global_search worker process, set by _init_worker.
+# Serial searches pass their FitContext to the workers explicitly instead.
+_worker_ctx = None
+
+def _init_worker(ctx):
+    global _worker_ctx
+    _worker_ctx = ctx
+
+def _objective_chunk(args):
+    ctx, X = args
+    if ctx is None:
+        ctx = _worker_ctx
+    return [ctx.objective(x) for x in X]
+
+def _refine(args):
+    ctx, x0, bounds, maxiter = args
+    if ctx is None:
+        ctx = _worker_ctx
+    res = minimize(ctx.objective, x0, method='L-BFGS-B', jac=True,
+                   args=(True,), bounds=bounds,
+                   options={'gtol': 1e-10, 'ftol': 1e-8, 'maxiter': maxiter})
+    return res['x'], res['fun']
+
+def global_search(ctx, search_range, bounds, x0=None, int ns=10,
+                  int nsamples=0, int nstart=8, int maxiter=10, nproc=1,
+                  seed=0):
+    """Find a good starting point for the local optimization of the
+    nonlinear parameters of a force field fit.
+
+    The objective is first evaluated on a set of trial points inside
+    search_range. With fewer than 5 nonlinear parameters, this is the
+    same grid of ns points per parameter that scipy.optimize.brute
+    would search. With more, the grid becomes too large, and a Latin
+    hypercube sample of nsamples points (32 per parameter by default)
+    is used instead. x0 is added to the trial points in both cases.
+    The nstart best points are then refined
+    with L-BFGS-B by successive halving: every refinement runs for
+    maxiter iterations, after which the worse half of the points is
+    discarded and the iteration limit doubled, until one point is left.
+
+    Arguments:
+    ctx -- FitContext of the fit
+    search_range -- (lower, upper) bounds of the trial points for each
+                    nonlinear parameter
+    bounds -- L-BFGS-B bounds of each nonlinear parameter
+    x0 -- Initial guess
+    nproc -- Number of worker processes. If nproc > 1, trial points and
+             refinements are evaluated by a pool of forked processes,
+             which are only available on platforms that support fork.
+             The result does not depend on nproc.
+    seed -- Seed of the Latin hypercube sample
+
+    Returns the best point found."""
+    cdef int nnonlin = len(search_range)
     cdef int i
-    cdef int j
-    cdef int k
-    cdef int l
-    cdef int a
-    cdef int b
-    cdef int linstart = 0
-    cdef int nonlinstart = 0
-    cdef int nnonlin = len(pars)
-    cdef int info
-    cdef int Asize
-    cdef int nonlin_size
-
-    cdef double chisq
-
-    cdef double[:] pars_c = memoryview(pars)
-
-    cdef double rho
-    cdef double r0
-
-    xij_np = np.zeros(3, dtype=np.float64)
-    cdef double* xij = <double*> np.PyArray_DATA(xij_np)
+    if nnonlin == 0:
+        return np.zeros(0)
 
-    memset(&dFlin[0, 0, 0], 0, sizeof(double) * ndof * nlin)
-    memset(&dFnonlin[0, 0, 0, 0], 0, sizeof(double) * ndof * nnonlin * nlin)
-
-    for j in range(lj_interactions.nint):
-        for k in range(lj_interactions.npairs[j]):
-            a = lj_interactions.indices[j][2 * k]
-            b = lj_interactions.indices[j][2 * k + 1]
-            dcopy(&THREE, &lj_interactions.coords[j][3 * k], &ONE, xij, &ONE)
-            lj(a, b, linstart, xij)
-        linstart += 2
-
-    for j in range(buck_interactions.nint):
-        for k in range(buck_interactions.npairs[j]):
+    lower, upper = np.array(search_range, dtype=np.float64).T
+    if nnonlin < 5:
+        axes = [np.linspace(lo, hi, ns) for lo, hi in zip(lower, upper)]
+        X = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1)
+        X = X.reshape((-1, nnonlin))
+    else:
+        if nsamples <= 0:
+            nsamples = 32 * nnonlin
+        rng = np.random.RandomState(seed)
+        X = np.empty((nsamples, nnonlin))
+        for i in range(nnonlin):
+            X[:, i] = (rng.permutation(nsamples) + rng.rand(nsamples)) / nsamples
+        X = lower + X * (upper - lower)
+    if x0 is not None:
+        X = np.vstack((X, np.asarray(x0, dtype=np.float64).reshape((1, -1))))
+
+    if nproc is None:
+        nproc = os.cpu_count()
+    if nproc <= 1:
+        return _global_search(ctx, X, bounds, nstart, maxiter, map, 1)
+
+    mp_ctx = multiprocessing.get_context('fork')
+    with mp_ctx.Pool(nproc, initializer=_init_worker, initargs=(ctx,)) as pool:
+        return _global_search(None, X, bounds, nstart, maxiter, pool.map,
+                              4 * nproc)
+
+def _global_search(ctx, X, bounds, int nstart, int maxiter, pmap, int nchunks):
+    # ctx is None when pmap runs in pool workers that already have it
+    chunks = np.array_split(X, min(len(X), nchunks))
+    f = np.concatenate([np.array(fs, dtype=np.float64)
+                        for fs in pmap(_objective_chunk, [(ctx, c) for c in chunks])])
+
+    order = np.argsort(f, kind='stable')[:nstart]
+    X = X[order]
+    while len(X) > 1:
+        results = list(pmap(_refine, [(ctx, x, bounds, maxiter) for x in X]))
+        X = np.array([x for x, _ in results])
+        f = np.array([fx for _, fx in results])
+        X = X[np.argsort(f, kind='stable')[:len(X) // 2]]
+        maxiter *= 2
+    return X[0]
+
+cdef class FitContext:
+    """Pair interactions and reference forces of a single force field fit.
+
+    The pair lists in ff_data are copied into C arrays when the context
+    is created, and freed when it is garbage collected. objective and
+    calc_hess never modify the context and keep their work arrays local
+    to each call, so one context may be evaluated from several threads
+    at once, and independent fits do not interfere with each other.
+    Both release the GIL while evaluating the force field.
+
+    Arguments:
+    ff_data -- Dict mapping each interaction type ('lj', 'buck', 'morse'
+               and 'bond') to a dict of (indices, coords) pair arrays, one
+               per element pair
+    natoms -- Number of atoms
+    ftrue -- Reference forces, shape (natoms, 3)
+    """
+    cdef readonly int natoms
+    cdef readonly int ndof
+    cdef readonly int nlin
+    cdef readonly int nnonlin
+    cdef readonly dict ff_data
+    cdef readonly object ftrue
+    cdef double[:, :] _ftrue
+
+    cdef pair_interactions lj_interactions
+    cdef pair_interactions buck_interactions
+    cdef pair_interactions morse_interactions
+    cdef pair_interactions bond_interactions
+
+    # dgelsd parameters, which only depend on the problem size
+    cdef double rcond
+    cdef int lwork
+    cdef int liwork
+
+    def __cinit__(self, dict ff_data, int natoms, ftrue):
+        cdef int m
+        cdef int n
+        cdef int ldb
+        cdef int rank
+        cdef int info
+        cdef double work_query
+        cdef int iwork_query
+        cdef double dummy = 0.
+
+        self.natoms = natoms
+        self.ndof = 3 * natoms
+        self.nlin = (2 * len(ff_data['lj']) + 2 * len(ff_data['buck'])
+                     + 2 * len(ff_data['morse']) + len(ff_data['bond']))
+        self.nnonlin = (len(ff_data['buck']) + len(ff_data['morse'])
+                        + len(ff_data['bond']))
+        if self.nlin == 0:
+            raise ValueError("No pair interactions to fit")
+        self.ff_data = ff_data
+        self.ftrue = np.array(ftrue, dtype=np.float64).reshape((natoms, 3))
+        self._ftrue = self.ftrue
+
+        init_pair_interactions(&self.lj_interactions, ff_data['lj'])
+        init_pair_interactions(&self.buck_interactions, ff_data['buck'])
+        init_pair_interactions(&self.morse_interactions, ff_data['morse'])
+        init_pair_interactions(&self.bond_interactions, ff_data['bond'])
+
+        # Same cutoff for small singular values as np.linalg.lstsq
+        m = self.ndof
+        n = self.nlin
+        ldb = max(m, n)
+        self.rcond = np.finfo(np.float64).eps * ldb
+        self.lwork = -1
+        dgelsd(&m, &n, &ONE, &dummy, &m, &dummy, &ldb, &dummy, &self.rcond,
+               &rank, &work_query, &self.lwork, &iwork_query, &info)
+        self.lwork = <int> work_query
+        self.liwork = max(iwork_query, 1)
+
+    def __reduce__(self):
+        return (FitContext, (self.ff_data, self.natoms, self.ftrue))
+
+    def __dealloc__(self):
+        free_pair_interactions(&self.lj_interactions)
+        free_pair_interactions(&self.buck_interactions)
+        free_pair_interactions(&self.morse_interactions)
+        free_pair_interactions(&self.bond_interactions)
+
+    def objective(self, pars, bint grad=False, bint ret_linpars=False):
+        """Sum of squared force errors for the nonlinear parameters pars,
+        with the linear parameters fitted by least squares. Returns the
+        error, the error and its gradient if grad is True, or the linear
+        parameters if ret_linpars is True."""
+        cdef double[:] pars_c = np.array(pars, dtype=np.float64).ravel()
+        if pars_c.shape[0] != self.nnonlin:
+            raise ValueError("Expected {} nonlinear parameters, got {}"
+                             "".format(self.nnonlin, pars_c.shape[0]))
+
+        dFlin_np = np.zeros((self.natoms, 3, self.nlin))
+        dFnonlin_np = np.zeros((self.natoms, 3, self.nnonlin, self.nlin))
+        linpars_np = np.zeros(self.nlin)
+        dchisq_np = np.zeros(self.nnonlin)
+
+        cdef double[:, :, :] dFlin = dFlin_np
+        cdef double[:, :, :, :] dFnonlin = dFnonlin_np
+        cdef double[:] linpars = linpars_np
+        cdef double[:] dchisq = dchisq_np
+        cdef double chisq
+        cdef int info
+
+        with nogil:
+            self._derivatives(pars_c, dFlin, dFnonlin)
+            info = self._lstsq(dFlin, linpars)
+            if info == 0:
+                chisq = self._chisq(dFlin, dFnonlin, linpars, dchisq, grad)
+
+        if info != 0:
+            raise RuntimeError("Least squares fit of linear parameters failed "
+                               "(dgelsd info = {})".format(info))
+
+        if ret_linpars:
+            return linpars_np
+
+        if not grad:
+            return chisq
+
+        return chisq, dchisq_np
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void _derivatives(self, double[:] pars, double[:, :, :] dFlin,
+                           double[:, :, :, :] dFnonlin) noexcept nogil:
+        cdef int j
+        cdef int k
+        cdef int a
+        cdef int b
+        cdef int linstart = 0
+        cdef int nonlinstart = 0
+        cdef double rho
+        cdef double r0
+
+        for j in range(self.lj_interactions.nint):
+            for k in range(self.lj_interactions.npairs[j]):
+                a = self.lj_interactions.indices[j][2 * k]
+                b = self.lj_interactions.indices[j][2 * k + 1]
+                lj(dFlin, a, b, linstart, &self.lj_interactions.coords[j][3 * k])
+            linstart += 2
+
+        for j in range(self.buck_interactions.nint):
             rho = pars[nonlinstart]
-            a = buck_interactions.indices[j][2 * k]
-            b = buck_interactions.indices[j][2 * k + 1]
-            dcopy(&THREE, &buck_interactions.coords[j][3 * k], &ONE, xij, &ONE)
-            buck(a, b, linstart, nonlinstart, xij, rho)
-        linstart += 2
-        nonlinstart += 1
-
-    for j in range(morse_interactions.nint):
-        for k in range(morse_interactions.npairs[j]):
+            for k in range(self.buck_interactions.npairs[j]):
+                a = self.buck_interactions.indices[j][2 * k]
+                b = self.buck_interactions.indices[j][2 * k + 1]
+                buck(dFlin, dFnonlin, a, b, linstart, nonlinstart,
+                     &self.buck_interactions.coords[j][3 * k], rho)
+            linstart += 2
+            nonlinstart += 1
+
+        for j in range(self.morse_interactions.nint):
             rho = pars[nonlinstart]
-            a = morse_interactions.indices[j][2 * k]
-            b = morse_interactions.indices[j][2 * k + 1]
-            dcopy(&THREE, &morse_interactions.coords[j][3 * k], &ONE, xij, &ONE)
-            morse(a, b, linstart, nonlinstart, xij, rho)
-        linstart += 2
-        nonlinstart += 1
-
-    for j in range(bond_interactions.nint):
-        for k in range(bond_interactions.npairs[j]):
+            for k in range(self.morse_interactions.npairs[j]):
+                a = self.morse_interactions.indices[j][2 * k]
+                b = self.morse_interactions.indices[j][2 * k + 1]
+                morse(dFlin, dFnonlin, a, b, linstart, nonlinstart,
+                      &self.morse_interactions.coords[j][3 * k], rho)
+            linstart += 2
+            nonlinstart += 1
+
+        for j in range(self.bond_interactions.nint):
             r0 = pars[nonlinstart]
-            a = bond_interactions.indices[j][2 * k]
-            b = bond_interactions.indices[j][2 * k + 1]
-            dcopy(&THREE, &bond_interactions.coords[j][3 * k], &ONE, xij, &ONE)
-            bond(a, b, linstart, nonlinstart, xij, r0)
-        linstart += 1
-        nonlinstart += 1
-
-    linpars, _, _, _ = np.linalg.lstsq(np.asarray(dFlin).reshape((ndof, nlin)), ftrue.ravel(), rcond=None)
-    fapprox = np.einsum('ijk,k', dFlin, linpars)
-    df = fapprox - ftrue
-    chisq = np.sum(df * df)
-
-    if ret_linpars:
-        return linpars
-
-    if not grad:
-        return chisq
-
-    dchisq = 2 * np.einsum('ij,ijkl,l', df, dFnonlin, linpars)
-
-    return chisq, dchisq
+            for k in range(self.bond_interactions.npairs[j]):
+                a = self.bond_interactions.indices[j][2 * k]
+                b = self.bond_interactions.indices[j][2 * k + 1]
+                bond(dFlin, dFnonlin, a, b, linstart, nonlinstart,
+                     &self.bond_interactions.coords[j][3 * k], r0)
+            linstart += 1
+            nonlinstart += 1
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef int _lstsq(self, double[:, :, :] dFlin, double[:] linpars) noexcept nogil:
+        # Minimum norm least squares solution of dFlin @ linpars = ftrue,
+        # equivalent to np.linalg.lstsq
+        cdef int m = self.ndof
+        cdef int n = self.nlin
+        cdef int ldb = max(m, n)
+        cdef int rank
+        cdef int info
+        cdef int i
+        cdef int a
+        cdef int k
+
+        cdef double* A = <double*> malloc(sizeof(double) * m * n)
+        cdef double* rhs = <double*> malloc(sizeof(double) * ldb)
+        cdef double* s = <double*> malloc(sizeof(double) * min(m, n))
+        cdef double* work = <double*> malloc(sizeof(double) * self.lwork)
+        cdef int* iwork = <int*> malloc(sizeof(int) * self.liwork)
+
+        # LAPACK expects A in column-major order
+        for i in range(self.natoms):
+            for a in range(3):
+                rhs[3 * i + a] = self._ftrue[i, a]
+                for k in range(n):
+                    A[k * m + 3 * i + a] = dFlin[i, a, k]
+
+        dgelsd(&m, &n, &ONE, A, &m, rhs, &ldb, s, &self.rcond, &rank,
+               work, &self.lwork, iwork, &info)
+
+        for k in range(n):
+            linpars[k] = rhs[k]
+
+        free(A)
+        free(rhs)
+        free(s)
+        free(work)
+        free(iwork)
+        return info
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef double _chisq(self, double[:, :, :] dFlin, double[:, :, :, :] dFnonlin,
+                       double[:] linpars, double[:] dchisq, bint grad) noexcept nogil:
+        cdef int i
+        cdef int a
+        cdef int k
+        cdef int l
+        cdef double df
+        cdef double dfk
+        cdef double chisq = 0.
+
+        for i in range(self.natoms):
+            for a in range(3):
+                df = -self._ftrue[i, a]
+                for l in range(self.nlin):
+                    df += dFlin[i, a, l] * linpars[l]
+                chisq += df * df
+
+                if not grad:
+                    continue
 
-def calc_hess(linpars, nonlinpars, natoms):
-    global lj_interactions
-    global buck_interactions
-    global morse_interactions
-    global bond_interactions
+                for k in range(self.nnonlin):
+                    dfk = 0.
+                    for l in range(self.nlin):
+                        dfk += dFnonlin[i, a, k, l] * linpars[l]
+                    dchisq[k] += 2 * df * dfk
+        return chisq
 
-    cdef int i
-    cdef int j
-    cdef int k
-    cdef int l
-    cdef int a
-    cdef int b
-    cdef int linstart = 0
-    cdef int nonlinstart = 0
-    cdef int nlin = len(linpars)
-    cdef int nnonlin = len(nonlinpars)
-
-    cdef double C6
-    cdef double C12
-    cdef double A
-    cdef double B
-    cdef double D
-    cdef double K
-    cdef double r0
-    cdef double rho
-
-    xij_np = np.zeros(3, dtype=np.float64)
-    cdef double* xij = <double*> np.PyArray_DATA(xij_np)
-
-    hess_np = np.zeros((natoms, 3, natoms, 3))
-    cdef double[:, :, :, :] hess = memoryview(hess_np)
-
-    for i in range(lj_interactions.nint):
-        for j in range(lj_interactions.npairs[i]):
+    def calc_hess(self, linpars, nonlinpars, bint sparse=False):
+        """Cartesian Hessian of the fitted force field. If sparse is True,
+        the Hessian is returned as a scipy.sparse BSR matrix with 3x3
+        blocks, which only stores the blocks of atoms that interact."""
+        cdef double[:] lin = np.array(linpars, dtype=np.float64).ravel()
+        cdef double[:] nonlin = np.array(nonlinpars, dtype=np.float64).ravel()
+        if lin.shape[0] != self.nlin or nonlin.shape[0] != self.nnonlin:
+            raise ValueError("Wrong number of force field parameters")
+
+        cdef hess_target target
+        cdef double[:, :] hess
+        cdef double[:, :, :] blocks
+        cdef int[:, :] pair_blocks
+        cdef int[:] diag_blocks
+
+        memset(&target, 0, sizeof(hess_target))
+        target.sparse = sparse
+        target.ndof = self.ndof
+
+        if not sparse:
+            hess_np = np.zeros((self.ndof, self.ndof))
+            hess = hess_np
+            target.dense = &hess[0, 0]
+            with nogil:
+                self._hess(lin, nonlin, &target)
+            return hess_np
+
+        indices, indptr, pair_blocks_np, diag_blocks_np = self._bsr_structure()
+        blocks_np = np.zeros((len(indices), 3, 3))
+        blocks = blocks_np
+        pair_blocks = pair_blocks_np
+        diag_blocks = diag_blocks_np
+        target.blocks = &blocks[0, 0, 0]
+        target.diag_blocks = &diag_blocks[0]
+        if pair_blocks.shape[0] > 0:
+            target.pair_blocks = &pair_blocks[0, 0]
+        with nogil:
+            self._hess(lin, nonlin, &target)
+        return bsr_matrix((blocks_np, indices, indptr),
+                          shape=(self.ndof, self.ndof))
+
+    def _bsr_structure(self):
+        """Sparsity pattern of the Hessian in BSR format, along with the
+        block indices that each pair contributes to (see hess_target).
+        Every atom gets a diagonal block, even if it interacts with
+        nothing, and periodic self-interactions get no pair blocks as
+        they do not contribute to the Hessian."""
+        cdef int natoms = self.natoms
+        pairs = [indices for name in ['lj', 'buck', 'morse', 'bond']
+                 for indices, _ in self.ff_data[name].values()]
+        pairs = np.concatenate(pairs + [np.zeros((0, 2), dtype=np.int32)])
+        pairs = pairs.astype(np.int64)
+        offdiag = pairs[:, 0] != pairs[:, 1]
+
+        diag_keys = np.arange(natoms, dtype=np.int64) * (natoms + 1)
+        ij_keys = pairs[:, 0] * natoms + pairs[:, 1]
+        ji_keys = pairs[:, 1] * natoms + pairs[:, 0]
+        keys = np.unique(np.concatenate((diag_keys, ij_keys[offdiag],
+                                         ji_keys[offdiag])))
+
+        indices = (keys % natoms).astype(np.int32)
+        indptr = np.zeros(natoms + 1, dtype=np.int32)
+        np.cumsum(np.bincount(keys // natoms, minlength=natoms), out=indptr[1:])
+
+        pair_blocks = -np.ones((len(pairs), 2), dtype=np.int32)
+        pair_blocks[offdiag, 0] = np.searchsorted(keys, ij_keys[offdiag])
+        pair_blocks[offdiag, 1] = np.searchsorted(keys, ji_keys[offdiag])
+        diag_blocks = np.searchsorted(keys, diag_keys).astype(np.int32)
+        return indices, indptr, pair_blocks, diag_blocks
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void _hess(self, double[:] linpars, double[:] nonlinpars,
+                    hess_target* hess) noexcept nogil:
+        cdef int i
+        cdef int j
+        cdef int a
+        cdef int b
+        cdef int linstart = 0
+        cdef int nonlinstart = 0
+
+        cdef double C6
+        cdef double C12
+        cdef double A
+        cdef double B
+        cdef double K
+        cdef double r0
+        cdef double rho
+
+        for i in range(self.lj_interactions.nint):
             C6 = linpars[linstart]
             C12 = linpars[linstart + 1]
-            a = lj_interactions.indices[i][2 * j]
-            b = lj_interactions.indices[i][2 * j + 1]
-            dcopy(&THREE, &lj_interactions.coords[i][3 * j], &ONE, xij, &ONE)
-            lj_hess(a, b, C6, C12, xij, hess)
-        linstart += 2
-
-    for i in range(buck_interactions.nint):
-        for j in range(buck_interactions.npairs[i]):
+            for j in range(self.lj_interactions.npairs[i]):
+                a = self.lj_interactions.indices[i][2 * j]
+                b = self.lj_interactions.indices[i][2 * j + 1]
+                lj_hess(a, b, C6, C12, &self.lj_interactions.coords[i][3 * j], hess)
+            linstart += 2
+
+        for i in range(self.buck_interactions.nint):
             A = linpars[linstart]
             C6 = linpars[linstart + 1]
             rho = nonlinpars[nonlinstart]
-
-            a = buck_interactions.indices[i][2 * j]
-            b = buck_interactions.indices[i][2 * j + 1]
-            dcopy(&THREE, &buck_interactions.coords[i][3 * j], &ONE, xij, &ONE)
-            buck_hess(a, b, A, C6, rho, xij, hess)
-        linstart += 2
-        nonlinstart += 1
-
-    for i in range(morse_interactions.nint):
-        for j in range(morse_interactions.npairs[i]):
+            for j in range(self.buck_interactions.npairs[i]):
+                a = self.buck_interactions.indices[i][2 * j]
+                b = self.buck_interactions.indices[i][2 * j + 1]
+                buck_hess(a, b, A, C6, rho, &self.buck_interactions.coords[i][3 * j], hess)
+            linstart += 2
+            nonlinstart += 1
+
+        for i in range(self.morse_interactions.nint):
             A = linpars[linstart]
             B = linpars[linstart + 1]
             rho = nonlinpars[nonlinstart]
-
-            a = morse_interactions.indices[i][2 * j]
-            b = morse_interactions.indices[i][2 * j + 1]
-            dcopy(&THREE, &morse_interactions.coords[i][3 * j], &ONE, xij, &ONE)
-            morse_hess(a, b, A, B, rho, xij, hess)
-        linstart += 2
-        nonlinstart += 1
-
-    for i in range(bond_interactions.nint):
-        for j in range(bond_interactions.npairs[i]):
+            for j in range(self.morse_interactions.npairs[i]):
+                a = self.morse_interactions.indices[i][2 * j]
+                b = self.morse_interactions.indices[i][2 * j + 1]
+                morse_hess(a, b, A, B, rho, &self.morse_interactions.coords[i][3 * j], hess)
+            linstart += 2
+            nonlinstart += 1
+
+        for i in range(self.bond_interactions.nint):
             K = linpars[linstart]
             r0 = nonlinpars[nonlinstart]
-
-            a = bond_interactions.indices[i][2 * j]
-            b = bond_interactions.indices[i][2 * j + 1]
-            dcopy(&THREE, &bond_interactions.coords[i][3 * j], &ONE, xij, &ONE)
-            bond_hess(a, b, K, r0, xij, hess)
-        linstart += 1
-        nonlinstart += 1
-
-    return hess_np.reshape((3 * natoms, 3 * natoms))
+            for j in range(self.bond_interactions.npairs[i]):
+                a = self.bond_interactions.indices[i][2 * j]
+                b = self.bond_interactions.indices[i][2 * j + 1]
+                bond_hess(a, b, K, r0, &self.bond_interactions.coords[i][3 * j], hess)
+            linstart += 1
+            nonlinstart += 1
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-cdef void update_hess(int i, int j, double* xij, double[:, :, :, :] hess, double diag, double rest) nogil:
+cdef void update_hess(int i, int j, double* xij, hess_target* hess, double diag, double rest) noexcept nogil:
+    # The Hessian of a pair interaction is H = diag * I + rest * xij xij^T,
+    # added to the (i, i) and (j, j) blocks and subtracted from (i, j) and (j, i)
     cdef int k
     cdef int a
+    cdef int n = hess[0].ndof
     cdef double hessterm
+    cdef double* ii
+    cdef double* jj
+    cdef double* ij
+    cdef double* ji
+    cdef int* blk
+
+    if hess[0].sparse:
+        blk = &hess[0].pair_blocks[2 * hess[0].npair]
+        hess[0].npair += 1
+        if blk[0] < 0:
+            return
+        ii = &hess[0].blocks[9 * hess[0].diag_blocks[i]]
+        jj = &hess[0].blocks[9 * hess[0].diag_blocks[j]]
+        ij = &hess[0].blocks[9 * blk[0]]
+        ji = &hess[0].blocks[9 * blk[1]]
+        for k in range(3):
+            for a in range(3):
+                hessterm = rest * xij[k] * xij[a]
+                if a == k:
+                    hessterm += diag
+                ii[3 * k + a] += hessterm
+                jj[3 * k + a] += hessterm
+                ij[3 * k + a] -= hessterm
+                ji[3 * k + a] -= hessterm
+        return
 
     for k in range(3):
         hessterm = diag + rest * xij[k] * xij[k]
-        hess[i, k, i, k] += hessterm
-        hess[i, k, j, k] -= hessterm
+        hess[0].dense[(3 * i + k) * n + 3 * i + k] += hessterm
+        hess[0].dense[(3 * i + k) * n + 3 * j + k] -= hessterm
 
-        hess[j, k, i, k] -= hessterm
-        hess[j, k, j, k] += hessterm
+        hess[0].dense[(3 * j + k) * n + 3 * i + k] -= hessterm
+        hess[0].dense[(3 * j + k) * n + 3 * j + k] += hessterm
         for a in range(k + 1, 3):
             hessterm = rest * xij[k] * xij[a]
-            hess[i, k, i, a] += hessterm
-            hess[i, k, j, a] -= hessterm
-            hess[j, k, i, a] -= hessterm
-            hess[j, k, j, a] += hessterm
+            hess[0].dense[(3 * i + k) * n + 3 * i + a] += hessterm
+            hess[0].dense[(3 * i + k) * n + 3 * j + a] -= hessterm
+            hess[0].dense[(3 * j + k) * n + 3 * i + a] -= hessterm
+            hess[0].dense[(3 * j + k) * n + 3 * j + a] += hessterm
 
-            hess[i, a, i, k] += hessterm
-            hess[i, a, j, k] -= hessterm
-            hess[j, a, i, k] -= hessterm
-            hess[j, a, j, k] += hessterm
+            hess[0].dense[(3 * i + a) * n + 3 * i + k] += hessterm
+            hess[0].dense[(3 * i + a) * n + 3 * j + k] -= hessterm
+            hess[0].dense[(3 * j + a) * n + 3 * i + k] -= hessterm
+            hess[0].dense[(3 * j + a) * n + 3 * j + k] += hessterm
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-cdef void lj(int i, int j, int linstart, double* xij) nogil:
+cdef void lj(double[:, :, :] dFlin, int i, int j, int linstart, double* xij) noexcept nogil:
     cdef double dij
     cdef double dij2
     cdef double dij8
@@ -491,8 +884,6 @@ cdef void lj(int i, int j, int linstart, double* xij) nogil:
     cdef double f12
     cdef int k
 
-    global dFlin
-    
     dij2 = 0.
     for k in range(3):
         dij2 += xij[k] * xij[k]
@@ -515,7 +906,7 @@ cdef void lj(int i, int j, int linstart, double* xij) nogil:
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-cdef void lj_hess(int i, int j, double C6, double C12, double* xij, double[:, :, :, :] hess) nogil:
+cdef void lj_hess(int i, int j, double C6, double C12, double* xij, hess_target* hess) noexcept nogil:
     cdef double dij2
     cdef double dij8
     cdef double dij14
@@ -544,8 +935,8 @@ cdef void lj_hess(int i, int j, double C6, double C12, double* xij, double[:, :,
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-cdef void buck(int i, int j, int linstart, int nonlinstart,
-               double* xij, double B) nogil:
+cdef void buck(double[:, :, :] dFlin, double[:, :, :, :] dFnonlin, int i, int j,
+               int linstart, int nonlinstart, double* xij, double B) noexcept nogil:
     cdef double dij
     cdef double dij2
     cdef double dij8
@@ -555,9 +946,6 @@ cdef void buck(int i, int j, int linstart, int nonlinstart,
     cdef double dB
     cdef int k
 
-    global dFlin
-    global dFnonlin
-
     dij2 = 0.
     for k in range(3):
         dij2 += xij[k] * xij[k]
@@ -584,7 +972,7 @@ cdef void buck(int i, int j, int linstart, int nonlinstart,
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-cdef void buck_hess(int i, int j, double A, double C6, double B, double* xij, double[:, :, :, :] hess) nogil:
+cdef void buck_hess(int i, int j, double A, double C6, double B, double* xij, hess_target* hess) noexcept nogil:
     cdef double dij
     cdef double dij2
     cdef double dij3
@@ -615,7 +1003,8 @@ cdef void buck_hess(int i, int j, double A, double C6, double B, double* xij, do
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-cdef void morse(int i, int j, int linstart, int nonlinstart, double* xij, double rho) nogil:
+cdef void morse(double[:, :, :] dFlin, double[:, :, :, :] dFnonlin, int i, int j,
+                int linstart, int nonlinstart, double* xij, double rho) noexcept nogil:
     cdef double dij
     cdef double dij2
     cdef double expterm
@@ -626,9 +1015,6 @@ cdef void morse(int i, int j, int linstart, int nonlinstart, double* xij, double
     cdef double drho_rep
     cdef int k
 
-    global dFlin
-    global dFnonlin
-
     dij2 = 0.
     for k in range(3):
         dij2 += xij[k] * xij[k]
@@ -658,7 +1044,7 @@ cdef void morse(int i, int j, int linstart, int nonlinstart, double* xij, double
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-cdef void morse_hess(int i, int j, double A, double B, double rho, double* xij, double[:, :, :, :] hess) nogil:
+cdef void morse_hess(int i, int j, double A, double B, double rho, double* xij, hess_target* hess) noexcept nogil:
     cdef double dij
     cdef double dij2
     cdef double expterm
@@ -685,16 +1071,14 @@ cdef void morse_hess(int i, int j, double A, double B, double rho, double* xij,
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-cdef void bond(int i, int j, int linstart, int nonlinstart, double* xij, double r0) nogil:
+cdef void bond(double[:, :, :] dFlin, double[:, :, :, :] dFnonlin, int i, int j,
+               int linstart, int nonlinstart, double* xij, double r0) noexcept nogil:
     cdef double dij
     cdef double dij2
     cdef double fbond
     cdef double dr0
     cdef int k
 
-    global dFlin
-    global dFnonlin
-
     dij2 = 0.
     for k in range(3):
         dij2 += xij[k] * xij[k]
@@ -714,7 +1098,7 @@ cdef void bond(int i, int j, int linstart, int nonlinstart, double* xij, double
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-cdef void bond_hess(int i, int j, double K, double r0, double* xij, double[:, :, :, :] hess) nogil:
+cdef void bond_hess(int i, int j, double K, double r0, double* xij, hess_target* hess) noexcept nogil:
     cdef double dij
     cdef double dij2
     cdef double dij3
@@ -4,7 +4,7 @@ from __future__ import division
 
 import numpy as np
 
-from scipy.linalg import eigh, lstsq
+from scipy.linalg import eigh, lstsq, solve_triangular
 
 from .cython_routines import symmetrize_Y2
 
@@ -22,6 +22,123 @@ def symmetrize_Y(S, Y, symm):
         raise ValueError("Unknown symmetrization method {}".format(symm))
 
 
+class Symmetrizer(object):
+    """Incremental version of symmetrize_Y(S, Y, symm=2) for a subspace
+    S that only grows by appending columns.
+
+    Column i of the correction dY only depends on the first i + 1
+    columns of S and Y, so earlier columns never change. The Gram
+    matrices S.T @ S and Y.T @ S, the Cholesky factor of S.T @ S and the
+    projected matrix S.T @ (Y + dY) are extended by one row and column
+    per new vector, which costs O(n k + k^2) instead of recomputing
+    everything in O(n k^2 + k^3)."""
+    def __init__(self, d, capacity=8):
+        self.d = d
+        self.k = 0
+        self._S = np.zeros((d, capacity))
+        self._Y = np.zeros((d, capacity))
+        self._dY = np.zeros((d, capacity))
+        self._STS = np.zeros((capacity, capacity))
+        self._YTS = np.zeros((capacity, capacity))
+        self._L = np.zeros((capacity, capacity))
+        # Column i holds the coefficients x_i, with dY[:, i] = -S @ x_i
+        self._X = np.zeros((capacity, capacity))
+        self._Atilde = np.zeros((capacity, capacity))
+        # Set if S.T @ S is numerically singular, in which case the
+        # Cholesky factor can no longer be used
+        self._singular = False
+
+    def _grow(self):
+        capacity = 2 * self._S.shape[1]
+        for name in ['_S', '_Y', '_dY']:
+            old = getattr(self, name)
+            new = np.zeros((self.d, capacity))
+            new[:, :self.k] = old[:, :self.k]
+            setattr(self, name, new)
+        for name in ['_STS', '_YTS', '_L', '_X', '_Atilde']:
+            old = getattr(self, name)
+            new = np.zeros((capacity, capacity))
+            new[:self.k, :self.k] = old[:self.k, :self.k]
+            setattr(self, name, new)
+
+    def add(self, s, y):
+        """Append the columns of s and y"""
+        s = np.asarray(s).reshape((self.d, -1))
+        y = np.asarray(y).reshape((self.d, -1))
+        for si, yi in zip(s.T, y.T):
+            self._add(si, yi)
+
+    def _add(self, s, y):
+        i = self.k
+        if i == self._S.shape[1]:
+            self._grow()
+        S = self._S[:, :i]
+        self._S[:, i] = s
+        self._Y[:, i] = y
+
+        STs = S.T @ s
+        self._STS[:i, i] = self._STS[i, :i] = STs
+        self._STS[i, i] = s @ s
+        self._YTS[i, :i] = y @ S
+        self._YTS[:i, i] = self._Y[:, :i].T @ s
+        self._YTS[i, i] = y @ s
+
+        # dY.T @ S for the earlier columns of dY and the new column of S
+        dYTS = -(STs @ self._X[:i, :i])
+
+        if i > 0:
+            rhs = self._YTS[i, :i] - self._YTS[:i, i] - dYTS
+            if self._singular:
+                x = lstsq(self._STS[:i, :i], rhs)[0]
+            else:
+                L = self._L[:i, :i]
+                x = solve_triangular(L, solve_triangular(L, rhs, lower=True),
+                                     lower=True, trans='T')
+            self._X[:i, i] = x
+            self._dY[:, i] = -S @ x
+            STdY = -(self._STS[:i + 1, :i] @ x)
+        else:
+            STdY = np.zeros(1)
+
+        # Projected matrix S.T @ (Y + dY)
+        self._Atilde[:i + 1, i] = self._YTS[i, :i + 1] + STdY
+        self._Atilde[i, :i] = self._YTS[:i, i] + dYTS
+
+        # Extend the Cholesky factor of S.T @ S
+        if not self._singular:
+            l = np.zeros(0)
+            if i > 0:
+                l = solve_triangular(self._L[:i, :i], STs, lower=True)
+            d2 = self._STS[i, i] - l @ l
+            if d2 <= 1e-14 * self._STS[i, i]:
+                self._singular = True
+            else:
+                self._L[i, :i] = l
+                self._L[i, i] = np.sqrt(d2)
+        self.k += 1
+
+    @property
+    def S(self):
+        return self._S[:, :self.k]
+
+    @property
+    def Y(self):
+        return self._Y[:, :self.k]
+
+    @property
+    def dY(self):
+        return self._dY[:, :self.k]
+
+    @property
+    def Ytilde(self):
+        return self.Y + self.dY
+
+    @property
+    def Atilde(self):
+        """S.T @ Ytilde"""
+        return self._Atilde[:self.k, :self.k]
+
+
 def update_H(B, S, Y, method='BFGS_auto', symm=2, lams=None, vecs=None):
     if len(S.shape) == 1:
         if np.linalg.norm(S) < 1e-8:
@@ -6,21 +6,48 @@ import warnings
 
 import numpy as np
 from scipy.optimize import minimize
+from scipy.sparse import identity
+from scipy.sparse.linalg import LinearOperator, lsmr, splu
 from .internal_cython import get_internal, cart_to_internal
 
 from ase.data import covalent_radii, vdw_radii
 
+# Number of Cartesian coordinates up to which dense mode factorizes
+# every new B instead of reusing an earlier factorization with LSMR
+_DENSE_REFACTORIZE = 200
+
+
 class Internal(object):
-    def __init__(self, atoms, angles=False, dihedrals=False, extra_bonds=None):
+    def __init__(self, atoms, angles=False, dihedrals=False, extra_bonds=None,
+                 sparse=False, bt_tol=1e-7, dt0=0.02, maxiter_reuse=10):
         self.extra_bonds = []
         if extra_bonds is not None:
             self.extra_bonds = extra_bonds
         self.use_angles = angles
         self.use_dihedrals = dihedrals
+        # Store B as a CSR matrix and back-transform steps iteratively,
+        # rather than with a dense SVD. Recommended for large systems.
+        self.sparse = sparse
         self._mask = None
 
+        # Parameters of the back-transformation in the p setter: target
+        # local error of each substep, initial substep size, and the
+        # number of preconditioned LSMR iterations allowed before B is
+        # factorized again. self.stats records the cost of the last step.
+        self.bt_tol = bt_tol
+        self.dt0 = dt0
+        self.maxiter_reuse = maxiter_reuse
+        self.stats = dict(nsubsteps=0, nrejected=0, nfactorizations=0,
+                          nsolves=0, niterations=0)
+        self._factor = None
+
+        # p, B and D are cached together and are valid as long as
+        # self._cache_version matches self._version, which is bumped
+        # whenever the positions change.
+        self._version = 0
+        self._cache_version = -1
+
         self.atoms = atoms
-        self._pos_old = np.zeros_like(self.atoms.get_positions())
 
         self.path = None
         self.v0 = None
@@ -28,8 +55,9 @@ class Internal(object):
 
 
     def get_internal(self):
-        self.c10y, self.nbonds, self.bonds, self.angles, self.dihedrals = get_internal(
-                self._atoms, self.use_angles, self.use_dihedrals, self.extra_bonds)
+        (self.c10y, self.nbonds, self.bonds, self.angles, self.dihedrals,
+         self.images) = get_internal(self._atoms, self.use_angles,
+                                     self.use_dihedrals, self.extra_bonds)
         self.nb = len(self.bonds)
         if self.use_angles:
             self.na = len(self.angles)
@@ -56,9 +84,15 @@ class Internal(object):
     def atoms(self, new_atoms):
         self._atoms = new_atoms.copy()
         self.natoms = len(self._atoms)
+        self._version += 1
 
         self.get_internal()
 
+        # Rigid rotations are not free in periodic systems, so leave
+        # the orientation alone
+        if self.periodic:
+            return
+
         # Index of atom to be placed at the origin
         for ind0 in range(self.natoms):
             # Index of atom to be placed along X axis
@@ -72,6 +106,7 @@ class Internal(object):
 
         # Translate ind0 to origin
         self._atoms.positions -= self._atoms.get_positions()[ind0]
+        self._version += 1
         
         # Rotate ind1 into X axis
         pos = self._atoms.get_positions()
@@ -83,87 +118,211 @@ class Internal(object):
         pos = self._atoms.get_positions()
         angle = -np.arccos(pos[ind2, 1] /  np.linalg.norm(pos[ind2, 1:])) * 180. / np.pi
         self._atoms.rotate(angle, 'x')
+        self._version += 1
+
+    @property
+    def positions(self):
+        return self._atoms.positions
+
+    @positions.setter
+    def positions(self, new_positions):
+        """All changes to the geometry should go through this setter, so
+        that cached internal coordinates and derivatives are invalidated"""
+        new_positions = np.asarray(new_positions).reshape((-1, 3))
+        if np.array_equal(new_positions, self._atoms.positions):
+            return
+        self._atoms.positions = new_positions
+        self._version += 1
+
+    @property
+    def periodic(self):
+        return bool(np.any(self._atoms.pbc))
+
+    def _cart_to_internal(self, mask, gradient=False, curvature=False):
+        if self.periodic:
+            cell, images = self.atoms.cell.array, self.images
+        else:
+            cell, images = None, None
+        return cart_to_internal(self.atoms.positions, self.bonds,
+                                self.angles, self.dihedrals, mask,
+                                gradient, curvature, cell, images,
+                                self.sparse)
+
+    def _factorize(self):
+        """Factorize the current B.
+
+        Returns functions applying pinv(B) and its transpose. In dense
+        mode this is done through the SVD of B, leaving out vectors
+        corresponding to small singular values. In sparse mode the
+        regularized normal equations are factorized with a sparse LU
+        decomposition."""
+        B = self.B
+        self.stats['nfactorizations'] += 1
+        if self.sparse:
+            G = (B.T @ B).tocsc()
+            # B has a null space (rigid body motions), so G must be
+            # regularized. Too weak a shift leaves rounding noise in
+            # that null space amplified by 1 / delta, which gives the
+            # reused factorization spurious small singular values and
+            # stalls LSMR, so a moderate shift is used and its bias is
+            # removed by one step of iterative refinement.
+            delta = 1e-6 * max(G.diagonal().mean(), 1.)
+            lu = splu(G + delta * identity(G.shape[0], format='csc'))
+            def solve(b):
+                y = lu.solve(b)
+                return y + lu.solve(b - G @ y)
+            def apply(r):
+                return solve(B.T @ r)
+            def apply_T(x):
+                return B @ solve(x)
+        else:
+            lvecs, lams, rvecs = np.linalg.svd(B, full_matrices=False)
+            indices = [i for i, lam in enumerate(lams) if abs(lam) > 1e-12]
+            lvecs = lvecs[:, indices]
+            lams = lams[indices]
+            rvecs = rvecs[indices, :]
+            def apply(r):
+                return rvecs.T @ ((lvecs.T @ r) / lams)
+            def apply_T(x):
+                return lvecs @ ((rvecs @ x) / lams)
+        self._factor = (B, apply, apply_T)
+
+    def _solve(self, rhs, transpose=False):
+        """Least squares solution of B @ x = rhs, or of B.T @ x = rhs
+        if transpose is True.
+
+        The factorization of an earlier B is reused as a right
+        preconditioner for LSMR. Because B changes little between
+        substeps, B @ pinv(B_old) is close to a projector and LSMR
+        converges in a few iterations. If it does not converge within
+        maxiter_reuse iterations, B is factorized again. The transposed
+        system is solved the same way, since pinv(B.T) = pinv(B).T."""
+        self.stats['nsolves'] += 1
+        B = self.B
+        # The number of coordinates changes if angles become collinear.
+        # For small dense systems, a new SVD is cheaper than the LSMR
+        # iterations, so B is simply factorized again when it changes.
+        if (self._factor is None or self._factor[0].shape != B.shape
+                or (not self.sparse and B.shape[1] <= _DENSE_REFACTORIZE
+                    and self._factor[0] is not B)):
+            self._factorize()
+        B_old, apply, apply_T = self._factor
+        if transpose:
+            apply, apply_T = apply_T, apply
+        if B_old is B:
+            return apply(rhs)
+
+        if transpose:
+            B = B.T
+        n = B.shape[0]
+        A = LinearOperator((n, n), dtype=np.float64,
+                           matvec=lambda y: B @ apply(y),
+                           rmatvec=lambda z: apply_T(B.T @ z))
+        y, istop, itn = lsmr(A, rhs, atol=1e-12, btol=1e-12,
+                             maxiter=self.maxiter_reuse)[:3]
+        self.stats['niterations'] += itn
+        if istop in (0, 1, 2):
+            return apply(y)
+        self._factorize()
+        return self._factor[2 if transpose else 1](rhs)
+
+    def _coriolis(self, vhalf, dt):
+        """Self-consistently solve for the velocity and acceleration at
+        the end of a velocity-Verlet substep. Because of Coriolis forces,
+        v(t) depends on a(t) which depends on v(t)... This is solved
+        using DIIS. Returns None if it fails to converge."""
+        nscf = 100
+        ndiis = 5
+        viter = np.zeros((len(vhalf), nscf))
+        errors = np.zeros((len(vhalf), nscf))
+        D = self.D  # This calculates p and B as well
+        v = vhalf.copy()
+        for i in range(nscf):
+            vlast = v.copy()
+            viter[:, i] = v
+            a = -self._solve(D.ddot(v, v))
+            errors[:, i] = vhalf + a * dt / 2 - v
+            # Don't do DIIS for first two iterations
+            if i <= 1:
+                v = vhalf + a * dt / 2
+                continue
+            # Only use at most ndiis histories
+            nhist = min(i+1, ndiis)
+            # DIIS interpolation
+            A = np.ones((nhist+1, nhist+1))
+            A[:nhist, :nhist] = errors[:, i+1-nhist:i+1].T @ errors[:, i+1-nhist:i+1]
+            A[-1, -1] = 0
+            rhs = np.zeros(nhist+1)
+            rhs[-1] = 1
+            cs = np.linalg.lstsq(A, rhs, rcond=None)[0]
+            v = viter[:, i+1-nhist:i+1] @ cs[:nhist]
+            if np.linalg.norm(v - vlast) < 1e-12:
+                return v, a
+        return None
 
     def _calc_internal(self, gradient=False, curvature=False):
         mask = np.ones(self.ninternal, dtype=np.uint8)
-        self._p, _, _ = cart_to_internal(self.atoms.positions,
-                                         self.bonds,
-                                         self.angles,
-                                         self.dihedrals,
-                                         mask)
+        self._p, _, _ = self._cart_to_internal(mask)
 
-        added = True
         # Check for near-collinear angles and make sure the terminal atoms are
-        # considered connected. This is done iteratively.
+        # considered connected. This is done iteratively. Periodic solids
+        # have many collinear angles but their bond network already fixes
+        # all atoms, so extra bonds are only added for aperiodic systems.
+        added = not self.periodic
         while added:
-            added = False
-            for i, thetai in enumerate(self._p[self.nb:self.nb+self.na]):
-                # Check to see if an angle is near collinear
-                if np.pi - thetai < np.pi / 20:
-                #if False:
-                    a, b, c = self.angles[i]
-                    # If it is, check to make sure the two terminal atoms are bound.
-                    # If they aren't, add a bond explicitly.
-                    for j, k in self.bonds:
-                        if j == a and k == c:
-                            break
-                    else:
-                        self.extra_bonds.append(tuple(sorted((a, c))))
-                        added = True
+            collinear = _collinear(self._p[self.nb:self.nb+self.na])
+            missing = _missing_bonds(self.bonds, self.images[0],
+                                     self.angles[collinear],
+                                     self.images[1][collinear])
+            self.extra_bonds += missing
+            added = bool(missing)
             if added:
                 self.get_internal()
-                self._p, _, _ = cart_to_internal(self.atoms.positions,
-                                                 self.bonds,
-                                                 self.angles,
-                                                 self.dihedrals,
-                                                 self._mask)
+                self._p, _, _ = self._cart_to_internal(self._mask)
         # Next, identify all angles near 180 degrees.
-        collinear = []
+        collinear = _collinear(self._p[self.nb:self.nb+self.na])
         self._mask = np.ones(self.ninternal, dtype=np.uint8)
-        for i, thetai in enumerate(self._p[self.nb:self.nb+self.na]):
-            if np.pi - thetai < np.pi / 20:
-            #if False:
-                collinear.append(i)
+        # Without the extra bond, a linear angle must be left
+        # out, as its gradient is undefined
+        if self.periodic:
+            self._mask[self.nb + collinear] = False
         # Next, mask all dihedral angles for which three of the atoms
         # form an angle near 180 degrees.
-        for i, di in enumerate(self.dihedrals):
-            for j in collinear:
-                a, b, c = self.angles[j]
-                if (a in di) and (b in di) and (c in di):
-                    self._mask[self.nb + self.na + i] = False
-                    break
-        self._p, self._B, self._D = cart_to_internal(self.atoms.positions,
-                                                     self.bonds,
-                                                     self.angles,
-                                                     self.dihedrals,
-                                                     self._mask,
-                                                     gradient, curvature)
-        self._pos_old = self.atoms.positions.copy()
+        masked = _dihedrals_containing(self.dihedrals, self.images[2],
+                                       self.angles[collinear],
+                                       self.images[1][collinear])
+        self._mask[self.nb + self.na + np.flatnonzero(masked)] = False
+        self._p, B, D = self._cart_to_internal(self._mask, gradient,
+                                               curvature)
+        # Keep whatever was already cached at this geometry
+        if self._cache_version != self._version:
+            self._B = None
+            self._D = None
+            self._cache_version = self._version
+        if gradient and self._B is None:
+            self._B = B
+        if curvature:
+            self._D = D
 
     @property
     def p(self):
-        if self._p is not None and np.all(self.atoms.positions == self._pos_old):
-            return self._p
-        self._calc_internal()
-        self._B = None
-        self._D = None
+        if self._p is None or self._cache_version != self._version:
+            self._calc_internal()
         return self._p
 
     @p.setter
     def p(self, target):
         # Dihedral angles can differ by at most pi and at least -pi.
         # Modify dihedral angles accordingly
-        nba = self.nb + self.na
         dp = target - self.p
+        nba = self.nb + int(np.sum(self._mask[self.nb:self.nb+self.na]))
         dp[nba:] = (dp[nba:] + np.pi) % (2 * np.pi) - np.pi
 
+        self.stats = dict(nsubsteps=0, nrejected=0, nfactorizations=0,
+                          nsolves=0, niterations=0)
 
         # Calculate linearized cartesian displacement vector.
-        # Rather than calculating pinv(B), we do SVD and explicitly
-        # leave out vectors corresponding to small singular values.
-        lvecs, lams, rvecs = np.linalg.svd(self.B, full_matrices=False)
-        indices = [i for i, lam in enumerate(lams) if abs(lam) > 1e-12]
-        dx = rvecs[indices, :].T @ ((lvecs[:, indices].T @ dp) / lams[indices])
+        dx = self._solve(dp)
         self.v0 = dx.copy()
         dxnorm = np.linalg.norm(dx)
         dx_max = 1e-3  # Maximum linear displacement to use
@@ -172,68 +331,48 @@ class Internal(object):
         # displacement and skip the rest of the algorithm
         if dxnorm <= dx_max:
             self.path = [self.atoms.get_positions().copy()]
-            self.atoms.positions += dx.reshape((-1, 3))
+            self.positions = self.positions + dx.reshape((-1, 3))
             self.path.append(self.atoms.get_positions().copy())
             self.v1 = dx.copy()
             return
-        nsteps = int(np.ceil(dxnorm / dx_max))
-        dt = dxnorm / nsteps  # "time step"
         # Initial "velocity" is initial displacement vector normalized
         v = dx / dxnorm
         # Acceleration comes from Coriolis forces in internal coordinates.
-        a = -rvecs[indices, :].T @ ((lvecs[:, indices].T @ self.D.ddot(v, v)) / lams[indices])
+        a = -self._solve(self.D.ddot(v, v))
         self.path = [self.atoms.get_positions().copy()]
 
-        # Parameters for DIIS (see below)
-        nscf = 100
-        ndiis = 5
-        viter = np.zeros((len(dx), nscf))
-        errors = np.zeros((len(dx), nscf))
-        p = self.p.copy()
-        # Outer loop controls linear displacements in cartesian coordinates
-        for _ in range(nsteps):
-            # Use explicit velocity-verlet to integrate
+        # Integrate with velocity-Verlet using adaptive substeps. The
+        # local error of a substep is estimated from the change in
+        # acceleration, dt**2 |a(t + dt) - a(t)| / 6, and the substep
+        # size is adjusted to keep it close to bt_tol.
+        t = 0.
+        dt = min(self.dt0, dxnorm)
+        while dxnorm - t > 1e-12 * dxnorm:
+            dt = min(dt, dxnorm - t)
+            pos = self.atoms.get_positions()
             vhalf = v + a * dt / 2
-            self.atoms.positions += (vhalf * dt).reshape((-1, 3))
-            D = self.D  # This calculates p and B as well
-            self.path.append(self.atoms.get_positions().copy())
-            v = vhalf.copy()
-            lvecs, lams, rvecs = np.linalg.svd(self.B, full_matrices=False)
-            indices = [i for i, lam in enumerate(lams) if abs(lam) > 1e-12]
-            # Inner loop controls self consistency. Because of Coriolis
-            # forces, v(t) depends on a(t) which depends on v(t)... This
-            # is solved self-consistently using DIIS
-            for i in range(nscf):
-                ## Simple iterative algorithm. While this usually works,
-                ## it occasionally fails to converge
-                #vlast = v.copy()
-                #a = -rvecs[indices, :].T @ ((lvecs[:, indices].T @ self.D.ddot(v, v)) / lams[indices])
-                #v = vhalf + a * dt / 2
-                #if np.linalg.norm(v - vlast) < 1e-12:
-                #    break
-                vlast = v.copy()
-                viter[:, i] = v
-                a = -rvecs[indices, :].T @ ((lvecs[:, indices].T @ self.D.ddot(v, v)) / lams[indices])
-                errors[:, i] = vhalf + a * dt / 2 - v
-                # Don't do DIIS for first two iterations
-                if i <= 1:
-                    v = vhalf + a * dt / 2
-                    continue
-                # Only use at most ndiis histories
-                nhist = min(i+1, ndiis)
-                # DIIS interpolation
-                A = np.ones((nhist+1, nhist+1))
-                A[:nhist, :nhist] = errors[:, i+1-nhist:i+1].T @ errors[:, i+1-nhist:i+1]
-                A[-1, -1] = 0
-                rhs = np.zeros(nhist+1)
-                rhs[-1] = 1
-                cs = np.linalg.lstsq(A, rhs, rcond=None)[0]
-                v = viter[:, i+1-nhist:i+1] @ cs[:nhist]
-                if np.linalg.norm(v - vlast) < 1e-12:
-                    break
+            self.positions = self.positions + (vhalf * dt).reshape((-1, 3))
+            result = self._coriolis(vhalf, dt)
+            if result is None:
+                err = np.inf
             else:
-                print(np.linalg.norm(v - vlast))
+                err = dt**2 * np.linalg.norm(result[1] - a) / 6
+            if err > self.bt_tol and dt > dx_max:
+                self.positions = pos
+                self.stats['nrejected'] += 1
+                dt = max(dt * max(0.9 * (self.bt_tol / err)**(1/3), 0.2),
+                         dx_max)
+                continue
+            if result is None:
                 raise RuntimeError('Failed to converge Coriolis forces')
+            v, a = result
+            t += dt
+            self.stats['nsubsteps'] += 1
+            self.path.append(self.atoms.get_positions().copy())
+            if err > 0:
+                dt *= min(0.9 * (self.bt_tol / err)**(1/3), 2.)
+            else:
+                dt *= 2.
         self.v1 = dxnorm * v.copy()
 
     def xpolate(self, alpha):
@@ -242,7 +381,7 @@ class Internal(object):
             raise RuntimeError('No path to interpolate/extrapolate!')
         # Extrapolate backwards, starting from original configuration
         if alpha < 0:
-            self.atoms.positions = self.path[0]
+            self.positions = self.path[0]
             self.p = self.p + alpha * self.B @ self.v0
         # Linearly interpolate from two adjacent images in path
         elif 0 < alpha < 1:
@@ -250,24 +389,82 @@ class Internal(object):
             beta = alpha * nsteps
             idx = int(beta)
             beta -= idx
-            self.atoms.positions = self.path[idx + 1] * beta + self.path[idx] * (1 - beta)
+            self.positions = self.path[idx + 1] * beta + self.path[idx] * (1 - beta)
         # Extrpolate forwards, starting from final configuration
         else:
-            self.atoms.positions = self.path[-1]
+            self.positions = self.path[-1]
             self.p = self.p + (1 - alpha) * self.B @ self.v1
         return self.p
 
     @property
     def B(self):
-        if self._B is not None and np.all(self.atoms.positions == self._pos_old):
-            return self._B
-        self._calc_internal(gradient=True)
-        self._D = None
+        if self._B is None or self._cache_version != self._version:
+            self._calc_internal(gradient=True)
         return self._B
 
     @property
     def D(self):
-        if self._D is not None and np.all(self.atoms.positions == self._pos_old):
-            return self._D
-        self._calc_internal(gradient=True, curvature=True)
+        if self._D is None or self._cache_version != self._version:
+            self._calc_internal(gradient=True, curvature=True)
         return self._D
+
+
+def _collinear(angles, tol=np.pi / 20):
+    """Indices of the angles within tol of 180 degrees"""
+    return np.flatnonzero(np.pi - angles < tol)
+
+
+def _missing_bonds(bonds, bond_images, angles, angle_images):
+    """Bonds between the terminal atoms of angles that are not in bonds,
+    as (i, j, image) tuples in the format of extra_bonds"""
+    bonded = set(map(tuple, np.column_stack((bonds, bond_images)).tolist()))
+    missing = []
+    images = angle_images.sum(1).tolist()
+    for (a, _, c), image in zip(angles.tolist(), images):
+        bond = (a, c, *image)
+        if bond not in bonded:
+            bonded.add(bond)
+            missing.append((a, c, tuple(image)))
+    return missing
+
+
+def _triple_keys(atoms, first, second):
+    """Rows identifying the atom triples a-b-c together with the images
+    of b and c relative to a, where first is the image of b relative to
+    a and second that of c relative to b. The triple and its reverse
+    c-b-a get the same row."""
+    fwd = np.column_stack((atoms, first, first + second))
+    rev = np.column_stack((atoms[:, ::-1], -second, -first - second))
+    # Keep whichever of the two orders compares lexicographically smaller
+    diff = fwd != rev
+    col = diff.argmax(1)
+    rows = np.arange(len(fwd))
+    use_rev = rev[rows, col] < fwd[rows, col]
+    fwd[use_rev] = rev[use_rev]
+    return fwd
+
+
+def _dihedrals_containing(dihedrals, dihedral_images, angles, angle_images):
+    """Boolean mask of the dihedrals i-j-k-m in which i-j-k or j-k-m is
+    one of angles.
+
+    Atoms are matched together with their periodic images, so in a
+    periodic system only dihedrals running through the same copies of
+    the atoms of an angle are matched, not every dihedral that happens
+    to contain the same atom indices."""
+    result = np.zeros(len(dihedrals), dtype=bool)
+    if len(dihedrals) == 0 or len(angles) == 0:
+        return result
+
+    targets = _triple_keys(angles, angle_images[:, 0], angle_images[:, 1])
+    first = _triple_keys(dihedrals[:, :3], dihedral_images[:, 0],
+                         dihedral_images[:, 1])
+    second = _triple_keys(dihedrals[:, 1:], dihedral_images[:, 1],
+                          dihedral_images[:, 2])
+
+    _, inverse = np.unique(np.vstack((targets, first, second)), axis=0,
+                           return_inverse=True)
+    inverse = inverse.ravel()
+    nt = len(targets)
+    hit = np.isin(inverse[nt:], inverse[:nt])
+    return hit[:len(dihedrals)] | hit[len(dihedrals):]
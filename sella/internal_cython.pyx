@@ -1,13 +1,19 @@
 # cython: language_level=3
 
+import os
+
 import numpy as np
+from scipy.sparse import csr_matrix, coo_matrix
+from scipy.spatial import cKDTree
 from ase import Atoms
+from ase.neighborlist import primitive_neighbor_list
 from ase.data import covalent_radii, vdw_radii
 
 cimport cython
 cimport numpy as np
 from cython.view cimport array
 from cython cimport numeric
+from cython.parallel cimport prange, threadid
 from libc.math cimport sqrt, acos, atan2
 from libc.string cimport memset
 
@@ -26,10 +32,37 @@ cdef double DNTWO = -2.
 # For molecules, this could probably be reduced to 4.
 cdef size_t _MAX_BONDS = 12
 
+# Number of OpenMP threads used by the coordinate and curvature kernels.
+# 0 means "not set": use OMP_NUM_THREADS or the available CPUs.
+cdef int _num_threads = 0
+
+def set_num_threads(int nthreads):
+    """Set the number of threads used by cart_to_internal and GradB.
+    A value < 1 restores the default."""
+    global _num_threads
+    _num_threads = max(nthreads, 0)
+
+def get_num_threads():
+    """Number of threads used by cart_to_internal and GradB"""
+    if _num_threads > 0:
+        return _num_threads
+    env = os.environ.get('OMP_NUM_THREADS', '')
+    if env.isdigit() and int(env) > 0:
+        return int(env)
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def _output_rows(mask):
+    """Output row of each coordinate once masked coordinates are
+    removed, so that coordinates can be evaluated independently"""
+    return np.cumsum(np.asarray(mask, dtype=np.intp)) - 1
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-cdef inline void cross(double[:] x, double[:] y, double[:] z) nogil:
+cdef inline void cross(double[:] x, double[:] y, double[:] z) noexcept nogil:
     z[0] = x[1] * y[2] - y[1] * x[2]
     z[1] = x[2] * y[0] - y[2] * x[0]
     z[2] = x[0] * y[1] - y[0] * x[1]
@@ -37,7 +70,7 @@ cdef inline void cross(double[:] x, double[:] y, double[:] z) nogil:
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-cdef inline void skew(double[:] x, double[:, :] Y, double scale=1.) nogil:
+cdef inline void skew(double[:] x, double[:, :] Y, double scale=1.) noexcept nogil:
     Y[2, 1] = scale * x[0]
     Y[0, 2] = scale * x[1]
     Y[1, 0] = scale * x[2]
@@ -49,7 +82,7 @@ cdef inline void skew(double[:] x, double[:, :] Y, double scale=1.) nogil:
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-cdef inline void symmetrize(double* X, size_t n, size_t lda) nogil:
+cdef inline void symmetrize(double* X, size_t n, size_t lda) noexcept nogil:
     cdef size_t i, j
     for i in range(n):
         for j in range(i + 1, n):
@@ -57,142 +90,320 @@ cdef inline void symmetrize(double* X, size_t n, size_t lda) nogil:
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-@cython.cdivision(True)
-cdef void flood_fill(size_t idx, size_t[:] nbonds, int[:, :] c10y, int[:] labels, size_t label) nogil:
-    cdef size_t i, j
-    for i in range(nbonds[idx]):
-        j = <size_t>c10y[idx, i]
-        if labels[j] != label:
-            labels[j] = label
-            flood_fill(j, nbonds, c10y, labels, label)
+cdef size_t uf_find(size_t[:] parent, size_t i) nogil:
+    """Find the root of the fragment containing atom i, compressing
+    the path along the way"""
+    cdef size_t root = i, tmp
+    while parent[root] != root:
+        root = parent[root]
+    while parent[i] != root:
+        tmp = parent[i]
+        parent[i] = root
+        i = tmp
+    return root
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef bint uf_union(size_t[:] parent, size_t[:] rank, size_t i, size_t j) nogil:
+    """Merge the fragments containing atoms i and j. Returns False if
+    they were already in the same fragment."""
+    i = uf_find(parent, i)
+    j = uf_find(parent, j)
+    if i == j:
+        return False
+    if rank[i] < rank[j]:
+        i, j = j, i
+    parent[j] = i
+    if rank[i] == rank[j]:
+        rank[i] += 1
+    return True
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline int image_sign(int[:] image) nogil:
+    """Sign of the first nonzero component of a periodic image offset"""
+    cdef size_t k
+    for k in range(3):
+        if image[k] > 0:
+            return 1
+        elif image[k] < 0:
+            return -1
+    return 0
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline bint is_zero_image(int[:] a, int[:] b, int sign) nogil:
+    """Whether a + sign * b is the zero image offset"""
+    cdef size_t k
+    for k in range(3):
+        if a[k] + sign * b[k] != 0:
+            return False
+    return True
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef bint add_bond(size_t i, size_t j, int[:] image, int[:, :] c10y,
+                   int[:, :, :] c10y_images, size_t[:] nbonds,
+                   int[:, :] bonds, int[:, :] bond_images,
+                   size_t* nbonds_tot):
+    """Bond atom i to the image of atom j displaced by image (in units
+    of the lattice vectors). Returns False if the bond already exists."""
+    cdef size_t k, tmp
+    cdef int sign = 1
+
+    # Store each bond as (i, j, image) with i <= j, and with the
+    # lexicographically positive image for bonds of an atom to its
+    # own periodic image
+    if i > j or (i == j and image_sign(image) < 0):
+        tmp = i
+        i = j
+        j = tmp
+        sign = -1
+
+    # Make sure they aren't already bonded
+    for k in range(nbonds[i]):
+        if <int>j == c10y[i, k] and is_zero_image(c10y_images[i, k], image, -sign):
+            return False
+
+    assert nbonds[i] < _MAX_BONDS
+    assert nbonds[j] < _MAX_BONDS
+
+    bonds[nbonds_tot[0], 0] = i
+    bonds[nbonds_tot[0], 1] = j
+    for k in range(3):
+        bond_images[nbonds_tot[0], k] = sign * image[k]
+    nbonds_tot[0] += 1
+
+    c10y[i, nbonds[i]] = j
+    for k in range(3):
+        c10y_images[i, nbonds[i], k] = sign * image[k]
+    nbonds[i] += 1
+
+    c10y[j, nbonds[j]] = i
+    for k in range(3):
+        c10y_images[j, nbonds[j], k] = -sign * image[k]
+    nbonds[j] += 1
+    return True
+
+def _neighbor_pairs(object atoms, object tree, double cutoff):
+    """Find all pairs of atoms (i, j) closer than cutoff, including
+    pairs across periodic boundaries. Returns the pairs, the image
+    offsets of j, and the distances. Each pair is returned only once."""
+    if not np.any(atoms.pbc):
+        pairs = tree.query_pairs(cutoff, output_type='ndarray')
+        pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+        dx = atoms.positions[pairs[:, 1]] - atoms.positions[pairs[:, 0]]
+        images = np.zeros((len(pairs), 3), dtype=np.int32)
+        return pairs, images, np.linalg.norm(dx, axis=1)
+
+    i, j, S, d = primitive_neighbor_list('ijSd', atoms.pbc, atoms.cell,
+                                         atoms.positions, cutoff)
+    # primitive_neighbor_list returns both (i, j, S) and (j, i, -S)
+    sign = np.zeros(len(S), dtype=np.int32)
+    for k in range(2, -1, -1):
+        sign = np.where(S[:, k] != 0, np.sign(S[:, k]), sign)
+    keep = (i < j) | ((i == j) & (sign > 0))
+    order = np.lexsort((j[keep], i[keep]))
+    pairs = np.stack((i[keep], j[keep]), axis=1)[order]
+    return pairs, S[keep][order].astype(np.int32), d[keep][order]
 
 def get_internal(object atoms, bint use_angles=True, bint use_dihedrals=True, list add_bonds=None):
     """Find bonding (and optionally angle bend/dihedral) internal
-    coordinates of a molecule.
+    coordinates of a molecule or periodic system.
 
     Arguments:
-    atoms -- ASE Atoms object representing a molecule
+    atoms -- ASE Atoms object
     use_angles -- Include angle bends in internal coordinate search
     use_dihedrals -- Include dihedral angles
+    add_bonds -- Extra bonds, given as (i, j) or (i, j, image) tuples
+
+    Returns the connectivity, the number of bonds of each atom, the
+    bond, angle and dihedral indices, and a tuple of their periodic
+    image offsets. The image offsets have shapes (nbonds, 3),
+    (nangles, 2, 3) and (ndihedrals, 3, 3), one for each displacement
+    vector between consecutive atoms, and are all zero unless atoms
+    has periodic boundary conditions.
     """
-    cdef size_t i, j, k
+    cdef size_t i, j, k, n
     cdef size_t natoms = len(atoms)
 
-    cdef double[:, :] rij = memoryview(atoms.get_all_distances())
-    cdef double[:] rcov = memoryview((1.335 * np.array([covalent_radii[atom.number] for atom in atoms])))
+    rcov_np = 1.335 * np.array([covalent_radii[atom.number] for atom in atoms])
+    cdef double[:] rcov = memoryview(rcov_np)
 
     # c10y == connectivity
     c10y_np = -np.ones((natoms, _MAX_BONDS), dtype=np.int32)
     cdef int[:, :] c10y = memoryview(c10y_np)
+    c10y_images_np = np.zeros((natoms, _MAX_BONDS, 3), dtype=np.int32)
+    cdef int[:, :, :] c10y_images = memoryview(c10y_images_np)
 
     nbonds_np = np.zeros(natoms, dtype=np.uintp)
     cdef size_t[:] nbonds = memoryview(nbonds_np)
 
-    # actual maximum number of bonds per atom
-    cdef size_t max_bonds = 0
-
     cdef size_t nbonds_tot = 0
     bonds_np = -np.ones((_MAX_BONDS * natoms // 2, 2), dtype=np.int32)
     cdef int[:, :] bonds = memoryview(bonds_np)
+    bond_images_np = np.zeros((_MAX_BONDS * natoms // 2, 3), dtype=np.int32)
+    cdef int[:, :] bond_images = memoryview(bond_images_np)
 
+    # Fragments are tracked with a union-find structure that is updated
+    # as bonds are added
     cdef size_t nfrag = natoms
-    fragments_np = -np.ones(natoms, dtype=np.int32)
-    cdef int[:] fragments = memoryview(fragments_np)
+    parent_np = np.arange(natoms, dtype=np.uintp)
+    cdef size_t[:] parent = memoryview(parent_np)
+    rank_np = np.zeros(natoms, dtype=np.uintp)
+    cdef size_t[:] rank = memoryview(rank_np)
+    fragments_np = np.zeros(natoms, dtype=np.uintp)
+    cdef size_t[:] fragments = memoryview(fragments_np)
     cdef double scale = 1.
+    cdef double rmax = 2 * np.max(rcov_np)
+    cdef bint periodic = np.any(atoms.pbc)
 
-    if add_bonds is not None:
-        for i, j in add_bonds:
-            bonds[nbonds_tot, 0] = min(i, j)
-            bonds[nbonds_tot, 1] = max(i, j)
-            nbonds_tot += 1
-
-            c10y[i, nbonds[i]] = j
-            nbonds[i] += 1
-
-            c10y[j, nbonds[j]] = i
-            nbonds[j] += 1
+    cdef int[:] zero_image = np.zeros(3, dtype=np.int32)
+    cdef int[:] image
 
+    if add_bonds is not None:
+        for bond in add_bonds:
+            if len(bond) == 3:
+                image = np.asarray(bond[2], dtype=np.int32)
+            else:
+                image = zero_image
+            if (add_bond(bond[0], bond[1], image, c10y, c10y_images, nbonds,
+                         bonds, bond_images, &nbonds_tot)
+                    and uf_union(parent, rank, bond[0], bond[1])):
+                nfrag -= 1
+
+    # Neighbor search with a k-d tree (or ASE's neighbor list for
+    # periodic systems), which avoids building the dense distance
+    # matrix. The initial pass considers all pairs within the longest
+    # possible bond length.
+    tree = None if periodic else cKDTree(atoms.positions)
+    pairs_np, images_np, dists_np = _neighbor_pairs(atoms, tree, rmax)
+    cdef int[:, :] pairs = memoryview(np.ascontiguousarray(pairs_np, dtype=np.int32))
+    cdef int[:, :] images = memoryview(np.ascontiguousarray(images_np, dtype=np.int32))
+    cdef double[:] dists = memoryview(np.ascontiguousarray(dists_np, dtype=np.float64))
+
+    for n in range(pairs.shape[0]):
+        i = pairs[n, 0]
+        j = pairs[n, 1]
+        if dists[n] <= rcov[i] + rcov[j]:
+            if (add_bond(i, j, images[n], c10y, c10y_images, nbonds, bonds,
+                         bond_images, &nbonds_tot)
+                    and uf_union(parent, rank, i, j)):
+                nfrag -= 1
+
+    # Make sure the graph is fully connected. Fragments only ever merge,
+    # so the pairs between different fragments are searched for once,
+    # within a cutoff that covers several passes, and each pass only
+    # filters them by distance. The search is repeated with a doubled
+    # cutoff if the scale outgrows it.
+    cdef double rcut = 0.
     while nfrag > 1:
-        # FIXME: Implement self-bonding, as this can happen with periodic
-        # boundary conditions and is relevant for angles/dihedrals.
-        for i in range(natoms):
-            for j in range(i + 1, natoms):
-                if fragments[i] == fragments[j] != -1:
-                    continue
-                if rij[i, j] <= scale * (rcov[i] + rcov[j]):
-                    assert nbonds[i] < _MAX_BONDS
-                    assert nbonds[j] < _MAX_BONDS
-
-                    # Make sure they aren't already bonded
-                    for k in range(nbonds[i]):
-                        if j == c10y[i, k]:
-                            break
-                    else:
-                        bonds[nbonds_tot, 0] = i
-                        bonds[nbonds_tot, 1] = j
-
-                        nbonds_tot += 1
-
-                        c10y[i, nbonds[i]] = j
-                        nbonds[i] += 1
-
-                        c10y[j, nbonds[j]] = i
-                        nbonds[j] += 1
-            max_bonds = max(max_bonds, nbonds[i])
-
-        # Traverse the graph to ensure it is fully connected
+        # Fragment labels at the start of this pass
         for i in range(natoms):
-            fragments[i] = -1
-
-        nfrag = 0
-        for i in range(natoms):
-            if fragments[i] == -1:
-                fragments[i] = nfrag
-                flood_fill(i, nbonds, c10y, fragments, nfrag)
-                nfrag += 1
+            fragments[i] = uf_find(parent, i)
 
+        # Increase the bonding cutoff and look for new bonds between
+        # fragments.
         scale *= 1.05
+        if scale * rmax > rcut:
+            rcut = 2 * scale * rmax
+            pairs_np, images_np, dists_np = _neighbor_pairs(atoms, tree, rcut)
+            inter = fragments_np[pairs_np[:, 0]] != fragments_np[pairs_np[:, 1]]
+            pairs = memoryview(np.ascontiguousarray(pairs_np[inter], dtype=np.int32))
+            images = memoryview(np.ascontiguousarray(images_np[inter], dtype=np.int32))
+            dists = memoryview(np.ascontiguousarray(dists_np[inter], dtype=np.float64))
+        for n in range(pairs.shape[0]):
+            i = pairs[n, 0]
+            j = pairs[n, 1]
+            if fragments[i] == fragments[j]:
+                continue
+            if dists[n] <= scale * (rcov[i] + rcov[j]):
+                if (add_bond(i, j, images[n], c10y, c10y_images, nbonds,
+                             bonds, bond_images, &nbonds_tot)
+                        and uf_union(parent, rank, i, j)):
+                    nfrag -= 1
 
     bonds_np = np.resize(bonds_np, (nbonds_tot, 2))
+    bond_images_np = np.resize(bond_images_np, (nbonds_tot, 3))
     assert np.all(bonds_np >= 0)
 
+    cdef size_t jj, kk, m, mm
     cdef size_t nangles_tot = 0
-    # TODO: nbonds_tot**2 is certainly overkill, find a more reasonable
-    # upper bound for the number of angles
+    cdef size_t ndihedrals_tot = 0
+    cdef int[:] t = np.zeros(3, dtype=np.int32)
+
+    # Counting pass, so that the angle and dihedral arrays can be
+    # allocated at their exact size. Each angle (i, j, k) is counted
+    # once per center j, and each dihedral (i, j, k, m) once per
+    # central bond, using the same ordering rules as the loop below.
+    if use_angles:
+        for j in range(natoms):
+            nangles_tot += nbonds[j] * (nbonds[j] - 1) // 2
+    if use_dihedrals:
+        for i in range(natoms):
+            for jj in range(nbonds[i]):
+                j = c10y[i, jj]
+                for kk in range(nbonds[j]):
+                    k = c10y[j, kk]
+                    if k == i and is_zero_image(c10y_images[i, jj], c10y_images[j, kk], 1):
+                        continue
+                    for mm in range(nbonds[k]):
+                        m = c10y[k, mm]
+                        if m == j and is_zero_image(c10y_images[j, kk], c10y_images[k, mm], 1):
+                            continue
+                        if m < i:
+                            continue
+                        if m == i:
+                            for n in range(3):
+                                t[n] = (c10y_images[i, jj, n] + c10y_images[j, kk, n]
+                                        + c10y_images[k, mm, n])
+                            if image_sign(t) <= 0:
+                                continue
+                        ndihedrals_tot += 1
+
     if use_angles:
-        angles_np = -np.ones((nbonds_tot**2, 3), dtype=np.int32)
+        angles_np = -np.ones((nangles_tot, 3), dtype=np.int32)
     else:
         angles_np = np.empty((0, 3), dtype=np.int32)
     cdef int[:, :] angles = memoryview(angles_np)
+    angle_images_np = np.zeros((len(angles_np), 2, 3), dtype=np.int32)
+    cdef int[:, :, :] angle_images = memoryview(angle_images_np)
 
-    cdef size_t ndihedrals_tot = 0
-    # TODO: nbonds_tot**3 is certainly overkill, find a more reasonable
-    # upper bound for the number of dihedrals
     if use_dihedrals:
-        dihedrals_np = -np.ones((nbonds_tot**3, 4), dtype=np.int32)
+        dihedrals_np = -np.ones((ndihedrals_tot, 4), dtype=np.int32)
     else:
         dihedrals_np = np.empty((0, 4), dtype=np.int32)
     cdef int[:, :] dihedrals = memoryview(dihedrals_np)
+    dihedral_images_np = np.zeros((len(dihedrals_np), 3, 3), dtype=np.int32)
+    cdef int[:, :, :] dihedral_images = memoryview(dihedral_images_np)
+
+    images_out = (bond_images_np, angle_images_np, dihedral_images_np)
 
     if not (use_angles or use_dihedrals):
-        return c10y_np, nbonds_np, bonds_np, angles_np, dihedrals_np
+        return c10y_np, nbonds_np, bonds_np, angles_np, dihedrals_np, images_out
 
-    cdef size_t jj, kk, m, mm
+    nangles_tot = 0
+    ndihedrals_tot = 0
 
     for i in range(natoms):
         for jj in range(nbonds[i]):
             j = c10y[i, jj]
             for kk in range(nbonds[j]):
                 k = c10y[j, kk]
-                # (i, j, i) is not a valid angle
-                if k == i:
+                # (i, j, i) is not a valid angle, unless the two i
+                # are different periodic images
+                for n in range(3):
+                    t[n] = c10y_images[i, jj, n] + c10y_images[j, kk, n]
+                if k == i and image_sign(t) == 0:
                     continue
                 # to avoid double-counting angles, only consider triplets
                 # (i, j, k) where k > i
-                elif use_angles and k>i:
+                elif use_angles and (k > i or (k == i and image_sign(t) > 0)):
                     angles[nangles_tot, 0] = i
                     angles[nangles_tot, 1] = j
                     angles[nangles_tot, 2] = k
+                    angle_images[nangles_tot, 0, :] = c10y_images[i, jj, :]
+                    angle_images[nangles_tot, 1, :] = c10y_images[j, kk, :]
                     nangles_tot += 1
                 if not use_dihedrals:
                     continue
@@ -200,258 +411,332 @@ def get_internal(object atoms, bint use_angles=True, bint use_dihedrals=True, li
                     m = c10y[k, mm]
                     # similar to before, only consider quadruplets
                     # (i, j, k, m) where m > i
-                    if m == j or m <= i:
+                    if m == j and is_zero_image(c10y_images[j, kk], c10y_images[k, mm], 1):
                         continue
+                    if m < i:
+                        continue
+                    if m == i:
+                        for n in range(3):
+                            t[n] = (c10y_images[i, jj, n] + c10y_images[j, kk, n]
+                                    + c10y_images[k, mm, n])
+                        if image_sign(t) <= 0:
+                            continue
                     dihedrals[ndihedrals_tot, 0] = i
                     dihedrals[ndihedrals_tot, 1] = j
                     dihedrals[ndihedrals_tot, 2] = k
                     dihedrals[ndihedrals_tot, 3] = m
+                    dihedral_images[ndihedrals_tot, 0, :] = c10y_images[i, jj, :]
+                    dihedral_images[ndihedrals_tot, 1, :] = c10y_images[j, kk, :]
+                    dihedral_images[ndihedrals_tot, 2, :] = c10y_images[k, mm, :]
                     ndihedrals_tot += 1
 
-    angles_np = np.resize(angles_np, (nangles_tot, 3))
+    assert nangles_tot == len(angles_np)
+    assert ndihedrals_tot == len(dihedrals_np)
     assert np.all(angles_np >= 0)
-
-#    if not use_dihedrals:
-#        return c10y_np, nbonds_np, bonds_np, angles_np, None
-
-    dihedrals_np = np.resize(dihedrals_np, (ndihedrals_tot, 4))
     assert np.all(dihedrals_np >= 0)
 
-#    if not use_angles:
-#        return c10y_np, nbonds_np, bonds_np, None, dihedrals_np
-
-    return c10y_np, nbonds_np, bonds_np, angles_np, dihedrals_np
-
-def cart_to_internal(np.ndarray[np.float64_t, ndim=2] pos_np,
-                     np.ndarray[np.int32_t, ndim=2] bonds_np,
-                     np.ndarray[np.int32_t, ndim=2] angles_np,
-                     np.ndarray[np.int32_t, ndim=2] dihedrals_np,
-                     np.ndarray[np.uint8_t, ndim=1] mask_np,
-                     bint gradient=False,
-                     bint curvature=False):
-    cdef double[:, :] pos = memoryview(pos_np)
-    cdef int[:, :] bonds = memoryview(bonds_np)
-    cdef int[:, :] angles = memoryview(angles_np)
-    cdef int[:, :] dihedrals = memoryview(dihedrals_np)
-    cdef np.uint8_t[:] mask = memoryview(mask_np)
-
-    cdef size_t i
-    cdef size_t natoms = len(pos_np)
-    cdef size_t nbonds = len(bonds_np)
-    cdef size_t nangles = len(angles_np)
-    cdef size_t ndihedrals = len(dihedrals_np)
-    cdef size_t ninternal = nbonds + nangles + ndihedrals
-    cdef size_t nmaskb = 0, nmaska = 0, nmaskd = 0, nmasktot = 0
-
-    for i in range(nbonds):
-        nmaskb += 1 - mask[i]
-
-    for i in range(nangles):
-        nmaska += 1 - mask[nbonds + i]
-
-    for i in range(ndihedrals):
-        nmaskd += 1 - mask[nbonds + nangles + i]
-
-    nmasktot = nmaskb + nmaska + nmaskd
-
-    # Arrays for internal coordinates and their derivatives
-    q_np = np.zeros(ninternal - nmasktot, dtype=np.float64)
-    if gradient:
-        dq_np = np.zeros((ninternal - nmasktot, natoms, 3), dtype=np.float64)
-    else:
-        dq_np = np.zeros((ninternal - nmasktot, 0, 0), dtype=np.float64)
-
-    if curvature:
-        d2q_np = np.zeros((ninternal - nmasktot, natoms, 3, natoms, 3), dtype=np.float64)
-    else:
-        d2q_np = np.zeros((ninternal - nmasktot, 0, 0, 0, 0), dtype=np.float64)
-
-    # Arrays for displacement vectors between bonded atoms
-    dx_bonds_np = np.zeros((nbonds, 3), dtype=np.float64)
-    dx_angles_np = np.zeros((nangles, 2, 3), dtype=np.float64)
-    dx_dihedrals_np = np.zeros((ndihedrals, 3, 3), dtype=np.float64)
-
-    cdef double[:, :] dx_bonds = memoryview(dx_bonds_np)
-    cdef double[:, :, :] dx_angles = memoryview(dx_angles_np)
-    cdef double[:, :, :] dx_dihedrals = memoryview(dx_dihedrals_np)
-
-
-    # Calculate displacement vectors
-    for i in range(nbonds):
-        if not mask[i]:
-            continue
-        dcopy(&THREE, &pos[bonds[i, 1], 0], &UNITY, &dx_bonds[i, 0], &UNITY)
-        daxpy(&THREE, &DNUNITY, &pos[bonds[i, 0], 0], &UNITY, &dx_bonds[i, 0], &UNITY)
-
-    for i in range(nangles):
-        if not mask[nbonds + i]:
-            continue
-        dcopy(&THREE, &pos[angles[i, 1], 0], &UNITY, &dx_angles[i, 0, 0], &UNITY)
-        dcopy(&THREE, &pos[angles[i, 2], 0], &UNITY, &dx_angles[i, 1, 0], &UNITY)
+    return c10y_np, nbonds_np, bonds_np, angles_np, dihedrals_np, images_out
 
-        daxpy(&THREE, &DNUNITY, &pos[angles[i, 0], 0], &UNITY, &dx_angles[i, 0, 0], &UNITY)
-        daxpy(&THREE, &DNUNITY, &pos[angles[i, 1], 0], &UNITY, &dx_angles[i, 1, 0], &UNITY)
+@cython.final
+cdef class _Workspace:
+    """Buffers for evaluating a fixed set of internal coordinates at one
+    or more geometries. Everything that only depends on the topology,
+    mask and cell is set up once and reused for every geometry.
 
-    for i in range(ndihedrals):
-        if not mask[nbonds + nangles + i]:
-            continue
-        dcopy(&THREE, &pos[dihedrals[i, 1], 0], &UNITY, &dx_dihedrals[i, 0, 0], &UNITY)
-        dcopy(&THREE, &pos[dihedrals[i, 2], 0], &UNITY, &dx_dihedrals[i, 1, 0], &UNITY)
-        dcopy(&THREE, &pos[dihedrals[i, 3], 0], &UNITY, &dx_dihedrals[i, 2, 0], &UNITY)
-
-        daxpy(&THREE, &DNUNITY, &pos[dihedrals[i, 0], 0], &UNITY, &dx_dihedrals[i, 0, 0], &UNITY)
-        daxpy(&THREE, &DNUNITY, &pos[dihedrals[i, 1], 0], &UNITY, &dx_dihedrals[i, 1, 0], &UNITY)
-        daxpy(&THREE, &DNUNITY, &pos[dihedrals[i, 2], 0], &UNITY, &dx_dihedrals[i, 2, 0], &UNITY)
-
-    cdef size_t n = 0
-
-    cdef double[:] q = memoryview(q_np[n : n+nbonds-nmaskb])
-    cdef double[:, :, :] dq = memoryview(dq_np[n : n+nbonds-nmaskb])
-    cdef double[:, :, :, :, :] d2q = memoryview(d2q_np[n : n+nbonds-nmaskb])
-
-    d2q_bonds_np = np.zeros((nbonds-nmaskb, 2, 3, 2, 3), dtype=np.float64)
-    d2q_angles_np = np.zeros((nangles-nmaska, 3, 3, 3, 3), dtype=np.float64)
-    d2q_dihedrals_np = np.zeros((ndihedrals-nmaskd, 4, 3, 4, 3), dtype=np.float64)
-
-    cdef double[:, :, :, :, :] d2q_bonds = memoryview(d2q_bonds_np)
-    cdef double[:, :, :, :, :] d2q_angles = memoryview(d2q_angles_np)
-    cdef double[:, :, :, :, :] d2q_dihedrals = memoryview(d2q_dihedrals_np)
-
-    cart_to_bond_sparse(bonds, dx_bonds, q, dq, d2q_bonds, mask[:nbonds], gradient, curvature)
-    n += nbonds - nmaskb
-
-    q = memoryview(q_np[n : n+nangles-nmaska])
-    dq = memoryview(dq_np[n : n+nangles-nmaska])
-
-    cart_to_angle_sparse(angles, dx_angles, q, dq, d2q_angles, mask[nbonds:nbonds+nangles], gradient, curvature)
-    n += nangles - nmaska
-
-    q = memoryview(q_np[n : n+ndihedrals-nmaskd])
-    dq = memoryview(dq_np[n : n+ndihedrals-nmaskd])
-
-    cart_to_dihedral_sparse(dihedrals, dx_dihedrals, q, dq, d2q_dihedrals, mask[nbonds+nangles:], gradient, curvature)
-    n += ndihedrals - nmaskd
-
-    D = GradB(natoms, bonds, angles, dihedrals, d2q_bonds, d2q_angles, d2q_dihedrals, mask)
-
-    return q_np, dq_np.reshape((-1, 3 * natoms)), D
+    The kernels are methods so that they reach the buffers through self;
+    passing a dozen memoryviews by value to every call roughly doubles
+    the cost of evaluating q alone."""
+    cdef readonly size_t natoms, nq
+    cdef int nthreads
+    cdef int[:, :] bonds, angles, dihedrals
+    cdef np.uint8_t[:] mask
+    cdef size_t nbonds, nangles, ndihedrals
+    cdef size_t nb, na, nd
+    cdef double[:, :] dx_bonds
+    cdef double[:, :, :] dx_angles, dx_dihedrals
+    cdef readonly tuple indices
+    cdef Py_ssize_t[:] rows_bonds, rows_angles, rows_dihedrals
+    cdef tuple dx, shifts, dq, empty
+    cdef double[:, :] x12_x23
+    cdef double[:, :, :] dq_int, vecs
+    cdef double[:, :, :, :] mats
+    cdef double[:, :, :, :, :] d2q_int
+    cdef double[:, :, :, :, :, :] tensors
+    cdef object flat, inverse, cols, indptr
+
+    # Outputs of the current evaluate() call
+    cdef bint gradient, curvature
+    cdef double[:] q_bonds, q_angles, q_dihedrals
+    cdef double[:, :, :] dq_bonds, dq_angles, dq_dihedrals
+    cdef double[:, :, :, :, :] d2q_bonds, d2q_angles, d2q_dihedrals
+
+    def __cinit__(self, size_t natoms,
+                  np.ndarray[np.int32_t, ndim=2] bonds_np,
+                  np.ndarray[np.int32_t, ndim=2] angles_np,
+                  np.ndarray[np.int32_t, ndim=2] dihedrals_np,
+                  np.ndarray[np.uint8_t, ndim=1] mask_np,
+                  object cell=None,
+                  tuple images=None,
+                  object nthreads=None):
+        self.natoms = natoms
+        self.nthreads = get_num_threads() if nthreads is None else max(nthreads, 1)
+        self.bonds = memoryview(bonds_np)
+        self.angles = memoryview(angles_np)
+        self.dihedrals = memoryview(dihedrals_np)
+        self.mask = memoryview(mask_np)
+
+        self.nbonds = len(bonds_np)
+        self.nangles = len(angles_np)
+        self.ndihedrals = len(dihedrals_np)
+        nba = self.nbonds + self.nangles
+
+        mask = mask_np.astype(bool)
+        self.indices = (bonds_np[mask[:self.nbonds]],
+                        angles_np[mask[self.nbonds:nba]],
+                        dihedrals_np[mask[nba:]])
+        self.nb, self.na, self.nd = [len(idx) for idx in self.indices]
+        self.nq = self.nb + self.na + self.nd
+
+        # Output row of every coordinate, so that the kernels can
+        # evaluate the coordinates independently
+        self.rows_bonds = _output_rows(mask_np[:self.nbonds])
+        self.rows_angles = _output_rows(mask_np[self.nbonds:nba])
+        self.rows_dihedrals = _output_rows(mask_np[nba:])
+
+        # Per-thread scratch space of the angle and dihedral kernels
+        self.x12_x23 = np.zeros((self.nthreads, 3))
+        self.dq_int = np.zeros((self.nthreads, 2, 3))
+        self.d2q_int = np.zeros((self.nthreads, 2, 3, 2, 3))
+        self.vecs = np.zeros((self.nthreads, 4, 3))
+        self.mats = np.zeros((self.nthreads, 3, 3, 3))
+        self.tensors = np.zeros((self.nthreads, 3, 3, 3, 3, 3))
+
+        # Arrays for displacement vectors between bonded atoms
+        self.dx = (np.zeros((self.nbonds, 3), dtype=np.float64),
+                   np.zeros((self.nangles, 2, 3), dtype=np.float64),
+                   np.zeros((self.ndihedrals, 3, 3), dtype=np.float64))
+        self.dx_bonds, self.dx_angles, self.dx_dihedrals = self.dx
+
+        # Periodic image offsets are constant lattice translations, so they
+        # only enter through the displacement vectors
+        if cell is not None and images is not None:
+            cell_np = np.asarray(cell, dtype=np.float64)
+            self.shifts = tuple(image @ cell_np for image in images)
+        else:
+            self.shifts = None
+
+        # First derivatives are calculated as compact per-coordinate blocks,
+        # with one row for each atom involved in the coordinate
+        self.dq = (np.zeros((self.nb, 2, 3), dtype=np.float64),
+                   np.zeros((self.na, 3, 3), dtype=np.float64),
+                   np.zeros((self.nd, 4, 3), dtype=np.float64))
+
+        # Placeholders for derivatives that are not requested
+        self.empty = (np.zeros((0, 2, 3), dtype=np.float64),
+                      np.zeros((0, 3, 3), dtype=np.float64),
+                      np.zeros((0, 4, 3), dtype=np.float64),
+                      np.zeros((0, 2, 3, 2, 3), dtype=np.float64),
+                      np.zeros((0, 3, 3, 3, 3), dtype=np.float64),
+                      np.zeros((0, 4, 3, 4, 3), dtype=np.float64))
+
+        # Sparsity pattern of B, which is the same for every geometry
+        ncart = 3 * natoms
+        counts = np.concatenate([np.full(len(idx), 3 * idx.shape[1]) for idx in self.indices])
+        rows = np.repeat(np.arange(self.nq, dtype=np.int64), counts)
+        self.cols = np.concatenate([_cart_indices(idx).ravel() for idx in self.indices])
+        self.flat = rows * ncart + self.cols
+        self.inverse = None
+        self.indptr = np.zeros(self.nq + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.indptr[1:])
+
+        # An atom can appear more than once in a coordinate through
+        # periodic images, in which case the entries of the blocks are
+        # summed onto the unique (row, column) pairs of B
+        if self.shifts is not None:
+            self.flat, self.inverse = np.unique(self.flat, return_inverse=True)
+            self.cols = self.flat % ncart
+            np.cumsum(np.bincount(self.flat // ncart, minlength=self.nq), out=self.indptr[1:])
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void displacements(self, double[:, :] pos):
+        cdef size_t i
+        cdef size_t nbonds = self.nbonds, nangles = self.nangles
+        cdef int[:, :] bonds = self.bonds, angles = self.angles, dihedrals = self.dihedrals
+        cdef double[:, :] dx_bonds = self.dx_bonds
+        cdef double[:, :, :] dx_angles = self.dx_angles, dx_dihedrals = self.dx_dihedrals
+
+        for i in range(nbonds):
+            if not self.mask[i]:
+                continue
+            dcopy(&THREE, &pos[bonds[i, 1], 0], &UNITY, &dx_bonds[i, 0], &UNITY)
+            daxpy(&THREE, &DNUNITY, &pos[bonds[i, 0], 0], &UNITY, &dx_bonds[i, 0], &UNITY)
 
-@cython.boundscheck(False)
-@cython.wraparound(False)
-@cython.cdivision(True)
-cdef void cart_to_bond_sparse(int[:, :] bonds,
-                              double[:, :] dx,
-                              double[:] q,
-                              double[:, :, :] dq,
-                              double[:, :, :, :, :] d2q,
-                              np.uint8_t[:] mask,
-                              bint gradient=False,
-                              bint curvature=False):
-    cdef size_t nbonds = len(bonds)
-
-    cdef size_t i, a1, a2, n = 0
-    cdef double tmp
-    cdef int sd_dx = dx.strides[1] // 8    # == 1 normally
-    cdef int sd_dq = dq.strides[2] // 8   # == 1 normally
-    cdef int sd_d2q = d2q.strides[2] // 8 # == 6? normally
-    cdef int info
-
-    for i in range(nbonds):
-        if not mask[i]:
-            continue
-        a1 = bonds[i, 0]
-        a2 = bonds[i, 1]
-
-        q[n] = dnrm2(&THREE, &dx[i, 0], &sd_dx)
-
-        if not (gradient or curvature):
-            n += 1
-            continue
-
-        tmp = 1 / q[n]
-        daxpy(&THREE, &tmp, &dx[i, 0], &sd_dx, &dq[n, a2, 0], &sd_dq)
-        daxpy(&THREE, &DNUNITY, &dq[n, a2, 0], &sd_dq, &dq[n, a1, 0], &sd_dq)
-
-        if not curvature:
-            n += 1
-            continue
-
-        dlaset('G', &THREE, &THREE, &DZERO, &tmp, &d2q[n, 0, 0, 0, 0], &sd_d2q)
-
-        tmp /= -q[i] * q[i]
-        dger(&THREE, &THREE, &tmp, &dx[i, 0], &sd_dx, &dx[i, 0], &sd_dx, &d2q[n, 0, 0, 0, 0], &sd_d2q)
-        dlacpy('G', &THREE, &THREE, &d2q[n, 0, 0, 0, 0], &sd_d2q, &d2q[n, 1, 0, 1, 0], &sd_d2q)
-
-        dlacpy('G', &THREE, &THREE, &d2q[n, 0, 0, 0, 0], &sd_d2q, &d2q[n, 0, 0, 1, 0], &sd_d2q)
-        dlascl('G', &UNITY, &UNITY, &DUNITY, &DNUNITY, &THREE, &THREE, &d2q[n, 0, 0, 1, 0], &sd_d2q, &info)
-        dlacpy('G', &THREE, &THREE, &d2q[n, 0, 0, 1, 0], &sd_d2q, &d2q[n, 1, 0, 0, 0], &sd_d2q)
-        n += 1
+        for i in range(nangles):
+            if not self.mask[nbonds + i]:
+                continue
+            dcopy(&THREE, &pos[angles[i, 1], 0], &UNITY, &dx_angles[i, 0, 0], &UNITY)
+            dcopy(&THREE, &pos[angles[i, 2], 0], &UNITY, &dx_angles[i, 1, 0], &UNITY)
 
-@cython.boundscheck(False)
-@cython.wraparound(False)
-@cython.cdivision(True)
-cdef void cart_to_angle_sparse(int[:, :] angles,
-                               double[:, :, :] dx,
-                               double[:] q,
-                               double[:, :, :] dq,
-                               double[:, :, :, :, :] d2q,
-                               np.uint8_t[:] mask,
-                               bint gradient=False,
-                               bint curvature=False):
-    cdef size_t nangles = len(angles)
-
-    cdef double[:] x12, x23
-    cdef double[:] x12_x23 = array(shape=(3,), itemsize=sizeof(double), format="d")
+            daxpy(&THREE, &DNUNITY, &pos[angles[i, 0], 0], &UNITY, &dx_angles[i, 0, 0], &UNITY)
+            daxpy(&THREE, &DNUNITY, &pos[angles[i, 1], 0], &UNITY, &dx_angles[i, 1, 0], &UNITY)
 
-    cdef size_t i, j, k, n
-    cdef size_t a1, a2, a3
-    cdef double tmp1, tmp2, tmp3, tmp4
-    cdef double r12, r23, r122, r232, r12x23, r12d23
-
-    cdef double[:, :] dq_int = array(shape=(2, 3), itemsize=sizeof(double), format="d")
-
-    cdef double[:, :, :, :] d2q_int = array(shape=(2, 3, 2, 3), itemsize=sizeof(double), format="d")
-
-    cdef int sd_dx = dx.strides[2] // 8
-    cdef int sd_dq = dq.strides[2] // 8
-    cdef int sd_d2q = d2q.strides[2] // 8
-    cdef int sd_d2int = d2q_int.strides[1] // 8
-
-    # The standard way of calculating the angle between two vectors
-    # a and b is arccos((a.b)/(|a| |b|)). Here, we use a different
-    # approach that depends on the relation |sin q| = |a| |b| |axb|.
-    # Rather than using arccos (or arcsin), we use arctan2(|axb|, (a.b)).
-    # This is primarily because the curvature becomes easier to evaluate
-    # (perhaps somewhat counterintuitively). arctan2 is also *somewhat*
-    # more accurate than arccos, though this is probably negligable.
-    
-    n = 0
-    for i in range(nangles):
-        if not mask[i]:
-            continue
-        a1 = angles[i, 0]
-        a2 = angles[i, 1]
-        a3 = angles[i, 2]
-
-        x12 = dx[i, 0]
-        x23 = dx[i, 1]
+        for i in range(self.ndihedrals):
+            if not self.mask[nbonds + nangles + i]:
+                continue
+            dcopy(&THREE, &pos[dihedrals[i, 1], 0], &UNITY, &dx_dihedrals[i, 0, 0], &UNITY)
+            dcopy(&THREE, &pos[dihedrals[i, 2], 0], &UNITY, &dx_dihedrals[i, 1, 0], &UNITY)
+            dcopy(&THREE, &pos[dihedrals[i, 3], 0], &UNITY, &dx_dihedrals[i, 2, 0], &UNITY)
+
+            daxpy(&THREE, &DNUNITY, &pos[dihedrals[i, 0], 0], &UNITY, &dx_dihedrals[i, 0, 0], &UNITY)
+            daxpy(&THREE, &DNUNITY, &pos[dihedrals[i, 1], 0], &UNITY, &dx_dihedrals[i, 1, 0], &UNITY)
+            daxpy(&THREE, &DNUNITY, &pos[dihedrals[i, 2], 0], &UNITY, &dx_dihedrals[i, 2, 0], &UNITY)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def evaluate(self, np.ndarray[np.float64_t, ndim=2] pos_np,
+                 np.ndarray[np.float64_t, ndim=1] q_np,
+                 bint gradient=False, bint curvature=False):
+        """Write the internal coordinates at pos_np to q_np. The first
+        derivatives are left in the workspace, see B(). Returns the
+        GradB object holding the second derivatives."""
+        cdef Py_ssize_t i
+        cdef int tid
+        cdef size_t nb = self.nb, na = self.na
+        cdef size_t nbonds = self.nbonds, nba = self.nbonds + self.nangles
+        cdef int nthreads = self.nthreads
+        cdef np.uint8_t[:] mask = self.mask
+        cdef Py_ssize_t[:] rows_bonds = self.rows_bonds
+        cdef Py_ssize_t[:] rows_angles = self.rows_angles
+        cdef Py_ssize_t[:] rows_dihedrals = self.rows_dihedrals
+
+        self.displacements(memoryview(pos_np))
+        if self.shifts is not None:
+            for dx, shift in zip(self.dx, self.shifts):
+                dx += shift
+
+        self.gradient = gradient
+        self.curvature = curvature
+        self.q_bonds = q_np[:nb]
+        self.q_angles = q_np[nb:nb+na]
+        self.q_dihedrals = q_np[nb+na:]
+
+        # The kernels accumulate into the first derivative blocks
+        if gradient or curvature:
+            for dq in self.dq:
+                dq.fill(0.)
+            self.dq_bonds, self.dq_angles, self.dq_dihedrals = self.dq
+        else:
+            self.dq_bonds, self.dq_angles, self.dq_dihedrals = self.empty[:3]
+
+        # The second derivatives end up in the returned GradB object,
+        # so they cannot be shared between geometries
+        if curvature:
+            self.d2q_bonds = np.zeros((nb, 2, 3, 2, 3), dtype=np.float64)
+            self.d2q_angles = np.zeros((na, 3, 3, 3, 3), dtype=np.float64)
+            self.d2q_dihedrals = np.zeros((self.nd, 4, 3, 4, 3), dtype=np.float64)
+        else:
+            self.d2q_bonds, self.d2q_angles, self.d2q_dihedrals = self.empty[3:]
+
+        for i in prange(nbonds, nogil=True, num_threads=nthreads, schedule='static'):
+            if mask[i]:
+                self.bond(i, rows_bonds[i])
+
+        for i in prange(self.nangles, nogil=True, num_threads=nthreads, schedule='static'):
+            if mask[nbonds + i]:
+                tid = threadid()
+                self.angle(i, rows_angles[i], tid)
+
+        for i in prange(self.ndihedrals, nogil=True, num_threads=nthreads, schedule='static'):
+            if mask[nba + i]:
+                tid = threadid()
+                self.dihedral(i, rows_dihedrals[i], tid)
+
+        return GradB(self.natoms, self.bonds, self.angles, self.dihedrals,
+                     self.d2q_bonds, self.d2q_angles, self.d2q_dihedrals, mask,
+                     nthreads)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    cdef void bond(self, size_t i, size_t n) noexcept nogil:
+        """Value and derivatives of bond i, written to row n of the output"""
+        cdef double tmp
+        cdef int sd_dx = self.dx_bonds.strides[1] // 8    # == 1 normally
+        cdef int sd_dq = self.dq_bonds.strides[2] // 8   # == 1 normally
+        cdef int sd_d2q = self.d2q_bonds.strides[2] // 8 # == 6? normally
+        cdef int info
+
+        self.q_bonds[n] = dnrm2(&THREE, &self.dx_bonds[i, 0], &sd_dx)
+
+        if not (self.gradient or self.curvature):
+            return
+
+        tmp = 1 / self.q_bonds[n]
+        daxpy(&THREE, &tmp, &self.dx_bonds[i, 0], &sd_dx, &self.dq_bonds[n, 1, 0], &sd_dq)
+        daxpy(&THREE, &DNUNITY, &self.dq_bonds[n, 1, 0], &sd_dq, &self.dq_bonds[n, 0, 0], &sd_dq)
+
+        if not self.curvature:
+            return
+
+        dlaset('G', &THREE, &THREE, &DZERO, &tmp, &self.d2q_bonds[n, 0, 0, 0, 0], &sd_d2q)
+
+        tmp /= -self.q_bonds[n] * self.q_bonds[n]
+        dger(&THREE, &THREE, &tmp, &self.dx_bonds[i, 0], &sd_dx, &self.dx_bonds[i, 0], &sd_dx, &self.d2q_bonds[n, 0, 0, 0, 0], &sd_d2q)
+        dlacpy('G', &THREE, &THREE, &self.d2q_bonds[n, 0, 0, 0, 0], &sd_d2q, &self.d2q_bonds[n, 1, 0, 1, 0], &sd_d2q)
+
+        dlacpy('G', &THREE, &THREE, &self.d2q_bonds[n, 0, 0, 0, 0], &sd_d2q, &self.d2q_bonds[n, 0, 0, 1, 0], &sd_d2q)
+        dlascl('G', &UNITY, &UNITY, &DUNITY, &DNUNITY, &THREE, &THREE, &self.d2q_bonds[n, 0, 0, 1, 0], &sd_d2q, &info)
+        dlacpy('G', &THREE, &THREE, &self.d2q_bonds[n, 0, 0, 1, 0], &sd_d2q, &self.d2q_bonds[n, 1, 0, 0, 0], &sd_d2q)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    cdef void angle(self, size_t i, size_t n, int tid) noexcept nogil:
+        """Value and derivatives of angle i, written to row n of the output.
+        Row tid of the scratch arrays belongs to the calling thread."""
+        cdef double[:] x12, x23
+        cdef double[:] x12_x23 = self.x12_x23[tid]
+        cdef double[:, :] dq_int
+        cdef double[:, :, :, :] d2q_int
+
+        cdef size_t j, k
+        cdef double tmp1, tmp2, tmp3, tmp4
+        cdef double r12, r23, r122, r232, r12x23, r12d23
+
+        cdef int sd_dx = self.dx_angles.strides[2] // 8
+        cdef int sd_dq = self.dq_angles.strides[2] // 8
+        cdef int sd_d2q = self.d2q_angles.strides[2] // 8
+        cdef int sd_d2int
+
+        # The standard way of calculating the angle between two vectors
+        # a and b is arccos((a.b)/(|a| |b|)). Here, we use a different
+        # approach that depends on the relation |sin q| = |a| |b| |axb|.
+        # Rather than using arccos (or arcsin), we use arctan2(|axb|, (a.b)).
+        # This is primarily because the curvature becomes easier to evaluate
+        # (perhaps somewhat counterintuitively). arctan2 is also *somewhat*
+        # more accurate than arccos, though this is probably negligable.
+
+
+        x12 = self.dx_angles[i, 0]
+        x23 = self.dx_angles[i, 1]
 
         r12d23 = ddot(&THREE, &x12[0], &sd_dx, &x23[0], &sd_dx)
 
         cross(x12, x23, x12_x23)
         r12x23 = dnrm2(&THREE, &x12_x23[0], &UNITY)
 
-        q[n] = atan2(r12x23, -r12d23)
+        self.q_angles[n] = atan2(r12x23, -r12d23)
 
-        if not (gradient or curvature):
-            n += 1
-            continue
+        if not (self.gradient or self.curvature):
+            return
 
         r12 = dnrm2(&THREE, &x12[0], &sd_dx)
         r23 = dnrm2(&THREE, &x23[0], &sd_dx)
 
         r122 = r12 * r12
         r232 = r23 * r23
+        dq_int = self.dq_int[tid]
         memset(&dq_int[0, 0,], 0, 6 * sizeof(double))
 
         tmp1 = -r12d23 / (r122 * r12x23)
@@ -463,16 +748,17 @@ cdef void cart_to_angle_sparse(int[:, :] angles,
         daxpy(&THREE, &tmp1, &x23[0], &sd_dx, &dq_int[1, 0], &UNITY)
         daxpy(&THREE, &tmp2, &x12[0], &sd_dx, &dq_int[1, 0], &UNITY)
 
-        dcopy(&THREE, &dq_int[0, 0], &UNITY, &dq[n, a2, 0], &sd_dq)
-        dcopy(&THREE, &dq_int[1, 0], &UNITY, &dq[n, a3, 0], &sd_dq)
+        dcopy(&THREE, &dq_int[0, 0], &UNITY, &self.dq_angles[n, 1, 0], &sd_dq)
+        dcopy(&THREE, &dq_int[1, 0], &UNITY, &self.dq_angles[n, 2, 0], &sd_dq)
 
-        daxpy(&THREE, &DNUNITY, &dq_int[0, 0], &UNITY, &dq[n, a1, 0], &sd_dq)
-        daxpy(&THREE, &DNUNITY, &dq_int[1, 0], &UNITY, &dq[n, a2, 0], &sd_dq)
+        daxpy(&THREE, &DNUNITY, &dq_int[0, 0], &UNITY, &self.dq_angles[n, 0, 0], &sd_dq)
+        daxpy(&THREE, &DNUNITY, &dq_int[1, 0], &UNITY, &self.dq_angles[n, 1, 0], &sd_dq)
 
 
-        if not curvature:
-            n += 1
-            continue
+        if not self.curvature:
+            return
+        d2q_int = self.d2q_int[tid]
+        sd_d2int = d2q_int.strides[1] // 8
         memset(&d2q_int[0, 0, 0, 0], 0, 36 * sizeof(double))
 
 
@@ -506,78 +792,57 @@ cdef void cart_to_angle_sparse(int[:, :] angles,
 
         for j in range(3):
             for k in range(j, 3):
-                d2q[n, 0, j, 0, k] = d2q[n, 0, k, 0, j] = d2q_int[0, j, 0, k]
-                d2q[n, 1, j, 1, k] = d2q[n, 1, k, 1, j] = d2q_int[1, j, 1, k] + d2q_int[0, j, 0, k] - d2q_int[0, k, 1, j] - d2q_int[0, j, 1, k]
-                d2q[n, 2, j, 2, k] = d2q[n, 2, k, 2, j] = d2q_int[1, j, 1, k]
+                self.d2q_angles[n, 0, j, 0, k] = self.d2q_angles[n, 0, k, 0, j] = d2q_int[0, j, 0, k]
+                self.d2q_angles[n, 1, j, 1, k] = self.d2q_angles[n, 1, k, 1, j] = d2q_int[1, j, 1, k] + d2q_int[0, j, 0, k] - d2q_int[0, k, 1, j] - d2q_int[0, j, 1, k]
+                self.d2q_angles[n, 2, j, 2, k] = self.d2q_angles[n, 2, k, 2, j] = d2q_int[1, j, 1, k]
             for k in range(3):
-                d2q[n, 0, j, 1, k] = d2q[n, 1, k, 0, j] = d2q_int[0, j, 1, k] - d2q_int[0, j, 0, k]
-                d2q[n, 0, j, 2, k] = d2q[n, 2, k, 0, j] = -d2q_int[0, j, 1, k]
+                self.d2q_angles[n, 0, j, 1, k] = self.d2q_angles[n, 1, k, 0, j] = d2q_int[0, j, 1, k] - d2q_int[0, j, 0, k]
+                self.d2q_angles[n, 0, j, 2, k] = self.d2q_angles[n, 2, k, 0, j] = -d2q_int[0, j, 1, k]
 
-                d2q[n, 1, j, 2, k] = d2q[n, 2, k, 1, j] = d2q_int[0, j, 1, k] - d2q_int[1, j, 1, k]
-        n += 1
+                self.d2q_angles[n, 1, j, 2, k] = self.d2q_angles[n, 2, k, 1, j] = d2q_int[0, j, 1, k] - d2q_int[1, j, 1, k]
 
-@cython.boundscheck(False)
-@cython.wraparound(False)
-@cython.cdivision(True)
-cdef void cart_to_dihedral_sparse(int[:, :] dihedrals,
-                                  double[:, :, :] dx,
-                                  double[:] q,
-                                  double[:, :, :] dq,
-                                  double[:, :, :, :, :] d2q,
-                                  np.uint8_t[:] mask,
-                                  bint gradient=False,
-                                  bint curvature=False):
-    cdef size_t ndihedrals = len(dihedrals)
-
-    cdef double[:] x12, x23, x34
-
-    cdef int NINE = 9
-    cdef int TWELVE = 12
-    cdef int EIGHTYONE = 81
-
-    # Arrays needed for q
-    cdef double[:] x12_x23 = array(shape=(3,), itemsize=sizeof(double), format="d")
-    cdef double[:] x23_x34 = array(shape=(3,), itemsize=sizeof(double), format="d")
-    cdef double[:] tmpar1 = array(shape=(3,), itemsize=sizeof(double), format="d")
-
-    # Arrays needed for dq
-    cdef double[:] x12_x34 = array(shape=(3,), itemsize=sizeof(double), format="d")
-    cdef double[:, :] dnumer = array(shape=(3, 3), itemsize=sizeof(double), format="d")
-    cdef double[:, :] ddenom = array(shape=(3, 3), itemsize=sizeof(double), format="d")
-    cdef double[:, :] dq_int = array(shape=(3, 3), itemsize=sizeof(double), format="d")
-
-    # Arrays needed for d2q
-    cdef double[:, :, :, :] d2numer = array(shape=(3, 3, 3, 3), itemsize=sizeof(double), format="d")
-    cdef double[:, :, :, :] d2denom = array(shape=(3, 3, 3, 3), itemsize=sizeof(double), format="d")
-    cdef double[:, :, :, :] d2q_int = array(shape=(3, 3, 3, 3), itemsize=sizeof(double), format="d")
-
-    cdef double numer, denom
-
-    cdef size_t i, j, k, m, n
-    cdef size_t a1, a2, a3, a4
-    cdef double tmp1, tmp2, tmp3, tmp4, tmp5
-    cdef double r12, r23, r34
-
-    cdef double r122, r232
-
-    cdef int sd_dx = dx.strides[2] // 8
-    cdef int sd_dq = dq.strides[2] // 8
-    cdef int sd_d2q = d2q.strides[2] // 8
-
-    cdef int sd_d2int = d2numer.strides[1] // 8
-
-    n = 0
-    for i in range(ndihedrals):
-        if not mask[i]:
-            continue
-        a1 = dihedrals[i, 0]
-        a2 = dihedrals[i, 1]
-        a3 = dihedrals[i, 2]
-        a4 = dihedrals[i, 3]
-
-        x12 = dx[i, 0]
-        x23 = dx[i, 1]
-        x34 = dx[i, 2]
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    cdef void dihedral(self, size_t i, size_t n, int tid) noexcept nogil:
+        """Value and derivatives of dihedral i, written to row n of the
+        output. Row tid of the scratch arrays belongs to the calling thread."""
+        cdef double[:] x12, x23, x34
+
+        cdef int NINE = 9
+        cdef int TWELVE = 12
+        cdef int EIGHTYONE = 81
+
+        # Arrays needed for q
+        cdef double[:] x12_x23 = self.vecs[tid, 0]
+        cdef double[:] x23_x34 = self.vecs[tid, 1]
+        cdef double[:] tmpar1 = self.vecs[tid, 2]
+
+        # Arrays needed for dq
+        cdef double[:] x12_x34
+        cdef double[:, :] dnumer, ddenom, dq_int
+
+        # Arrays needed for d2q
+        cdef double[:, :, :, :] d2numer, d2denom, d2q_int
+
+        cdef double numer, denom
+
+        cdef size_t j, k
+        cdef double tmp1, tmp2, tmp3, tmp4, tmp5
+        cdef double r12, r23, r34
+
+        cdef double r122, r232
+
+        cdef int sd_dx = self.dx_dihedrals.strides[2] // 8
+        cdef int sd_dq = self.dq_dihedrals.strides[2] // 8
+        cdef int sd_d2q = self.d2q_dihedrals.strides[2] // 8
+
+        cdef int sd_d2int
+
+
+        x12 = self.dx_dihedrals[i, 0]
+        x23 = self.dx_dihedrals[i, 1]
+        x34 = self.dx_dihedrals[i, 2]
 
         r23 = dnrm2(&THREE, &x23[0], &sd_dx)
         cross(x12, x23, x12_x23)
@@ -585,12 +850,15 @@ cdef void cart_to_dihedral_sparse(int[:, :] dihedrals,
         cross(x12_x23, x23_x34, tmpar1)
         numer = ddot(&THREE, &tmpar1[0], &UNITY, &x23[0], &sd_dx) / r23
         denom = ddot(&THREE, &x12_x23[0], &UNITY, &x23_x34[0], &UNITY)
-        q[n] = atan2(numer, denom)
+        self.q_dihedrals[n] = atan2(numer, denom)
 
-        if not (gradient or curvature):
-            n += 1
-            continue
+        if not (self.gradient or self.curvature):
+            return
 
+        x12_x34 = self.vecs[tid, 3]
+        dnumer = self.mats[tid, 0]
+        ddenom = self.mats[tid, 1]
+        dq_int = self.mats[tid, 2]
         cross(x12, x34, x12_x34)
 
         # Derivative of denominator
@@ -620,17 +888,21 @@ cdef void cart_to_dihedral_sparse(int[:, :] dihedrals,
             daxpy(&THREE, &tmp2, &dnumer[j, 0], &UNITY, &dq_int[j, 0], &UNITY)
             daxpy(&THREE, &tmp3, &ddenom[j, 0], &UNITY, &dq_int[j, 0], &UNITY)
 
-        dcopy(&THREE, &dq_int[0, 0], &UNITY, &dq[n, a1, 0], &sd_dq)
-        dcopy(&THREE, &dq_int[1, 0], &UNITY, &dq[n, a2, 0], &sd_dq)
-        dcopy(&THREE, &dq_int[2, 0], &UNITY, &dq[n, a3, 0], &sd_dq)
+        dcopy(&THREE, &dq_int[0, 0], &UNITY, &self.dq_dihedrals[n, 0, 0], &sd_dq)
+        dcopy(&THREE, &dq_int[1, 0], &UNITY, &self.dq_dihedrals[n, 1, 0], &sd_dq)
+        dcopy(&THREE, &dq_int[2, 0], &UNITY, &self.dq_dihedrals[n, 2, 0], &sd_dq)
 
-        daxpy(&THREE, &DNUNITY, &dq_int[0, 0], &UNITY, &dq[n, a2, 0], &sd_dq)
-        daxpy(&THREE, &DNUNITY, &dq_int[1, 0], &UNITY, &dq[n, a3, 0], &sd_dq)
-        daxpy(&THREE, &DNUNITY, &dq_int[2, 0], &UNITY, &dq[n, a4, 0], &sd_dq)
+        daxpy(&THREE, &DNUNITY, &dq_int[0, 0], &UNITY, &self.dq_dihedrals[n, 1, 0], &sd_dq)
+        daxpy(&THREE, &DNUNITY, &dq_int[1, 0], &UNITY, &self.dq_dihedrals[n, 2, 0], &sd_dq)
+        daxpy(&THREE, &DNUNITY, &dq_int[2, 0], &UNITY, &self.dq_dihedrals[n, 3, 0], &sd_dq)
 
-        if not curvature:
-            n += 1
-            continue
+        if not self.curvature:
+            return
+
+        d2numer = self.tensors[tid, 0]
+        d2denom = self.tensors[tid, 1]
+        d2q_int = self.tensors[tid, 2]
+        sd_d2int = d2numer.strides[1] // 8
 
         # Second derivative of denominator
         memset(&d2denom[0, 0, 0, 0], 0, 81 * sizeof(double))
@@ -689,23 +961,132 @@ cdef void cart_to_dihedral_sparse(int[:, :] dihedrals,
 
         for j in range(3):
             for k in range(j, 3):
-                d2q[n, 0, j, 0, k] = d2q[n, 0, k, 0, j] = d2q_int[0, j, 0, k]
-                d2q[n, 1, j, 1, k] = d2q[n, 1, k, 1, j] = d2q_int[1, j, 1, k] + d2q_int[0, j, 0, k] - d2q_int[0, k, 1, j] - d2q_int[0, j, 1, k]
-                d2q[n, 2, j, 2, k] = d2q[n, 2, k, 2, j] = d2q_int[2, j, 2, k] + d2q_int[1, j, 1, k] - d2q_int[1, j, 2, k] - d2q_int[1, k, 2, j]
-                d2q[n, 3, j, 3, k] = d2q[n, 3, k, 3, j] = d2q_int[2, j, 2, k]
+                self.d2q_dihedrals[n, 0, j, 0, k] = self.d2q_dihedrals[n, 0, k, 0, j] = d2q_int[0, j, 0, k]
+                self.d2q_dihedrals[n, 1, j, 1, k] = self.d2q_dihedrals[n, 1, k, 1, j] = d2q_int[1, j, 1, k] + d2q_int[0, j, 0, k] - d2q_int[0, k, 1, j] - d2q_int[0, j, 1, k]
+                self.d2q_dihedrals[n, 2, j, 2, k] = self.d2q_dihedrals[n, 2, k, 2, j] = d2q_int[2, j, 2, k] + d2q_int[1, j, 1, k] - d2q_int[1, j, 2, k] - d2q_int[1, k, 2, j]
+                self.d2q_dihedrals[n, 3, j, 3, k] = self.d2q_dihedrals[n, 3, k, 3, j] = d2q_int[2, j, 2, k]
             for k in range(3):
-                d2q[n, 0, j, 1, k] = d2q[n, 1, k, 0, j] = d2q_int[0, j, 1, k] - d2q_int[0, j, 0, k]
-                d2q[n, 0, j, 2, k] = d2q[n, 2, k, 0, j] = d2q_int[0, j, 2, k] - d2q_int[0, j, 1, k]
-                d2q[n, 0, j, 3, k] = d2q[n, 3, k, 0, j] = -d2q_int[0, j, 2, k]
+                self.d2q_dihedrals[n, 0, j, 1, k] = self.d2q_dihedrals[n, 1, k, 0, j] = d2q_int[0, j, 1, k] - d2q_int[0, j, 0, k]
+                self.d2q_dihedrals[n, 0, j, 2, k] = self.d2q_dihedrals[n, 2, k, 0, j] = d2q_int[0, j, 2, k] - d2q_int[0, j, 1, k]
+                self.d2q_dihedrals[n, 0, j, 3, k] = self.d2q_dihedrals[n, 3, k, 0, j] = -d2q_int[0, j, 2, k]
+
+                self.d2q_dihedrals[n, 1, j, 2, k] = self.d2q_dihedrals[n, 2, k, 1, j] = d2q_int[1, j, 2, k] + d2q_int[0, j, 1, k] - d2q_int[1, j, 1, k] - d2q_int[0, j, 2, k]
+                self.d2q_dihedrals[n, 1, j, 3, k] = self.d2q_dihedrals[n, 3, k, 1, j] = d2q_int[0, j, 2, k] - d2q_int[1, j, 2, k]
+
+                self.d2q_dihedrals[n, 2, j, 3, k] = self.d2q_dihedrals[n, 3, k, 2, j] = d2q_int[1, j, 2, k] - d2q_int[2, j, 2, k]
+
+    def _B_data(self):
+        data = np.concatenate([dq.ravel() for dq in self.dq])
+        if self.inverse is None:
+            return data
+        return np.bincount(self.inverse.ravel(), weights=data, minlength=len(self.flat))
+
+    def B(self, out=None):
+        """First derivatives from the last evaluate(), as a CSR matrix,
+        or written to the zeroed dense array out if given"""
+        if out is not None:
+            out.reshape(-1)[self.flat] = self._B_data()
+            return out
+        return csr_matrix((self._B_data(), self.cols, self.indptr),
+                          shape=(self.nq, 3 * self.natoms))
+
+def cart_to_internal(np.ndarray[np.float64_t, ndim=2] pos_np,
+                     np.ndarray[np.int32_t, ndim=2] bonds_np,
+                     np.ndarray[np.int32_t, ndim=2] angles_np,
+                     np.ndarray[np.int32_t, ndim=2] dihedrals_np,
+                     np.ndarray[np.uint8_t, ndim=1] mask_np,
+                     bint gradient=False,
+                     bint curvature=False,
+                     object cell=None,
+                     tuple images=None,
+                     bint sparse=False,
+                     object nthreads=None):
+    """Calculate internal coordinates and (optionally) their first and
+    second derivatives with respect to the Cartesian coordinates.
+
+    For periodic systems, cell and the image offsets returned by
+    get_internal must be provided. The displacement vector between
+    two atoms then includes the lattice vectors given by the offsets.
+
+    The first derivatives (B) are returned as a dense array, or as a
+    scipy.sparse CSR matrix if sparse is True. Each internal coordinate
+    involves at most 4 atoms, so B has at most 12 nonzeros per row.
+    The second derivatives are stored as compact per-coordinate blocks
+    in the returned GradB object.
+
+    The coordinates are evaluated in parallel with nthreads OpenMP
+    threads, defaulting to get_num_threads(). The products with the
+    second derivatives (GradB.ddot and GradB.ldot) use the same number
+    of threads.
+    """
+    cdef size_t natoms = len(pos_np)
+    ws = _Workspace(natoms, bonds_np, angles_np, dihedrals_np, mask_np,
+                    cell, images, nthreads)
+    q_np = np.zeros(ws.nq, dtype=np.float64)
+    D = ws.evaluate(pos_np, q_np, gradient, curvature)
+
+    if not gradient:
+        if sparse:
+            return q_np, csr_matrix((len(q_np), 3 * natoms)), D
+        return q_np, np.zeros((len(q_np), 0), dtype=np.float64), D
+
+    if sparse:
+        return q_np, ws.B(), D
+    return q_np, ws.B(np.zeros((ws.nq, 3 * natoms), dtype=np.float64)), D
+
+def cart_to_internal_batch(np.ndarray[np.float64_t, ndim=3] pos_np,
+                           np.ndarray[np.int32_t, ndim=2] bonds_np,
+                           np.ndarray[np.int32_t, ndim=2] angles_np,
+                           np.ndarray[np.int32_t, ndim=2] dihedrals_np,
+                           np.ndarray[np.uint8_t, ndim=1] mask_np,
+                           bint gradient=False,
+                           bint curvature=False,
+                           object cell=None,
+                           tuple images=None,
+                           bint sparse=False,
+                           object nthreads=None):
+    """cart_to_internal for a stack of geometries of shape
+    (nimages, natoms, 3) sharing the same internal coordinates, e.g.
+    the images of a path. The setup and work arrays are shared by all
+    geometries.
+
+    Returns q with shape (nimages, nq), B with shape (nimages, nq,
+    3 * natoms) (or a list of CSR matrices if sparse is True) and a list
+    of GradB objects, one per geometry.
+    """
+    cdef size_t k
+    cdef size_t nimages = pos_np.shape[0]
+    cdef size_t natoms = pos_np.shape[1]
+    ws = _Workspace(natoms, bonds_np, angles_np, dihedrals_np, mask_np,
+                    cell, images, nthreads)
+    q_np = np.zeros((nimages, ws.nq), dtype=np.float64)
+    if sparse:
+        B = []
+    elif gradient:
+        B = np.zeros((nimages, ws.nq, 3 * natoms), dtype=np.float64)
+    else:
+        B = np.zeros((nimages, ws.nq, 0), dtype=np.float64)
+    D = []
+
+    for k in range(nimages):
+        D.append(ws.evaluate(pos_np[k], q_np[k], gradient, curvature))
+        if not gradient:
+            if sparse:
+                B.append(csr_matrix((ws.nq, 3 * natoms)))
+        elif sparse:
+            B.append(ws.B())
+        else:
+            ws.B(B[k])
 
-                d2q[n, 1, j, 2, k] = d2q[n, 2, k, 1, j] = d2q_int[1, j, 2, k] + d2q_int[0, j, 1, k] - d2q_int[1, j, 1, k] - d2q_int[0, j, 2, k]
-                d2q[n, 1, j, 3, k] = d2q[n, 3, k, 1, j] = d2q_int[0, j, 2, k] - d2q_int[1, j, 2, k]
+    return q_np, B, D
 
-                d2q[n, 2, j, 3, k] = d2q[n, 3, k, 2, j] = d2q_int[1, j, 2, k] - d2q_int[2, j, 2, k]
-        n += 1
+def _cart_indices(indices):
+    """Cartesian indices of the atoms of each internal coordinate"""
+    return (3 * indices[:, :, np.newaxis] + np.arange(3)).reshape((len(indices), 3 * indices.shape[1]))
 
 cdef class GradB:
     cdef size_t natoms, nbonds, nangles, ndihedrals, ninternal, nmasked
+    cdef readonly int nthreads
     cdef np.uint8_t[:] mask
     cdef int[:, :] bonds, angles, dihedrals
     cdef double[:, :, :, :, :] Dbonds, Dangles, Ddihedrals
@@ -713,8 +1094,12 @@ cdef class GradB:
     def __cinit__(self, size_t natoms, int[:, :] bonds, int[:, :] angles,
                   int[:, :] dihedrals, double[:, :, :, :, :] Dbonds,
                   double[:, :, :, :, :] Dangles,
-                  double[:, :, :, :, :] Ddihedrals, np.uint8_t[:] mask):
+                  double[:, :, :, :, :] Ddihedrals, np.uint8_t[:] mask,
+                  object nthreads=None):
         self.natoms = natoms
+        # ddot and ldot use the same number of threads as the
+        # evaluation of the internal coordinates that created self
+        self.nthreads = get_num_threads() if nthreads is None else max(nthreads, 1)
 
         self.nbonds = len(bonds)
         self.nangles = len(angles)
@@ -735,109 +1120,119 @@ cdef class GradB:
         for i in mask:
             self.nmasked += 1 - i
 
+    def indices(self):
+        """Atom indices of the unmasked bonds, angles and dihedrals"""
+        mask = np.asarray(self.mask).astype(bool)
+        nba = self.nbonds + self.nangles
+        return (np.asarray(self.bonds)[mask[:self.nbonds]],
+                np.asarray(self.angles)[mask[self.nbonds:nba]],
+                np.asarray(self.dihedrals)[mask[nba:]])
+
+    def _ldot_sparse(self, np.ndarray[np.float64_t, ndim=1] v_np):
+        rows = []
+        cols = []
+        data = []
+        n = 0
+        for idx, D in zip(self.indices(), (self.Dbonds, self.Dangles, self.Ddihedrals)):
+            m = len(idx)
+            k = 3 * idx.shape[1]
+            cart = _cart_indices(idx)
+            block = v_np[n:n+m, np.newaxis, np.newaxis] * np.asarray(D).reshape((m, k, k))
+            rows.append(np.broadcast_to(cart[:, :, np.newaxis], (m, k, k)).ravel())
+            cols.append(np.broadcast_to(cart[:, np.newaxis, :], (m, k, k)).ravel())
+            data.append(block.ravel())
+            n += m
+        result = coo_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+                            shape=(3 * self.natoms, 3 * self.natoms))
+        return result.tocsr()
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
     def ddot(self, np.ndarray[np.float64_t, ndim=1] v1_np, np.ndarray[np.float64_t, ndim=1] v2_np):
-        cdef size_t i, j, k, a, b, ai, bi
-        cdef size_t start = 0
-        cdef size_t n = 0, m = 0
+        cdef Py_ssize_t m
+        cdef size_t n = 0
+        cdef int nthreads = self.nthreads
+        cdef int[:, :] idx
+        cdef double[:, :, :, :, :] D
         result_np = np.zeros(self.ninternal - self.nmasked, dtype=np.float64)
         cdef double[:] result = memoryview(result_np)
         cdef double[:] v1 = memoryview(v1_np)
         cdef double[:] v2 = memoryview(v2_np)
 
-        for i in range(self.nbonds):
-            if not self.mask[i]:
-                continue
-            for a in range(2):
-                ai = self.bonds[i, a]
-                for b in range(2):
-                    bi = self.bonds[i, b]
-                    for j in range(3):
-                        for k in range(3):
-                            result[n] += self.Dbonds[m, a, j, b, k] * v1[3 * ai + j] * v2[3 * bi + k]
-            n += 1
-            m += 1
-
-        m = 0
-        start += self.nbonds
-        for i in range(self.nangles):
-            if not self.mask[start + i]:
-                continue
-            for a in range(3):
-                ai = self.angles[i, a]
-                for b in range(3):
-                    bi = self.angles[i, b]
-                    for j in range(3):
-                        for k in range(3):
-                            result[n] += self.Dangles[m, a, j, b, k] * v1[3 * ai + j] * v2[3 * bi + k]
-            n += 1
-            m += 1
-
-        m = 0
-        start += self.nangles
-        for i in range(self.ndihedrals):
-            if not self.mask[start + i]:
-                continue
-            for a in range(4):
-                ai = self.dihedrals[i, a]
-                for b in range(4):
-                    bi = self.dihedrals[i, b]
-                    for j in range(3):
-                        for k in range(3):
-                            result[n] += self.Ddihedrals[m, a, j, b, k] * v1[3 * ai + j] * v2[3 * bi + k]
-            n += 1
-            m += 1
+        for idx_np, D in zip(self.indices(), (self.Dbonds, self.Dangles, self.Ddihedrals)):
+            idx = idx_np
+            for m in prange(idx.shape[0], nogil=True, num_threads=nthreads, schedule='static'):
+                result[n + m] = _ddot_block(D[m], idx[m], v1, v2)
+            n += idx.shape[0]
 
         return result_np
 
-    def ldot(self, np.ndarray[np.float64_t, ndim=1] v_np):
-        cdef size_t i, j, k, a, b, ai, bi
-        cdef size_t start = 0
-        cdef size_t n = 0, m = 0
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def ldot(self, np.ndarray[np.float64_t, ndim=1] v_np, bint sparse=False):
+        """Contract the internal coordinate index of D with v. If sparse
+        is True, the result is returned as a CSR matrix assembled from the
+        compact per-coordinate blocks rather than as a dense array."""
+        if sparse:
+            return self._ldot_sparse(v_np)
+
+        cdef Py_ssize_t a
+        cdef size_t n = 0
+        cdef int nthreads = self.nthreads
+        cdef int[:, :] idx
+        cdef double[:, :, :, :, :] D
+        cdef Py_ssize_t[:] indptr, entries
         result_np = np.zeros((3 * self.natoms, 3 * self.natoms), dtype=np.float64)
         cdef double[:, :] result = memoryview(result_np)
         cdef double[:] v = memoryview(v_np)
 
-        for i in range(self.nbonds):
-            if not self.mask[i]:
-                continue
-            for a in range(2):
-                ai = self.bonds[i, a]
-                for b in range(2):
-                    bi = self.bonds[i, b]
-                    for j in range(3):
-                        for k in range(3):
-                            result[3 * ai + j, 3 * bi + k] += v[n] * self.Dbonds[m, a, j, b, k]
-            n += 1
-            m += 1
-
-        m = 0
-        start += self.nbonds
-        for i in range(self.nangles):
-            if not self.mask[start + i]:
-                continue
-            for a in range(3):
-                ai = self.angles[i, a]
-                for b in range(3):
-                    bi = self.angles[i, b]
-                    for j in range(3):
-                        for k in range(3):
-                            result[3 * ai + j, 3 * bi + k] += v[n] * self.Dangles[m, a, j, b, k]
-            n += 1
-            m += 1
-
-        m = 0
-        start += self.nangles
-        for i in range(self.ndihedrals):
-            if not self.mask[start + i]:
-                continue
-            for a in range(4):
-                ai = self.dihedrals[i, a]
-                for b in range(4):
-                    bi = self.dihedrals[i, b]
-                    for j in range(3):
-                        for k in range(3):
-                            result[3 * ai + j, 3 * bi + k] += v[n] * self.Ddihedrals[m, a, j, b, k]
-            n += 1
-            m += 1
+        # Each thread owns the rows of a set of atoms and visits the
+        # coordinates involving them through an atom -> coordinate index,
+        # so no two threads ever write to the same element of result.
+        for idx_np, D in zip(self.indices(), (self.Dbonds, self.Dangles, self.Ddihedrals)):
+            idx = idx_np
+            flat = idx_np.ravel()
+            entries = np.argsort(flat, kind='stable').astype(np.intp)
+            indptr_np = np.zeros(self.natoms + 1, dtype=np.intp)
+            np.cumsum(np.bincount(flat, minlength=self.natoms), out=indptr_np[1:])
+            indptr = indptr_np
+            for a in prange(self.natoms, nogil=True, num_threads=nthreads, schedule='dynamic'):
+                _ldot_atom(result, v, n, idx, D, indptr, entries, a)
+            n += idx.shape[0]
 
         return result_np
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef double _ddot_block(double[:, :, :, :] D, int[:] idx, double[:] v1, double[:] v2) noexcept nogil:
+    """v1 . D . v2 for the compact curvature block D of one coordinate"""
+    cdef size_t a, b, j, k, ai, bi
+    cdef double result = 0.
+    for a in range(idx.shape[0]):
+        ai = idx[a]
+        for b in range(idx.shape[0]):
+            bi = idx[b]
+            for j in range(3):
+                for k in range(3):
+                    result += D[a, j, b, k] * v1[3 * ai + j] * v2[3 * bi + k]
+    return result
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _ldot_atom(double[:, :] result, double[:] v, size_t offset, int[:, :] idx,
+                     double[:, :, :, :, :] D, Py_ssize_t[:] indptr,
+                     Py_ssize_t[:] entries, Py_ssize_t atom) noexcept nogil:
+    """Add the rows of atom to sum_n v[offset + n] D[n]"""
+    cdef Py_ssize_t e, m, a, b, bi, j, k
+    cdef Py_ssize_t width = idx.shape[1]
+    cdef double w
+    for e in range(indptr[atom], indptr[atom + 1]):
+        m = entries[e] // width
+        a = entries[e] % width
+        w = v[offset + m]
+        for b in range(width):
+            bi = idx[m, b]
+            for j in range(3):
+                for k in range(3):
+                    result[3 * atom + j, 3 * bi + k] += w * D[m, a, j, b, k]
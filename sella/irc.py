@@ -2,83 +2,196 @@
 
 from __future__ import division
 
+import copy
+import multiprocessing
+import multiprocessing.connection
+import os
+import traceback
 import warnings
 
 import numpy as np
 
+from scipy.integrate import quad, solve_ivp
+from scipy.optimize import brentq
+
+from ase.io import Trajectory
 from ase.calculators.singlepoint import SinglePointCalculator
 
+from .optimize import solve_secular
+
 
 def rs_newton_irc(minmode, g, d1, dx, xi=1.):
-    lams = minmode.lams
-    vecs = minmode.vecs
+    lams = minmode.lams_q
+    vecs = minmode.vecs_q
     L = np.abs(lams)
     Vg = vecs.T @ g
     Vd1 = vecs.T @ d1
 
-    xilower = 0
-    xiupper = None
-
     eps = -vecs @ (Vg / L)
     d2 = d1 + eps
     d2mag = np.linalg.norm(d2)
     if d2mag < dx:
         return eps, xi
 
-    while True:
-        if xiupper is None:
-            xi *= 2
-        else:
-            xi = (xilower + xiupper) / 2.
-        eps = -vecs @ ((Vg + xi * Vd1) / (L + xi))
-        d2 = d1 + eps
-        d2mag = np.linalg.norm(d2)
-        if abs(d2mag - dx) < 1e-14 * dx:
-            break
+    # In the eigenbasis, the components of d2 = d1 + eps are
+    # (L * Vd1 - Vg) / (L + xi), plus whatever part of d1 lies outside
+    # the span of vecs, which does not depend on xi.
+    a = L * Vd1 - Vg
+    dperp2 = max(d1 @ d1 - Vd1 @ Vd1, 0.)
+    r = np.sqrt(max(dx * dx - dperp2, 0.))
+    xi = solve_secular(a, L, r, xi)
+    eps = -vecs @ ((Vg + xi * Vd1) / (L + xi))
+
+    return eps, xi
+
+
+class IRCPath(object):
+    """Compact storage for the points found along an IRC.
+
+    Positions, energies and forces are kept in preallocated NumPy
+    arrays, in the order in which the points were found, and the arrays
+    grow geometrically as needed. If a trajectory filename is given,
+    every point is written to it as soon as it is added. Atoms objects
+    (with a SinglePointCalculator) are only created when the path is
+    indexed or iterated over, in path order: the forward branch
+    reversed, then the TS, then the reverse branch."""
+    _directions = {None: 0, 'forward': 1, 'reverse': -1}
 
-        if d2mag > dx:
-            xilower = xi
+    def __init__(self, atoms, trajectory=None, capacity=16):
+        self.atoms = atoms.copy()
+        natoms = len(self.atoms)
+        self.positions = np.empty((capacity, natoms, 3))
+        self.energies = np.empty(capacity)
+        self.forces = np.empty((capacity, natoms, 3))
+        self.directions = np.empty(capacity, dtype=np.int8)
+        self.n = 0
+
+        if trajectory is not None:
+            self.trajectory = Trajectory(trajectory, 'w', self.atoms)
         else:
-            xiupper = xi
+            self.trajectory = None
 
-    return eps, xi
+    def _grow(self):
+        capacity = 2 * len(self.energies)
+        for name in ['positions', 'energies', 'forces', 'directions']:
+            old = getattr(self, name)
+            new = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.n] = old[:self.n]
+            setattr(self, name, new)
 
+    def append(self, direction, positions, energy, forces):
+        if self.n == len(self.energies):
+            self._grow()
+        i = self.n
+        self.directions[i] = self._directions[direction]
+        self.positions[i] = positions
+        self.energies[i] = energy
+        self.forces[i] = forces
+        self.n += 1
 
-def irc(minmode, maxiter, ftol, dx=0.01, direction='both', **kwargs):
-    d = minmode.d
+        if self.trajectory is not None:
+            self.trajectory.write(self._get_atoms(i))
 
-    if direction not in ['forward', 'reverse', 'both']:
-        raise ValueError("Don't understand direction='{}'".format(direction))
+    def close(self):
+        if self.trajectory is not None:
+            self.trajectory.close()
 
-    x = minmode.x_m.copy()
-    conf = minmode.atoms.copy()
-    calc = SinglePointCalculator(conf, **minmode.atoms.calc.results)
-    conf.set_calculator(conf)
-    path = [conf]
-    f1, g1, _ = minmode.kick(np.zeros_like(x))
-    minmode.f_minmode(**kwargs)
+    @property
+    def order(self):
+        """Storage indices of the points, in path order"""
+        d = self.directions[:self.n]
+        fwd = np.flatnonzero(d == 1)
+        ts = np.flatnonzero(d == 0)
+        rev = np.flatnonzero(d == -1)
+        if len(fwd) and len(rev):
+            return np.concatenate((fwd[::-1], ts, rev))
+        return np.concatenate((ts, fwd, rev))
 
-    if np.linalg.norm(g1) > ftol:
-        warnings.warn('Initial forces are greater than convergence tolerance! '
-                      'Are you sure this is a transition state?')
+    def _get_atoms(self, i):
+        atoms = self.atoms.copy()
+        atoms.positions = self.positions[i]
+        calc = SinglePointCalculator(atoms, energy=self.energies[i],
+                                     forces=self.forces[i].copy())
+        atoms.set_calculator(calc)
+        return atoms
 
-    if direction == 'both':
-        x0 = minmode.x.copy()
-        H = minmode.H.copy()
-        last = minmode.last.copy()
-        fpath = irc(minmode, maxiter, ftol, dx, 'forward', **kwargs)
-        minmode.x = x0
-        minmode.H = H
-        minmode.last = last
-        rpath = irc(minmode, maxiter, ftol, dx, 'reverse', **kwargs)
-        return list(reversed(fpath)) + rpath[1:]
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        idx = self.order[i]
+        if np.ndim(idx):
+            return [self._get_atoms(j) for j in idx]
+        return self._get_atoms(idx)
 
-    d1 = minmode.vecs[:, 0]
+    def __iter__(self):
+        for i in self.order:
+            yield self._get_atoms(i)
+
+
+def lqa_step(minmode, g, s):
+    """Local quadratic approximation (Page-McIver) step.
+
+    Follows the steepest descent path of the quadratic model defined by
+    the gradient g and the Hessian held by minmode for an arc length s.
+    In the eigenbasis of the Hessian, the path is
+    x_i(t) = (Vg)_i (exp(-lam_i t) - 1) / lam_i, and its arc length is
+    found by quadrature of |dx/dt| = ||Vg * exp(-lams t)||."""
+    lams = minmode.lams_q
+    vecs = minmode.vecs_q
+    Vg = vecs.T @ g
+
+    def arclength(t):
+        return quad(lambda tau: np.linalg.norm(Vg * np.exp(-lams * tau)),
+                    0, t)[0]
+
+    # Euler estimate for t, then expand the bracket until it holds the
+    # requested arc length. If the model path ends (at a minimum of the
+    # quadratic model) before reaching s, just go to the end of it.
+    t = s / np.linalg.norm(Vg)
+    for _ in range(50):
+        if arclength(t) >= s:
+            t = brentq(lambda tau: arclength(tau) - s, 0, t)
+            break
+        t *= 2
+    return vecs @ (Vg * np.expm1(-lams * t) / lams)
+
+
+def _irc_record(minmode, ftol, direction, f, g, arclength, calls0):
+    converged = np.all(minmode.lams > 0) and minmode.converged(ftol)
+    return dict(direction=direction,
+                x=minmode.last['x'],
+                g=minmode.last['g'],
+                f=f,
+                gnorm=np.linalg.norm(g),
+                calls=minmode.calls,
+                arclength=arclength,
+                calls_per_length=(minmode.calls - calls0) / arclength,
+                converged=converged)
+
+
+def _irc_branch(minmode, ftol, dx, direction, method='gs', dx_max=None,
+                etol=1e-3):
+    if method == 'gs':
+        return _irc_branch_gs(minmode, ftol, dx, direction)
+    elif method == 'pc':
+        if dx_max is None:
+            dx_max = 10 * dx
+        return _irc_branch_pc(minmode, ftol, dx, direction, dx_max, etol)
+    raise ValueError("Unknown IRC method {}".format(method))
+
+
+def _irc_branch_gs(minmode, ftol, dx, direction):
+    """Gonzalez-Schlegel style IRC: each point is found by a constrained
+    optimization on a hypersphere of radius dx around the previous one"""
+    d1 = minmode.vecs[:, 0].copy()
     d1 *= dx / np.linalg.norm(d1)
     if direction == 'reverse':
         d1 *= -1
 
     xi = 1.
+    calls0 = minmode.calls
+    arclength = 0.
 
     # Outer loop finds all points along the MEP
     while True:
@@ -92,10 +205,322 @@ def irc(minmode, maxiter, ftol, dx=0.01, direction='both', **kwargs):
                 break
             f1, g1, _ = minmode.kick(eps)
             d1 += eps
+        arclength += np.linalg.norm(d1)
+
+        record = _irc_record(minmode, ftol, direction, f1, g1, arclength,
+                             calls0)
+        yield record
+        if record['converged']:
+            return
+
+
+def dwi_step(x1, f0, g0, H0, f1, g1, H1, s):
+    """Steepest descent path on a distance weighted interpolant.
+
+    The surface interpolates between the quadratic models
+    T_i(x) = f_i + g_i.(x - x_i) + (x - x_i).H_i.(x - x_i) / 2 around
+    the starting point x_0 = 0 and the point x1, with weights
+    w_0 = |x - x1|^2 / (|x|^2 + |x - x1|^2) and w_1 = 1 - w_0. The path
+    starts at x_0 and is integrated for an arc length s, or until it
+    reaches a stationary point of the surface. Returns the end point of
+    the path and the arc length actually travelled."""
+    def gradient(x):
+        dx0 = x
+        dx1 = x - x1
+        d02 = dx0 @ dx0
+        d12 = dx1 @ dx1
+        S = d02 + d12
+        w0 = d12 / S
+        dw0 = 2 * (d02 * dx1 - d12 * dx0) / S**2
+        T0 = f0 + g0 @ dx0 + dx0 @ H0 @ dx0 / 2.
+        T1 = f1 + g1 @ dx1 + dx1 @ H1 @ dx1 / 2.
+        return (w0 * (g0 + H0 @ dx0) + (1 - w0) * (g1 + H1 @ dx1)
+                + (T0 - T1) * dw0)
+
+    gtol = 1e-8 * max(np.linalg.norm(g0), np.linalg.norm(g1))
+    n = len(g0)
+
+    # Integrate dx/dt = -g with the arc length carried as an extra
+    # variable, since the unit direction -g/|g| is not smooth at the
+    # stationary point that the path approaches
+    def descent(t, y):
+        gx = gradient(y[:n])
+        return np.append(-gx, np.linalg.norm(gx))
+
+    def reached(t, y):
+        return y[n] - s
+    reached.terminal = True
+
+    def stationary(t, y):
+        return np.linalg.norm(gradient(y[:n])) - gtol
+    stationary.terminal = True
+
+    # Euler estimate for t, then keep integrating over ever longer
+    # intervals until one of the events ends the path
+    y = np.zeros(n + 1)
+    t0 = 0.
+    t1 = s / max(np.linalg.norm(g0), gtol)
+    for _ in range(50):
+        sol = solve_ivp(descent, (t0, t1), y, method='LSODA', rtol=1e-8,
+                        atol=1e-10 * s, events=(reached, stationary))
+        y = sol.y[:, -1]
+        if sol.status == 1:
+            break
+        t0 = t1
+        t1 *= 2
+    return y[:n], min(y[n], s)
+
+
+def _irc_save(minmode):
+    return dict(x=minmode.x.copy(), last=minmode.last.copy(),
+                Hcurv=minmode._Hcurv)
+
+
+def _irc_restore(minmode, state, H=None):
+    """Go back to a saved point, keeping the (updated) Hessian unless
+    another one is given"""
+    minmode.x = state['x']
+    minmode.last = state['last']
+    minmode._Hcurv = state['Hcurv']
+    if H is None:
+        minmode._update_eig()
+    else:
+        minmode.H = H
+
+
+def _irc_branch_pc(minmode, ftol, dx, direction, dx_max, etol):
+    """Hessian-based predictor-corrector IRC with adaptive step length.
+
+    The predictor is an LQA step of length s using the quasi-Newton
+    Hessian, and the gradient is evaluated at the predicted point. The
+    corrector then integrates the path again from the same starting
+    point, on a distance weighted interpolant of the quadratic models
+    (energy, gradient and Hessian) at the starting and predicted points
+    (Hratchian and Schlegel, J. Chem. Phys. 120, 9918 (2004)). The
+    distance between the predicted and corrected points estimates the
+    local error of the predictor, which is O(s^3). Steps whose error
+    exceeds etol are rejected and retried from the starting point with
+    a smaller s, unless s has already shrunk to dx / 100. Accepted steps
+    move to the corrected point, so every accepted point costs two
+    gradient evaluations, and every rejected one a single evaluation."""
+    d1 = minmode.vecs[:, 0].copy()
+    d1 *= dx / np.linalg.norm(d1)
+    if direction == 'reverse':
+        d1 *= -1
+
+    calls0 = minmode.calls
+    s_min = dx / 100.
+
+    # The gradient vanishes at the TS, so the first step is taken
+    # along the minimum mode
+    f1, g1, _ = minmode.kick(d1)
+    s = arclength = dx
+
+    while True:
+        record = _irc_record(minmode, ftol, direction, f1, g1, arclength,
+                             calls0)
+        yield record
+        if record['converged']:
+            return
+
+        f0 = f1
+        g0 = g1
+        start = _irc_save(minmode)
+        rejected = False
+        while True:
+            H0 = minmode.Hred_q.copy()
+            dx_p = lqa_step(minmode, g0, s)
+            f1, g1, _ = minmode.kick(dx_p)
+            dx_c, ds = dwi_step(dx_p, f0, g0, H0, f1, g1, minmode.Hred_q,
+                                s)
+            err = np.linalg.norm(dx_c - dx_p)
+            if err == 0.:
+                fac = 2.
+            else:
+                fac = min(2., max(0.2, 0.9 * (etol / err)**(1. / 3.)))
+
+            if err <= etol or s <= s_min:
+                break
+            # Reject the step, but keep what the Hessian update learned
+            # from the predicted point
+            _irc_restore(minmode, start)
+            s = max(s * fac, s_min)
+            rejected = True
+
+        f1, g1, _ = minmode.kick(dx_c - dx_p)
+        arclength += ds
+        # Don't grow the step right after having had to shrink it
+        if rejected:
+            fac = min(fac, 1.)
+        s = min(s * fac, dx_max)
+
+
+class _RemoteTraceback(Exception):
+    """Carries the formatted traceback of an exception raised in an IRC
+    branch worker, so that it can be chained to the re-raised exception"""
+    def __init__(self, tb):
+        self.tb = tb
+
+    def __str__(self):
+        return self.tb
+
+
+def _irc_branch_worker(minmode, ftol, dx, direction, method, dx_max, etol,
+                       conn):
+    # Every record is sent as soon as it has been found, followed by
+    # ('done', None), or by ('error', (exception, traceback)) on failure
+    try:
+        # File-based calculators of the two branches would otherwise
+        # write their input and output files to the same place
+        calc = minmode._atoms_nodummy.calc
+        directory = getattr(calc, 'directory', None)
+        if directory is not None:
+            calc.directory = type(directory)(
+                os.path.join(directory, 'irc_' + direction))
+        for record in _irc_branch(minmode, ftol, dx, direction, method,
+                                  dx_max, etol):
+            conn.send(('record', record))
+        conn.send(('done', None))
+    except Exception as err:
+        tb = traceback.format_exc()
+        try:
+            conn.send(('error', (err, tb)))
+        except Exception:
+            # The exception itself could not be pickled
+            conn.send(('error', (RuntimeError(repr(err)), tb)))
+    finally:
+        conn.close()
+
+
+def irc_iter(minmode, maxiter, ftol, dx=0.01, direction='both',
+             parallel=False, method='gs', dx_max=None, etol=1e-3, **kwargs):
+    """Generator version of irc.
+
+    The first record yielded describes the starting point (the
+    transition state), with direction=None. Every subsequent iteration
+    finds one new point along the MEP and yields a dict describing it.
+    With direction='both', all forward points are yielded before any
+    reverse points, unless parallel=True. Each record also reports the
+    arc length travelled along its branch and the gradient calls per
+    unit arc length.
+
+    method selects the integrator. 'gs' finds each point by a
+    constrained optimization on a hypersphere of radius dx around the
+    previous point. 'pc' uses a Hessian-based predictor-corrector with
+    an LQA predictor and a distance weighted interpolant corrector (see
+    _irc_branch_pc), taking two gradient calls per point. Its step
+    length starts at dx and adapts to keep the local error estimate
+    below etol, up to at most dx_max (10 * dx by default); steps with a
+    larger error are rejected and retried.
+
+    With direction='both' and parallel=True, the two branches are run
+    concurrently in separate processes, each with its own copy of
+    minmode (and therefore of its calculator), starting from the TS
+    geometry, Hessian and minimum mode. The calculator of each branch
+    runs in the subdirectory irc_forward or irc_reverse of the
+    calculator's directory, so that file-based calculators do not
+    overwrite each other's files. Calculators that share other external
+    state between copies, such as a running server process or socket,
+    are not supported. Each point is yielded as soon as its worker has
+    found it, so points of the two branches are interleaved. Trajectory
+    output is not written for the branches, and minmode itself is left
+    at the TS, with the gradient calls of both branches added to
+    minmode.calls as their points arrive. If a branch fails, its
+    exception is re-raised with the worker's traceback chained to it,
+    and the other branch is stopped. Workers are forked, so the
+    calculator does not need to be picklable, but this is only available
+    on platforms that support fork."""
+    if direction not in ['forward', 'reverse', 'both']:
+        raise ValueError("Don't understand direction='{}'".format(direction))
+
+    f1, g1, _ = minmode.kick(np.zeros_like(minmode.x_m))
+    minmode.f_minmode(**kwargs)
+
+    if np.linalg.norm(g1) > ftol:
+        warnings.warn('Initial forces are greater than convergence tolerance! '
+                      'Are you sure this is a transition state?')
+
+    yield dict(direction=None,
+               x=minmode.last['x'],
+               g=minmode.last['g'],
+               f=f1,
+               gnorm=np.linalg.norm(g1),
+               calls=minmode.calls,
+               arclength=0.,
+               calls_per_length=None,
+               converged=False)
+
+    if direction == 'both' and parallel:
+        # The open trajectory file can't be shared with the workers
+        branch = copy.copy(minmode)
+        branch.trajectory = None
+        calls0 = minmode.calls
+        ctx = multiprocessing.get_context('fork')
+        conns = []
+        procs = []
+        for d in ('forward', 'reverse'):
+            recv, send = ctx.Pipe(duplex=False)
+            proc = ctx.Process(target=_irc_branch_worker,
+                               args=(branch, ftol, dx, d, method, dx_max,
+                                     etol, send))
+            proc.start()
+            send.close()
+            conns.append(recv)
+            procs.append(proc)
+        branch_calls = dict(forward=calls0, reverse=calls0)
+        pending = dict(zip(conns, ('forward', 'reverse')))
+        try:
+            while pending:
+                for conn in multiprocessing.connection.wait(list(pending)):
+                    d = pending[conn]
+                    try:
+                        kind, data = conn.recv()
+                    except EOFError:
+                        raise RuntimeError('IRC {} branch worker died '
+                                           'unexpectedly'.format(d))
+                    if kind == 'record':
+                        minmode.calls += data['calls'] - branch_calls[d]
+                        branch_calls[d] = data['calls']
+                        yield data
+                    elif kind == 'done':
+                        del pending[conn]
+                    else:
+                        err, tb = data
+                        raise err from _RemoteTraceback(tb)
+        finally:
+            for proc in procs:
+                if proc.is_alive():
+                    proc.terminate()
+                proc.join()
+            for conn in conns:
+                conn.close()
+    elif direction == 'both':
+        # The curvature term of internal coordinate mode is restored
+        # along with the geometry and Hessian at the TS
+        ts = _irc_save(minmode)
+        H = minmode.H.copy()
+        yield from _irc_branch(minmode, ftol, dx, 'forward', method, dx_max,
+                               etol)
+        _irc_restore(minmode, ts, H)
+        yield from _irc_branch(minmode, ftol, dx, 'reverse', method, dx_max,
+                               etol)
+    else:
+        yield from _irc_branch(minmode, ftol, dx, direction, method, dx_max,
+                               etol)
+
+
+def irc(minmode, maxiter, ftol, dx=0.01, direction='both', parallel=False,
+        method='gs', dx_max=None, etol=1e-3, trajectory=None, **kwargs):
+    """Find the IRC starting from the transition state held by minmode.
 
-        conf = minmode.atoms.copy()
-        calc = SinglePointCalculator(conf, **minmode.atoms.calc.results)
-        conf.set_calculator(calc)
-        path.append(conf)
-        if np.all(minmode.lams > 0) and minmode.converged(ftol):
-            return path
+    Returns an IRCPath, which can be indexed or iterated over like a
+    list of Atoms objects. If trajectory is given, every point is
+    written to that file as soon as it has been found. See irc_iter for
+    the remaining arguments."""
+    path = IRCPath(minmode.atoms, trajectory)
+    for point in irc_iter(minmode, maxiter, ftol, dx, direction, parallel,
+                          method, dx_max, etol, **kwargs):
+        path.append(point['direction'], point['x'].reshape((-1, 3)),
+                    point['f'], -point['g'].reshape((-1, 3)))
+    path.close()
+    return path
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+from __future__ import division
+
+import numpy as np
+
+from ase.data import covalent_radii
+from ase.units import Hartree, Bohr
+
+from .internal_cython import get_internal, cart_to_internal
+from .internal import _dihedrals_containing
+
+# Force constants and range parameter of the Lindh model Hessian
+# (Chem. Phys. Lett. 241, 423 (1995)), converted from atomic units.
+# Only the first-row parameters are used; the reference distances
+# are taken from covalent radii instead of the tabulated values.
+_K_BOND = 0.45 * Hartree / Bohr**2
+_K_ANGLE = 0.15 * Hartree
+_K_DIHEDRAL = 0.005 * Hartree
+_ALPHA = 1.0 / Bohr**2
+
+# Non-metals and metalloids, for which the bonding is covalent enough
+# for the covalent radii to be sensible reference distances
+_COVALENT = frozenset([1, 2, 5, 6, 7, 8, 9, 10, 14, 15, 16, 17, 18, 32, 33,
+                       34, 35, 36, 51, 52, 53, 54, 85, 86])
+
+
+def _rho(pos, rref, a, b, shift):
+    rab = pos[b] - pos[a] + shift
+    rab2 = np.sum(rab * rab, axis=-1)
+    rref_ab = rref[a] + rref[b]
+    return np.exp(_ALPHA * (rref_ab * rref_ab - rab2))
+
+
+def all_nonmetals(atoms):
+    """Whether all (non-dummy) atoms are non-metals or metalloids"""
+    return all(n in _COVALENT for n in atoms.numbers if n != 0)
+
+
+def lindh_applicable(atoms):
+    """Whether lindh_hessian gives a sensible model for atoms.
+
+    The force constants are those of covalent bonds and the reference
+    distances are sums of covalent radii, so the model is only used
+    when all (non-dummy) atoms are non-metals. For metals, the model is
+    typically orders of magnitude too stiff, and makes a poor initial
+    Hessian and eigensolver preconditioner."""
+    return all_nonmetals(atoms)
+
+
+def lindh_hessian(atoms, kbond=_K_BOND, kangle=_K_ANGLE,
+                  kdihedral=_K_DIHEDRAL):
+    """Construct a Lindh-style model Hessian in Cartesian coordinates.
+
+    The bonds, angles and dihedrals are taken from the connectivity
+    found by get_internal. Each internal coordinate is assigned a
+    force constant that decays with the distance between its
+    neighbouring atoms, and the resulting diagonal internal coordinate
+    Hessian is transformed to Cartesian coordinates with the Wilson
+    B-matrix. Curvature (gradient-dependent) terms are neglected.
+
+    This model is experimental. Its parameters have not been tuned,
+    and using it as the initial Hessian can increase the number of
+    gradient evaluations (e.g. 334 -> 400 for an ethanol saddle point
+    search in Cartesian coordinates).
+
+    Arguments:
+    atoms -- ASE Atoms object
+    kbond, kangle, kdihedral -- Force constant prefactors (eV/Ang^2 for
+                                bonds, eV/rad^2 for angles and dihedrals)
+    """
+    pos = atoms.get_positions()
+    rref = np.array([covalent_radii[n] for n in atoms.numbers])
+
+    _, _, bonds, angles, dihedrals, all_images = get_internal(atoms, True,
+                                                              True)
+    if np.any(atoms.pbc):
+        cell, images = atoms.cell.array, all_images
+    else:
+        cell, images = None, None
+    nb, na, nd = len(bonds), len(angles), len(dihedrals)
+
+    # Near-linear angles have an ill-defined gradient, as do dihedrals
+    # containing three near-collinear atoms, so leave them out.
+    mask = np.ones(nb + na + nd, dtype=np.uint8)
+    q, _, _ = cart_to_internal(pos, bonds, angles, dihedrals, mask,
+                               cell=cell, images=images)
+    linear = np.pi - q[nb:nb+na] < np.pi / 20
+    mask[nb:nb+na] = ~linear
+    mask[nb+na:] = ~_dihedrals_containing(dihedrals, all_images[2],
+                                          angles[linear],
+                                          all_images[1][linear])
+
+    _, B, _ = cart_to_internal(pos, bonds, angles, dihedrals, mask,
+                               gradient=True, cell=cell, images=images)
+
+    amask = mask[nb:nb+na].astype(bool)
+    dmask = mask[nb+na:].astype(bool)
+    angles = angles[amask]
+    dihedrals = dihedrals[dmask]
+
+    # Lattice translations between consecutive atoms of each coordinate
+    if cell is None:
+        sb = np.zeros((nb, 3))
+        sa = np.zeros((len(angles), 2, 3))
+        sd = np.zeros((len(dihedrals), 3, 3))
+    else:
+        sb = images[0] @ cell
+        sa = images[1][amask] @ cell
+        sd = images[2][dmask] @ cell
+
+    rho_b = _rho(pos, rref, bonds[:, 0], bonds[:, 1], sb)
+    rho_a = (_rho(pos, rref, angles[:, 0], angles[:, 1], sa[:, 0])
+             * _rho(pos, rref, angles[:, 1], angles[:, 2], sa[:, 1]))
+    rho_d = (_rho(pos, rref, dihedrals[:, 0], dihedrals[:, 1], sd[:, 0])
+             * _rho(pos, rref, dihedrals[:, 1], dihedrals[:, 2], sd[:, 1])
+             * _rho(pos, rref, dihedrals[:, 2], dihedrals[:, 3], sd[:, 2]))
+
+    k = np.concatenate((kbond * rho_b, kangle * rho_a, kdihedral * rho_d))
+
+    H = B.T @ (k[:, np.newaxis] * B)
+    return 0.5 * (H + H.T)
@@ -6,14 +6,52 @@ import warnings
 
 import numpy as np
 import scipy
-from scipy.linalg import eigh, lstsq
+from scipy.linalg import eigh, lstsq, cholesky, solve_triangular
+from scipy.optimize import nnls
+
+from .policies import EigPolicy
+
+
+def solve_secular(a, b, r, xi=1., rtol=1e-14, maxiter=100):
+    """Find the level shift xi >= 0 for which ||a / (b + xi)|| == r.
+
+    All b must be positive, and ||a / b|| must be greater than r.
+    This uses Newton's method on 1 / ||a / (b + xi)|| - 1 / r, which
+    is nearly linear in xi (More and Sorensen), safeguarded with
+    bisection. xi is used as the initial guess."""
+    a2 = a * a
+    xilower = 0.
+    xiupper = None
+    xi = max(xi, 0.)
+    for _ in range(maxiter):
+        bxi = b + xi
+        s = np.sqrt(np.sum(a2 / bxi**2))
+        if abs(s - r) < rtol * r:
+            break
+
+        if s > r:
+            xilower = xi
+        else:
+            xiupper = xi
+
+        xinew = xi + (s - r) * s * s / (r * np.sum(a2 / bxi**3))
+        if xinew <= xilower or (xiupper is not None and xinew >= xiupper):
+            # Newton steps from below the root never overshoot, so
+            # this only happens once xi stops changing
+            if xiupper is None:
+                break
+            xinew = (xilower + xiupper) / 2.
+        if xinew == xi:
+            break
+        xi = xinew
+    return xi
 
 
 def rs_newton(minmode, g, r_tr, order=1, xi=1.):
     """Perform a trust-radius Newton step towards an
     arbitrary-order saddle point (use order=0 to seek a minimum)"""
-    lams = minmode.lams
-    vecs = minmode.vecs
+    lams = minmode.lams_q
+    vecs = minmode.vecs_q
 
     # If we don't have any curvature information yet, just do steepest
     # descent.
@@ -30,32 +68,24 @@ def rs_newton(minmode, g, r_tr, order=1, xi=1.):
     L = np.abs(lams)
     L[:order] *= -1
     Vg = vecs.T @ g
-    dx = -vecs @ (Vg / L)
-    dx_mag = np.linalg.norm(dx)
+    dx_mag = np.linalg.norm(Vg / L)
     bound_clip = False
     if dx_mag > r_tr:
         bound_clip = True
-        rfo_counter = 0
-        xilower = 0
-        xiupper = None
-        LL = L * L
-        while True:
-            if xiupper is None:
-                xi *= 2
-            else:
-                xi = (xilower + xiupper) / 2.
-            if order == 0:
-                dx = -vecs @ (Vg / (L + xi))
-            else:
-                dx = -vecs @ (Vg * (L / (LL + xi)))
-            dx_mag = np.linalg.norm(dx)
-            if abs(dx_mag - r_tr) < 1e-14 * r_tr:
-                break
-
-            if dx_mag > r_tr:
-                xilower = xi
-            else:
-                xiupper = xi
+        # In the eigenbasis of the Hessian, the shifted step has
+        # components a / (b + xi), so the step length is a cheap
+        # function of xi and only the final step needs a matvec.
+        if order == 0:
+            a = Vg
+            b = L
+        else:
+            a = Vg * L
+            b = L * L
+        xi = solve_secular(a, b, r_tr, xi)
+        dx = -vecs @ (a / (b + xi))
+    else:
+        dx = -vecs @ (Vg / L)
+    dx_mag = np.linalg.norm(dx)
 
     return dx, dx_mag, xi, bound_clip
 
@@ -202,34 +232,66 @@ def interpolate_quadratic(f0, f1, g0, g1, dx, rmax=np.infty):
     return ft, gt, t
 
 
-def optimize(minmode, maxiter, ftol, r_trust, inc_factr=1.1, dec_factr=0.9,
-             dec_ratio=5.0, inc_ratio=1.01, order=1, eig=True, **kwargs):
+def optimize_iter(minmode, maxiter, ftol, r_trust, inc_factr=1.1,
+                  dec_factr=0.9, dec_ratio=5.0, inc_ratio=1.01, order=1,
+                  eig=True, policy=None, **kwargs):
+    """Generator version of optimize.
+
+    Each iteration takes a single trust-region step and yields a dict
+    describing it. The generator is exhausted once the optimization has
+    converged or maxiter gradient evaluations have been made, but the
+    caller is free to stop iterating (and e.g. checkpoint minmode) at
+    any point in between.
+
+    policy is an EigPolicy object (see sella.policies) which decides
+    after each step whether to re-probe the minimum mode with the
+    eigensolver. Defaults to probing only when the curvature of the
+    updated Hessian is wrong."""
 
     if order != 0 and not eig:
         warnings.warn("Saddle point optimizations with eig=False will "
                       "most likely fail!\n Proceeding anyway, but you "
                       "shouldn't be optimistic.")
 
+    if policy is None:
+        policy = EigPolicy()
+
     r_trust_min = kwargs.get('dxL', r_trust / 100.)
 
     f, g, _ = minmode.kick(np.zeros_like(minmode.x_m))
 
     if eig:
         minmode.f_minmode(**kwargs)
+        policy.start(minmode, order)
 
     xi = 1.
     while True:
         # Find new search step
         dx, dx_mag, xi, bound_clip = rs_newton(minmode, g, r_trust, order, xi)
 
-        # Determine if we need to call the eigensolver, then step
-        ev = (eig and minmode.lams is not None
-                  and np.any(minmode.lams[:order] > 0))
-        f, g, dx = minmode.kick(dx, ev, **kwargs)
+        # Step, then determine if we need to call the eigensolver
+        f, g, dx = minmode.kick(dx)
+        ev = eig and policy(minmode, order)
+        if ev:
+            calls = minmode.calls
+            minmode.f_minmode(**kwargs)
+            policy.probed(minmode, order, minmode.calls - calls)
+
+        converged = minmode.converged(ftol)
+        step = dict(x=minmode.last['x'],
+                    f=f,
+                    gnorm=np.linalg.norm(g),
+                    dx_mag=dx_mag,
+                    r_trust=r_trust,
+                    ratio=minmode.ratio,
+                    calls=minmode.calls,
+                    probed=ev,
+                    converged=converged)
 
         # Loop exit criterion: convergence or maxiter reached
-        if minmode.converged(ftol) or minmode.calls >= maxiter:
-            return minmode.last['x']
+        if converged or minmode.calls >= maxiter:
+            yield step
+            return
 
         # Update trust radius
         ratio = minmode.ratio
@@ -243,8 +305,26 @@ def optimize(minmode, maxiter, ftol, r_trust, inc_factr=1.1, dec_factr=0.9,
         # Debug print statement
         print(f, np.linalg.norm(g), ratio, dx_mag / r_trust, r_trust, minmode.lams[0])
 
+        yield step
+
+
+def optimize(minmode, maxiter, ftol, r_trust, inc_factr=1.1, dec_factr=0.9,
+             dec_ratio=5.0, inc_ratio=1.01, order=1, eig=True, policy=None,
+             **kwargs):
+    for _ in optimize_iter(minmode, maxiter, ftol, r_trust, inc_factr,
+                           dec_factr, dec_ratio, inc_ratio, order, eig,
+                           policy, **kwargs):
+        pass
+    return minmode.last['x']
+
 
 class GDIIS(object):
+    """History of geometries, energies and gradients for GDIIS/GEDIIS.
+
+    The history is kept in a fixed-capacity ring buffer: column
+    self._head holds the most recent entry, and older entries are
+    found by stepping backwards modulo nhist. The Gram matrix of the
+    Newton steps HG is updated one row/column at a time."""
     def __init__(self, d, nhist):
         self.d = d
         self.nhist = nhist
@@ -255,40 +335,54 @@ class GDIIS(object):
         self.HG = np.zeros((d, nhist), dtype=np.float64)
         self.GTG = np.zeros((nhist, nhist), dtype=np.float64)
 
+        self._head = -1
         self._n = 0
 
+    @property
+    def indices(self):
+        """Ring buffer columns of the active history, newest first"""
+        return (self._head - np.arange(self.n)) % self.nhist
+
     def update(self, e, r, g, minmode):
-        vecs = minmode.vecs
-        L = abs(minmode.lams)
+        vecs = minmode.vecs_q
+        L = abs(minmode.lams_q)
         L[0] *= -1
 
-        self.E = np.roll(self.E, 1)
-        self.R = np.roll(self.R, 1, 1)
-        self.G = np.roll(self.G, 1, 1)
-        self.HG = np.roll(self.HG, 1, 1)
-        self.GTG = np.roll(self.GTG, 1, (0, 1))
+        self.n = min(self.n + 1, self.nhist)
+        i = self._head = (self._head + 1) % self.nhist
 
-        self.E[0] = e
-        self.R[:, 0] = r.copy()
-        self.G[:, 0] = g.copy()
-        self.HG[:, 0] = vecs @ ((vecs.T @ g) / L)
-        self.GTG[0, :] = self.GTG[:, 0] = self.HG.T @ self.HG[:, 0]
+        self.E[i] = e
+        self.R[:, i] = r
+        self.G[:, i] = g
+        self.HG[:, i] = vecs @ ((vecs.T @ g) / L)
 
-        self.n = min(self.n + 1, self.nhist)
+        idx = self.indices
+        self.GTG[i, idx] = self.GTG[idx, i] = self.HG[:, idx].T @ self.HG[:, i]
 
     def _calc_c(self):
+        # Minimize ||HG @ c|| subject to sum(c) == 1 and c >= 0.
+        # With A = GTG, the solution is c = y / sum(y), where y >= 0
+        # minimizes y.T @ A @ y / 2 - sum(y). Writing A = U.T @ U, that
+        # is the non-negative least squares problem
+        # min ||U @ y - U^-T @ 1||, solved by an active-set method.
         c = np.zeros(self.nhist)
-        c[0] = 1.
-        resmin = np.infty
-        for mask in mask_gen(self.n):
-            c[:self.n] = mask * lstsq(self.GTG[:self.n, :self.n], mask)[0]
-            c /= c.sum()
-            if np.all(c >= 0.):
-                res = np.linalg.norm(self.HG @ c)
-                if res < resmin:
-                    self._c = c
-                    resmin = res
-        print(self._c, resmin)
+        if self.n == 0:
+            self._c = c
+            return
+        idx = self.indices
+        A = self.GTG[np.ix_(idx, idx)]
+        scale = np.trace(A) / self.n
+        if scale == 0.:
+            c[idx[0]] = 1.
+            self._c = c
+            return
+        A = A + 1e-12 * scale * np.eye(self.n)
+        U = cholesky(A)
+        rhs = solve_triangular(U, np.ones(self.n), trans='T')
+        y, _ = nnls(U, rhs)
+        c[idx] = y / y.sum()
+        self._c = c
+        print(c[idx], np.linalg.norm(self.HG @ c))
 
     def reset(self):
         self.n = 1
@@ -387,15 +481,3 @@ def gediis(minmode, x0, maxcalls, ftol, nqn=0, nhist=10,
 
         print(f1, np.linalg.norm(g1), ratio, dx_mag/r_trust, r_trust, lams[0])
 
-
-def mask_gen(n):
-    mask = np.ones(n, dtype=int)
-    yield mask.copy()
-    while True:
-        mask[-1] -= 1
-        for i in range(n - 2, -1, -1):
-            mask[i] += mask[i + 1] // 2
-            mask[i + 1] %= 2
-        if mask[0] == 0:
-            return
-        yield mask.copy()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+from __future__ import division
+
+import numpy as np
+
+
+class EigPolicy(object):
+    """Decides when optimize should re-probe the minimum mode.
+
+    The base policy only calls the eigensolver when one of the lowest
+    `order` eigenvalues of the quasi-Newton Hessian has the wrong sign.
+    Subclasses can ask for additional probes by overriding _decide.
+
+    Every decision is appended to self.history as a dict with keys
+    'probe' (whether the eigensolver was called), 'reason' and 'cost'
+    (the number of gradient evaluations the probe took, or 0)."""
+    name = 'curvature'
+
+    def __init__(self):
+        self.history = []
+
+    def __call__(self, minmode, order):
+        if minmode.lams is None:
+            probe, reason = False, None
+        elif np.any(minmode.lams[:order] > 0):
+            probe, reason = True, 'curvature'
+        elif self._decide(minmode, order):
+            probe, reason = True, self.name
+        else:
+            probe, reason = False, None
+        self.history.append(dict(probe=probe, reason=reason, cost=0))
+        return probe
+
+    def _decide(self, minmode, order):
+        return False
+
+    def start(self, minmode, order):
+        """Must be called after the initial probe, before the first step"""
+        pass
+
+    def probed(self, minmode, order, cost):
+        """Must be called after each probe this policy asked for"""
+        self.history[-1]['cost'] = cost
+
+    @property
+    def nprobes(self):
+        return sum(1 for rec in self.history if rec['probe'])
+
+    @property
+    def nskips(self):
+        return len(self.history) - self.nprobes
+
+    @property
+    def cost(self):
+        """Total gradient evaluations spent on probes"""
+        return sum(rec['cost'] for rec in self.history)
+
+
+class FixedIntervalPolicy(EigPolicy):
+    """Probe at least once every `interval` steps"""
+    name = 'interval'
+
+    def __init__(self, interval=5):
+        EigPolicy.__init__(self)
+        self.interval = interval
+
+    def _decide(self, minmode, order):
+        nsteps = 1
+        for rec in reversed(self.history):
+            if rec['probe']:
+                break
+            nsteps += 1
+        return nsteps >= self.interval
+
+
+class ModeOverlapPolicy(EigPolicy):
+    """Probe when the lowest mode(s) of the quasi-Newton Hessian have
+    drifted away from the mode(s) found by the last probe, i.e. when
+    the overlap between the two subspaces drops below `threshold`"""
+    name = 'overlap'
+
+    def __init__(self, threshold=0.9):
+        EigPolicy.__init__(self)
+        self.threshold = threshold
+        self.v_ref = None
+
+    def _modes(self, minmode, order):
+        return minmode.Tm @ minmode.vecs[:, :max(order, 1)]
+
+    def _decide(self, minmode, order):
+        v = self._modes(minmode, order)
+        if self.v_ref is None or self.v_ref.shape != v.shape:
+            self.v_ref = v
+            return False
+        # Smallest singular value of the overlap matrix is the cosine of
+        # the largest principal angle between the two subspaces
+        overlap = np.linalg.svd(self.v_ref.T @ v, compute_uv=False)[-1]
+        return overlap < self.threshold
+
+    def start(self, minmode, order):
+        self.v_ref = self._modes(minmode, order)
+
+    def probed(self, minmode, order, cost):
+        EigPolicy.probed(self, minmode, order, cost)
+        self.v_ref = self._modes(minmode, order)
+
+
+class TrustRatioPolicy(EigPolicy):
+    """Probe when the ratio of predicted to actual energy change of the
+    last step (minmode.ratio) falls outside of [lower, upper]"""
+    name = 'ratio'
+
+    def __init__(self, lower=0.5, upper=2.):
+        EigPolicy.__init__(self)
+        self.lower = lower
+        self.upper = upper
+
+    def _decide(self, minmode, order):
+        ratio = minmode.ratio
+        if ratio is None:
+            return False
+        return not (self.lower <= ratio <= self.upper)
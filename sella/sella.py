@@ -14,14 +14,27 @@ from .eigensolvers import davidson
 from .linalg import NumericalHessian, ProjectedMatrix
 from .hessian_update import update_H, symmetrize_Y
 from .constraints import initialize_constraints, calc_constr_basis
+from .model_hessian import all_nonmetals, lindh_applicable, lindh_hessian
+from .internal import Internal
+
+
+def _reduced_eig(Tproj, H):
+    """Hessian H projected with Tproj, and its eigenvalues and
+    eigenvectors, leaving out the (near) zero eigenvalues"""
+    Hred = Tproj @ H @ Tproj.T
+    lams, vecs = eigh(Hred)
+    indices = [i for i, lam in enumerate(lams) if abs(lam) > 1e-12]
+    return Hred, lams[indices], vecs[:, indices]
 
 
 class MinModeAtoms(object):
     def __init__(self, atoms, calc, eigensolver=davidson,
                  project_translations=True, project_rotations=None,
                  constraints=None, trajectory=None, shift=1000,
-                 v0=None, maxres=1e-5):
+                 v0=None, maxres=1e-5, H0=None, internal=False):
         self.atoms = atoms.copy()
+        self.internal = None
+        self._Hcurv = None
         self.H = None
 
         if self.atoms.constraints:
@@ -86,25 +99,79 @@ class MinModeAtoms(object):
 
         self._basis_update()
 
+        # Optional initial approximate Hessian, which is also used to
+        # precondition the first call to the eigensolver. Either a full
+        # (3N x 3N) Cartesian Hessian or the name of a model Hessian.
+        # The Lindh model is experimental: it has not been tuned, and
+        # it can increase the number of gradient evaluations compared to
+        # no model Hessian. It is only meaningful for covalent systems, so
+        # no model is used for systems containing metal atoms.
+        if isinstance(H0, str):
+            if H0 != 'lindh':
+                raise ValueError("Unknown model Hessian {}".format(H0))
+            if lindh_applicable(self.atoms):
+                warnings.warn('The Lindh model Hessian is experimental, '
+                              'and may increase the number of gradient '
+                              'evaluations!')
+                H0 = lindh_hessian(self.atoms)
+            else:
+                warnings.warn('The Lindh model Hessian is not suitable '
+                              'for systems containing metal atoms! '
+                              'Proceeding without a model Hessian.')
+                H0 = None
+        if H0 is not None:
+            self.H = self.Tfree.T @ H0 @ self.Tfree
+
+        # Optionally take steps in redundant internal coordinates. The
+        # step is still chosen in the Cartesian basis of free coordinates,
+        # but with the Hessian of the internal coordinates, and it is
+        # carried out along the curvilinear path on which the internal
+        # coordinates change linearly. internal may be True or a dict of
+        # keyword arguments for Internal.
+        if internal:
+            kwargs = dict(angles=True, dihedrals=True)
+            if isinstance(internal, dict):
+                kwargs.update(internal)
+            if not all_nonmetals(self.atoms):
+                warnings.warn('Internal coordinates are not suitable for '
+                              'systems containing metal atoms, which have '
+                              'very many redundant internal coordinates '
+                              'and make internal steps slow! Consider '
+                              'internal=False.')
+            self.internal = Internal(self.atoms, **kwargs)
+            if (not self.internal.periodic
+                    and self.internal.ninternal < self.d - 6):
+                raise RuntimeError('Not enough internal coordinates found! '
+                                   'Consider using angles or dihedrals.')
+
     @property
     def H(self):
         return self._H
 
     @H.setter
     def H(self, target):
-        if target is None:
-            self._H = None
-            self.Hred = None
-            self.lams = None
-            self.vecs = None
-            return
         self._H = target
+        self._update_eig()
+
+    def _update_eig(self):
+        # Hred, lams and vecs always describe the Cartesian Hessian.
+        # Steps are chosen with Hred_q, lams_q and vecs_q, which in
+        # internal coordinate mode leave out the part of the Hessian
+        # that comes from the curvature of q(x), and are otherwise the
+        # same as the Cartesian ones.
+        if self._H is None:
+            self.Hred = self.Hred_q = None
+            self.lams = self.lams_q = None
+            self.vecs = self.vecs_q = None
+            return
         Tproj = self.Tm.T @ self.Tfree
-        self.Hred = Tproj @ target @ Tproj.T
-        lams, vecs = eigh(self.Hred)
-        indices = [i for i, lam in enumerate(lams) if abs(lam) > 1e-12]
-        self.lams = lams[indices]
-        self.vecs = vecs[:, indices]
+        self.Hred, self.lams, self.vecs = _reduced_eig(Tproj, self._H)
+        if self._Hcurv is None:
+            self.Hred_q, self.lams_q, self.vecs_q = (self.Hred, self.lams,
+                                                     self.vecs)
+        else:
+            self.Hred_q, self.lams_q, self.vecs_q = _reduced_eig(
+                Tproj, self._H - self._Hcurv)
 
     @property
     def x(self):
@@ -163,14 +230,47 @@ class MinModeAtoms(object):
 
         dx_c, _, _, _ = lstsq(-self.drdx.T, self.res)
 
-        dx = self.Tm @ dx_m + dx_c
-        f1, g1 = self.f_update(self.x + dx)
+        if self.internal is None:
+            dx = self.Tm @ dx_m
+        else:
+            dx = self._internal_step(self.Tm @ dx_m)
+        f1, g1 = self.f_update(self.x + dx + dx_c)
 
         if minmode:
             self.f_minmode(**kwargs)
 
         return f1, self.Tm.T @ self.last['g'], dx_m
 
+    def _internal_step(self, dx):
+        """Displacement that changes the internal coordinates by B @ dx.
+
+        The curvilinear displacement is projected back onto the free
+        coordinates, so that e.g. fixed atoms stay in place. Falls back
+        to the linear step dx if the back-transformation fails."""
+        internal = self.internal
+        internal.positions = self.x.reshape((-1, 3))
+        try:
+            internal.p = internal.p + internal.B @ dx
+        except RuntimeError:
+            warnings.warn('Internal coordinate back-transformation failed, '
+                          'taking a Cartesian step instead.')
+            return dx
+        dx = internal.positions.ravel() - self.x
+        return self.Tm @ (self.Tm.T @ dx)
+
+    def _internal_curvature(self, g):
+        """Contribution of the curvature of the internal coordinates to
+        the Hessian, D . g_q, in the basis of free coordinates. g_q is
+        the gradient in internal coordinates, B.T @ g_q = g."""
+        internal = self.internal
+        internal.positions = self.x.reshape((-1, 3))
+        # Factorize B at this geometry. The next step starts from here,
+        # so its back-transformation reuses the same factorization.
+        if internal._factor is None or internal._factor[0] is not internal.B:
+            internal._factorize()
+        g_q = internal._solve(g, transpose=True)
+        return self.Tfree.T @ internal.D.ldot(g_q) @ self.Tfree
+
     def set_constraints(self, constraints, p_t, p_r):
         if self.H is not None:
             assert self.Tfree is not None
@@ -219,6 +319,12 @@ class MinModeAtoms(object):
         f, g = self.calc_eg(x)
         h = g - self.drdx @ self.Tc.T @ g
 
+        if self.internal is not None:
+            self._Hcurv = self._internal_curvature(g)
+            # Otherwise the H setter below refreshes the eigensystem
+            if self.last['h'] is None:
+                self._update_eig()
+
         if self.last['f'] is not None:
             self.df = f - self.last['f']
             dx = self.x - self.last['x']
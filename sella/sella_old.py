@@ -481,6 +481,12 @@ class MinModeInternal(MinModeAtoms):
         else:
             self.trajectory = None
 
+    def eval_eg(self, x):
+        # self.atoms is shared with self.internal, so move the atoms
+        # through Internal to invalidate its cached p, B and D
+        self.internal.positions = x.reshape((-1, 3))
+        return MinModeAtoms.eval_eg(self, x)
+
     def xpolate(self, alpha):
         self.internal.xpolate(alpha)
         return self.internal.atoms.get_positions().ravel().copy()
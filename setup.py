@@ -1,4 +1,6 @@
 #!/usr/bin/env python
+import sys
+
 import numpy as np
 
 from setuptools import setup, Extension, find_packages
@@ -7,12 +9,22 @@ from Cython.Build import cythonize
 with open('README.md', 'r') as f:
     long_description = f.read()
 
+# The internal coordinate kernels are parallelized with OpenMP. Apple's
+# clang and MSVC need different (or no) flags, so only use them on
+# platforms where -fopenmp is expected to work.
+if sys.platform.startswith(('linux', 'freebsd')):
+    openmp_args = ['-fopenmp']
+else:
+    openmp_args = []
+
 ext_modules = [Extension('sella.force_match',
                          ['sella/force_match.pyx']),
                Extension('sella.cython_routines',
                          ['sella/cython_routines.pyx']),
                Extension('sella.internal_cython',
-                         ['sella/internal_cython.pyx']),
+                         ['sella/internal_cython.pyx'],
+                         extra_compile_args=openmp_args,
+                         extra_link_args=openmp_args),
                ]
 
 setup(name='Sella',
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from sella.cython_routines import (block_ortho, modified_gram_schmidt,
+                                   simple_ortho)
+
+
+def _spd(n, rng):
+    A = rng.normal(size=(n, n))
+    return A @ A.T + n * np.eye(n)
+
+
+@pytest.mark.parametrize('use_M', [False, True])
+def test_block_ortho(use_M):
+    rng = np.random.default_rng(0)
+    n = 40
+    M = _spd(n, rng) if use_M else None
+    Mmat = np.eye(n) if M is None else M
+    # Y must be M-orthonormal
+    Y = rng.normal(size=(n, 5))
+    L = np.linalg.cholesky(Y.T @ Mmat @ Y)
+    Y = np.linalg.solve(L, Y.T).T
+    X = rng.normal(size=(n, 8))
+
+    Q = block_ortho(X, Y, M)
+    assert Q.shape == (n, 8)
+    np.testing.assert_allclose(Q.T @ Mmat @ Q, np.eye(8), atol=1e-12)
+    np.testing.assert_allclose(Y.T @ Mmat @ Q, 0., atol=1e-12)
+    # Q spans the part of X outside of the span of Y
+    P = X - Y @ (Y.T @ Mmat @ X)
+    np.testing.assert_allclose(Q @ (Q.T @ Mmat @ P), P, atol=1e-10)
+
+
+def test_block_ortho_dependent_columns():
+    rng = np.random.default_rng(1)
+    n = 30
+    Y = np.linalg.qr(rng.normal(size=(n, 3)))[0]
+    X = rng.normal(size=(n, 4))
+    # A column in the span of Y, and one in the span of the others
+    X = np.column_stack([X, Y @ rng.normal(size=3), X[:, :2] @ [1., -2.]])
+    Q = block_ortho(X, Y)
+    assert Q.shape == (n, 4)
+    np.testing.assert_allclose(Q.T @ Q, np.eye(4), atol=1e-12)
+    np.testing.assert_allclose(Y.T @ Q, 0., atol=1e-12)
+
+
+def test_block_ortho_qr():
+    X = np.random.default_rng(2).normal(size=(25, 6))
+    Q, R = np.linalg.qr(X)
+    # Same Q factor as the QR decomposition, up to the signs of columns
+    Q *= np.sign(np.diag(R))
+    np.testing.assert_allclose(block_ortho(X), Q, atol=1e-12)
+    np.testing.assert_allclose(modified_gram_schmidt(X), Q, atol=1e-12)
+
+
+def test_simple_ortho():
+    rng = np.random.default_rng(3)
+    Y = np.linalg.qr(rng.normal(size=(20, 4)))[0]
+    X = rng.normal(size=(20, 3))
+    Q = simple_ortho(X, Y)
+    np.testing.assert_allclose(Q.T @ Q, np.eye(Q.shape[1]), atol=1e-12)
+    np.testing.assert_allclose(Y.T @ Q, 0., atol=1e-12)
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+from ase.build import bulk, molecule
+from ase.neighborlist import neighbor_list
+
+from sella.force_match import FitContext, _group_pairs, _neighbor_pairs
+
+
+def _fit_context(atoms, types=('buck', 'bond')):
+    pairs, coords, dists = _neighbor_pairs(atoms, 5.)
+    enumbers = atoms.numbers
+    groups = _group_pairs(enumbers, pairs, coords)
+    ff_data = dict(lj={}, buck={}, morse={}, bond={})
+    for name in types:
+        if name == 'bond':
+            bonded = dists < 1.6
+            ff_data['bond'] = _group_pairs(enumbers, pairs[bonded],
+                                           coords[bonded])
+        else:
+            ff_data[name] = groups
+    return FitContext(ff_data, len(atoms), np.zeros((len(atoms), 3)))
+
+
+def _parameters(ctx, rng):
+    linpars = rng.uniform(0.5, 2., size=ctx.nlin)
+    nonlinpars = rng.uniform(1., 3., size=ctx.nnonlin)
+    return linpars, nonlinpars
+
+
+@pytest.mark.parametrize('types', [('buck', 'bond'), ('lj', 'morse')])
+def test_calc_hess_sparse(types):
+    atoms = molecule('CH3CH2OH')
+    ctx = _fit_context(atoms, types)
+    linpars, nonlinpars = _parameters(ctx, np.random.default_rng(0))
+    H = ctx.calc_hess(linpars, nonlinpars)
+    Hs = ctx.calc_hess(linpars, nonlinpars, sparse=True)
+    assert Hs.blocksize == (3, 3)
+    np.testing.assert_allclose(Hs.toarray(), H, atol=1e-12)
+    np.testing.assert_allclose(H, H.T, atol=1e-12)
+    # Pair potentials are invariant to rigid translations
+    T = np.tile(np.eye(3), (len(atoms), 1))
+    np.testing.assert_allclose(H @ T, 0., atol=1e-10 * np.abs(H).max())
+
+
+def test_calc_hess_sparse_periodic():
+    atoms = bulk('NaCl', 'rocksalt', a=5.6) * (2, 1, 1)
+    ctx = _fit_context(atoms, ('buck',))
+    linpars, nonlinpars = _parameters(ctx, np.random.default_rng(1))
+    H = ctx.calc_hess(linpars, nonlinpars)
+    Hs = ctx.calc_hess(linpars, nonlinpars, sparse=True)
+    np.testing.assert_allclose(Hs.toarray(), H, atol=1e-12)
+    with pytest.raises(ValueError):
+        ctx.calc_hess(linpars[:-1], nonlinpars)
+
+
+@pytest.mark.parametrize('periodic', [False, True])
+def test_neighbor_pairs(periodic):
+    if periodic:
+        atoms = bulk('Cu', 'fcc', a=3.6, cubic=True)
+        atoms.rattle(0.05, seed=0)
+    else:
+        atoms = molecule('CH3CH2OH')
+    cutoff = 4.
+    pairs, coords, dists = _neighbor_pairs(atoms, cutoff)
+    np.testing.assert_allclose(np.linalg.norm(coords, axis=1), dists)
+    found = sorted((i, j, tuple(np.round(d, 8))) for (i, j), d
+                   in zip(pairs, coords))
+
+    # ASE lists every pair in both directions; keep one of each
+    i, j, D = neighbor_list('ijD', atoms, cutoff)
+    ref = []
+    for a, b, d in zip(i, j, D):
+        if a < b or (a == b and tuple(d) > (0., 0., 0.)):
+            ref.append((a, b, tuple(np.round(d, 8))))
+    assert len(found) == len(ref)
+    np.testing.assert_allclose([f[2] for f in found],
+                               [r[2] for r in sorted(ref)], atol=1e-7)
+    assert [f[:2] for f in found] == [r[:2] for r in sorted(ref)]
@@ -0,0 +1,24 @@
+import numpy as np
+
+from sella.hessian_update import Symmetrizer, symmetrize_Y
+
+
+def test_symmetrizer():
+    rng = np.random.default_rng(0)
+    d = 30
+    A = rng.normal(size=(d, d))
+    A = A + A.T
+    S = rng.normal(size=(d, 12))
+    # Y is A @ S up to noise, so it is not exactly symmetric in S
+    Y = A @ S + 1e-3 * rng.normal(size=S.shape)
+
+    # Start small so that the buffers have to grow
+    sym = Symmetrizer(d, capacity=2)
+    sym.add(S[:, :1], Y[:, :1])
+    for k in range(2, S.shape[1] + 1, 3):
+        sym.add(S[:, sym.k:k], Y[:, sym.k:k])
+        Ytilde = symmetrize_Y(S[:, :k], Y[:, :k], symm=2)
+        np.testing.assert_allclose(sym.Ytilde, Ytilde, atol=1e-10)
+        np.testing.assert_allclose(sym.Atilde, S[:, :k].T @ Ytilde,
+                                   atol=1e-10)
+        np.testing.assert_allclose(sym.Atilde, sym.Atilde.T, atol=1e-10)
@@ -0,0 +1,190 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from ase import Atoms
+from ase.build import bulk, fcc111, molecule
+from ase.data import covalent_radii
+
+from sella.internal import Internal
+from sella.internal_cython import get_internal, cart_to_internal
+
+
+def _ethanol():
+    atoms = molecule('CH3CH2OH')
+    atoms.rattle(0.05, seed=1)
+    return atoms
+
+
+def _slab():
+    atoms = fcc111('Cu', (2, 2, 2), vacuum=5.)
+    atoms.rattle(0.05, seed=2)
+    return atoms
+
+
+def _coords(atoms):
+    """Internal coordinates of atoms, with the arguments needed to
+    evaluate them with cart_to_internal"""
+    _, _, bonds, angles, dihedrals, images = get_internal(atoms)
+    mask = np.ones(len(bonds) + len(angles) + len(dihedrals), dtype=np.uint8)
+    if np.any(atoms.pbc):
+        cell, images = atoms.cell.array, images
+    else:
+        cell, images = None, None
+    return (bonds, angles, dihedrals, mask), dict(cell=cell, images=images)
+
+
+def _wrap(dq, nba):
+    dq = dq.copy()
+    dq[nba:] = (dq[nba:] + np.pi) % (2 * np.pi) - np.pi
+    return dq
+
+
+@pytest.mark.parametrize('make_atoms', [_ethanol, _slab])
+def test_cart_to_internal_finite_difference(make_atoms):
+    atoms = make_atoms()
+    args, kwargs = _coords(atoms)
+    nba = len(args[0]) + len(args[1])
+    pos = atoms.positions
+    q, B, D = cart_to_internal(pos, *args, gradient=True, curvature=True,
+                               **kwargs)
+    v = np.random.default_rng(0).normal(size=len(q))
+    Dv = D.ldot(v)
+
+    h = 1e-5
+    B_fd = np.zeros_like(B)
+    Dv_fd = np.zeros_like(Dv)
+    for j in range(pos.size):
+        dx = np.zeros(pos.size)
+        dx[j] = h
+        dx = dx.reshape(pos.shape)
+        qp, Bp, _ = cart_to_internal(pos + dx, *args, gradient=True, **kwargs)
+        qm, Bm, _ = cart_to_internal(pos - dx, *args, gradient=True, **kwargs)
+        B_fd[:, j] = _wrap(qp - qm, nba) / (2 * h)
+        Dv_fd[:, j] = v @ (Bp - Bm) / (2 * h)
+
+    # Near-linear angles of the slab have large third derivatives
+    np.testing.assert_allclose(B, B_fd, rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(Dv, Dv_fd, rtol=1e-5, atol=1e-5)
+    np.testing.assert_allclose(Dv, Dv.T, atol=1e-12)
+    # ddot is the quadratic form of each curvature block
+    u = np.random.default_rng(1).normal(size=pos.size)
+    ref = np.array([u @ D.ldot(e) @ u for e in np.eye(len(q))])
+    np.testing.assert_allclose(D.ddot(u, u), ref, atol=1e-10)
+
+
+@pytest.mark.parametrize('make_atoms', [_ethanol, _slab])
+def test_cart_to_internal_sparse(make_atoms):
+    atoms = make_atoms()
+    args, kwargs = _coords(atoms)
+    q, B, D = cart_to_internal(atoms.positions, *args, gradient=True,
+                               curvature=True, **kwargs)
+    qs, Bs, Ds = cart_to_internal(atoms.positions, *args, gradient=True,
+                                  curvature=True, sparse=True, **kwargs)
+    assert np.all(np.diff(Bs.indptr) <= 12)
+    np.testing.assert_allclose(qs, q, atol=1e-14)
+    np.testing.assert_allclose(Bs.toarray(), B, atol=1e-14)
+    v = np.random.default_rng(0).normal(size=len(q))
+    np.testing.assert_allclose(Ds.ldot(v, sparse=True).toarray(), D.ldot(v),
+                               atol=1e-12)
+
+
+@pytest.mark.parametrize('make_atoms', [_ethanol, _slab])
+def test_cart_to_internal_threads(make_atoms):
+    atoms = make_atoms()
+    args, kwargs = _coords(atoms)
+    rng = np.random.default_rng(0)
+    results = []
+    for nthreads in [1, 4]:
+        q, B, D = cart_to_internal(atoms.positions, *args, gradient=True,
+                                   curvature=True, nthreads=nthreads,
+                                   **kwargs)
+        assert D.nthreads == nthreads
+        if not results:
+            v = rng.normal(size=len(q))
+            u = rng.normal(size=3 * len(atoms))
+        results.append((q, B, D.ldot(v), D.ddot(u, u)))
+    for ref, res in zip(*results):
+        np.testing.assert_array_equal(res, ref)
+
+
+def _bonds_reference(atoms):
+    """Bonds of an aperiodic system, found the simple way: all pairs
+    within 1.335 times the sum of covalent radii are bonded, and the
+    cutoff is increased by 5% until the fragments are connected"""
+    natoms = len(atoms)
+    rcov = 1.335 * covalent_radii[atoms.numbers]
+    dists = atoms.get_all_distances()
+    frag = list(range(natoms))
+    bonds = set()
+
+    def union(i, j):
+        fi, fj = frag[i], frag[j]
+        for k in range(natoms):
+            if frag[k] == fj:
+                frag[k] = fi
+
+    scale = 1.
+    while True:
+        old = list(frag)
+        for i, j in itertools.combinations(range(natoms), 2):
+            if scale > 1 and old[i] == old[j]:
+                continue
+            if dists[i, j] <= scale * (rcov[i] + rcov[j]):
+                bonds.add((i, j))
+                union(i, j)
+        if len(set(frag)) == 1:
+            return bonds
+        scale *= 1.05
+
+
+def test_get_internal_fragments():
+    water = molecule('H2O')
+    atoms = Atoms()
+    for shift in [(0., 0., 0.), (0., 0., 3.5), (5., 0., 1.5)]:
+        frag = water.copy()
+        frag.translate(shift)
+        atoms += frag
+    _, _, bonds, _, _, _ = get_internal(atoms, False, False)
+    assert set(map(tuple, np.sort(bonds, axis=1))) == _bonds_reference(atoms)
+
+
+def test_get_internal_periodic_images():
+    a = 3.6
+    atoms = bulk('Cu', 'fcc', a=a)
+    _, nbonds, bonds, angles, dihedrals, images = get_internal(atoms)
+    # Each of the 12 nearest neighbours is a periodic image of atom 0,
+    # and each bond is counted once
+    assert nbonds[0] == 12
+    assert len(bonds) == 6
+    assert np.all(bonds == 0)
+    vecs = images[0] @ atoms.cell.array
+    np.testing.assert_allclose(np.linalg.norm(vecs, axis=1), a / np.sqrt(2))
+    offsets = set(map(tuple, images[0])) | set(map(tuple, -images[0]))
+    assert len(offsets) == 12
+
+    mask = np.ones(len(bonds) + len(angles) + len(dihedrals), dtype=np.uint8)
+    q, _, _ = cart_to_internal(atoms.positions, bonds, angles, dihedrals,
+                               mask, cell=atoms.cell.array, images=images)
+    np.testing.assert_allclose(q[:len(bonds)], a / np.sqrt(2))
+    # The angles between nearest neighbours of fcc are 60, 90, 120 and
+    # 180 degrees
+    angles_deg = np.degrees(q[len(bonds):len(bonds) + len(angles)])
+    assert np.allclose(np.min(np.abs(angles_deg[:, np.newaxis]
+                                     - [60., 90., 120., 180.]), axis=1), 0.)
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_internal_back_transformation(sparse):
+    atoms = _ethanol()
+    internal = Internal(atoms.copy(), angles=True, dihedrals=True,
+                        sparse=sparse)
+    target_atoms = atoms.copy()
+    target_atoms.rattle(0.03, seed=3)
+    target = Internal(target_atoms, angles=True, dihedrals=True).p
+    nba = internal.nb + internal.na
+    err0 = np.max(np.abs(_wrap(internal.p - target, nba)))
+    internal.p = target
+    err = np.max(np.abs(_wrap(internal.p - target, nba)))
+    assert err < 1e-3 and err < 1e-2 * err0
@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+from scipy.integrate import quad
+from scipy.linalg import expm
+from scipy.optimize import brentq
+
+from ase.build import molecule
+from ase.io import read
+
+from sella.irc import IRCPath, dwi_step
+
+
+def test_irc_path(tmp_path):
+    atoms = molecule('H2O')
+    traj = str(tmp_path / 'irc.traj')
+    path = IRCPath(atoms, trajectory=traj, capacity=2)
+    points = [(None, 0.), ('forward', -1.), ('reverse', -2.), ('forward', -3.),
+              ('reverse', -4.), ('forward', -5.)]
+    for direction, energy in points:
+        pos = atoms.positions + energy
+        path.append(direction, pos, energy, np.full((3, 3), energy))
+    path.close()
+
+    assert len(path) == len(points)
+    # Forward branch reversed, then the TS, then the reverse branch
+    energies = [a.get_potential_energy() for a in path]
+    assert energies == [-5., -3., -1., 0., -2., -4.]
+    assert path[0].get_potential_energy() == -5.
+    assert [a.get_potential_energy() for a in path[2:4]] == [-1., 0.]
+    np.testing.assert_allclose(path[3].get_forces(), 0.)
+    np.testing.assert_allclose(path[-1].positions, atoms.positions - 4.)
+    # The trajectory has the points in the order they were found
+    written = read(traj, ':')
+    assert [a.get_potential_energy() for a in written] == [e for _, e in
+                                                           points]
+
+
+def _quadratic(H, g0):
+    """A quadratic surface around x = 0, and its models at x0 = 0 and
+    at another point"""
+    x1 = np.linalg.solve(H, -g0) / 2.
+
+    def model(x):
+        g = g0 + H @ x
+        return g0 @ x + x @ H @ x / 2., g, H
+    return x1, model(np.zeros(len(g0))), model(x1)
+
+
+def test_dwi_step_isotropic():
+    # On an isotropic quadratic the steepest descent path is a straight
+    # line to the minimum at -g0 / h
+    h = 2.
+    g0 = np.array([1., -2., 0.5])
+    x1, m0, m1 = _quadratic(h * np.eye(3), g0)
+    dist = np.linalg.norm(g0) / h
+    x, s = dwi_step(x1, *m0, *m1, 0.3 * dist)
+    np.testing.assert_allclose(x, -0.3 * g0 / h, atol=1e-7)
+    np.testing.assert_allclose(s, 0.3 * dist, rtol=1e-8)
+    # The path stops at the minimum
+    x, s = dwi_step(x1, *m0, *m1, 2 * dist)
+    np.testing.assert_allclose(x, -g0 / h, atol=1e-6)
+    np.testing.assert_allclose(s, dist, rtol=1e-6)
+
+
+@pytest.mark.parametrize('s', [0.1, 0.4])
+def test_dwi_step_quadratic(s):
+    # When both models are the same quadratic, so is the interpolant,
+    # and the path is x(t) = -H^-1 (1 - exp(-H t)) g0
+    H = np.diag([0.5, 1., 3.])
+    g0 = np.array([1., 0.5, -0.8])
+    x1, m0, m1 = _quadratic(H, g0)
+
+    def speed(t):
+        return np.linalg.norm(expm(-H * t) @ g0)
+
+    t = brentq(lambda t: quad(speed, 0., t, epsabs=1e-13)[0] - s, 0., 50.)
+    ref = -np.linalg.solve(H, (np.eye(3) - expm(-H * t)) @ g0)
+    x, length = dwi_step(x1, *m0, *m1, s)
+    np.testing.assert_allclose(length, s, rtol=1e-8)
+    np.testing.assert_allclose(x, ref, atol=1e-6)
@@ -0,0 +1,74 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from scipy.optimize import brentq, minimize
+
+from sella.optimize import GDIIS, solve_secular
+
+
+@pytest.mark.parametrize('xi0', [0., 1., 100.])
+def test_solve_secular(xi0):
+    rng = np.random.default_rng(0)
+    a = rng.normal(size=20)
+    b = np.exp(rng.normal(size=20))
+    r = 0.3 * np.linalg.norm(a / b)
+    xi = solve_secular(a, b, r, xi0)
+    assert xi >= 0.
+    np.testing.assert_allclose(np.linalg.norm(a / (b + xi)), r, rtol=1e-12)
+    # The root is unique, so it matches the one found by bisection
+    ref = brentq(lambda x: np.linalg.norm(a / (b + x)) - r, 0.,
+                 np.linalg.norm(a) / r)
+    np.testing.assert_allclose(xi, ref, rtol=1e-10)
+
+
+def _gdiis(d, nhist, npoints, rng):
+    vecs = np.linalg.qr(rng.normal(size=(d, d)))[0]
+    lams = np.sort(np.exp(rng.normal(size=d)))
+    minmode = SimpleNamespace(vecs_q=vecs, lams_q=lams)
+    gdiis = GDIIS(d, nhist)
+    for _ in range(npoints):
+        gdiis.update(rng.normal(), rng.normal(size=d), rng.normal(size=d),
+                     minmode)
+    return gdiis
+
+
+@pytest.mark.parametrize('npoints', [1, 3, 8])
+def test_gdiis_calc_c(npoints):
+    rng = np.random.default_rng(npoints)
+    d = 6
+    gdiis = _gdiis(d, 5, npoints, rng)
+    idx = gdiis.indices
+    assert len(idx) == min(npoints, 5)
+    c = gdiis.c
+    assert np.all(c >= 0.)
+    np.testing.assert_allclose(c.sum(), 1.)
+    # Entries outside of the active history are unused
+    inactive = np.setdiff1d(np.arange(gdiis.nhist), idx)
+    np.testing.assert_array_equal(c[inactive], 0.)
+
+    # Compare with a general purpose constrained minimization of
+    # ||HG @ c|| over the simplex
+    HG = gdiis.HG[:, idx]
+    n = len(idx)
+    ref = minimize(lambda x: np.sum((HG @ x)**2), np.ones(n) / n,
+                   jac=lambda x: 2 * HG.T @ (HG @ x), method='SLSQP',
+                   bounds=[(0., None)] * n,
+                   constraints=dict(type='eq', fun=lambda x: np.sum(x) - 1),
+                   options=dict(ftol=1e-14, maxiter=1000))
+    assert np.linalg.norm(HG @ c[idx])**2 <= ref.fun + 1e-8
+    np.testing.assert_allclose(gdiis.r, gdiis.R @ c)
+    np.testing.assert_allclose(gdiis.g, gdiis.G @ c)
+    np.testing.assert_allclose(gdiis.e, gdiis.E @ c)
+
+
+def test_gdiis_ring_buffer():
+    rng = np.random.default_rng(0)
+    d = 4
+    gdiis = _gdiis(d, 3, 7, rng)
+    # The Gram matrix is kept up to date as the oldest entries are
+    # overwritten
+    np.testing.assert_allclose(gdiis.GTG, gdiis.HG.T @ gdiis.HG, atol=1e-12)
+    gdiis.reset()
+    assert gdiis.n == 1
+    np.testing.assert_allclose(gdiis.c[gdiis.indices], [1.])
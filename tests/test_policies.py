@@ -0,0 +1,70 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from sella.policies import (EigPolicy, FixedIntervalPolicy,
+                            ModeOverlapPolicy, TrustRatioPolicy)
+
+
+def _minmode(lams, vecs=None, ratio=None):
+    lams = np.asarray(lams, dtype=float)
+    if vecs is None:
+        vecs = np.eye(len(lams))
+    return SimpleNamespace(lams=lams, vecs=vecs, Tm=np.eye(len(lams)),
+                           ratio=ratio)
+
+
+def test_eig_policy():
+    policy = EigPolicy()
+    assert not policy(_minmode([-1., 1., 2.]), 1)
+    assert policy(_minmode([1., 2., 3.]), 1)
+    policy.probed(None, 1, 4)
+    assert not policy(SimpleNamespace(lams=None), 1)
+    assert policy.nprobes == 1
+    assert policy.nskips == 2
+    assert policy.cost == 4
+    assert [rec['reason'] for rec in policy.history] == [None, 'curvature',
+                                                         None]
+
+
+def test_fixed_interval_policy():
+    policy = FixedIntervalPolicy(interval=3)
+    minmode = _minmode([-1., 1.])
+    probes = []
+    for _ in range(7):
+        probe = policy(minmode, 1)
+        if probe:
+            policy.probed(minmode, 1, 2)
+        probes.append(probe)
+    assert probes == [False, False, True, False, False, True, False]
+    assert policy.cost == 4
+
+
+def _rotation(theta):
+    c, s = np.cos(theta), np.sin(theta)
+    return np.array([[c, -s, 0.], [s, c, 0.], [0., 0., 1.]])
+
+
+def test_mode_overlap_policy():
+    policy = ModeOverlapPolicy(threshold=0.9)
+    lams = [-1., 1., 2.]
+    # The reference mode is the one found by the initial probe
+    policy.start(_minmode(lams), 1)
+    np.testing.assert_allclose(policy.v_ref, [[1.], [0.], [0.]])
+    # cos(0.3) > 0.9, cos(0.6) < 0.9
+    assert not policy(_minmode(lams, _rotation(0.3)), 1)
+    minmode = _minmode(lams, _rotation(0.6))
+    assert policy(minmode, 1)
+    policy.probed(minmode, 1, 3)
+    np.testing.assert_allclose(policy.v_ref, _rotation(0.6)[:, :1])
+    assert not policy(_minmode(lams, _rotation(0.8)), 1)
+    assert policy.history[-2]['reason'] == 'overlap'
+
+
+def test_trust_ratio_policy():
+    policy = TrustRatioPolicy(lower=0.5, upper=2.)
+    lams = [-1., 1.]
+    assert not policy(_minmode(lams, ratio=None), 1)
+    assert not policy(_minmode(lams, ratio=1.), 1)
+    assert policy(_minmode(lams, ratio=0.2), 1)
+    assert policy(_minmode(lams, ratio=3.), 1)